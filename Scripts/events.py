@@ -0,0 +1,157 @@
+# Sources telling discovery when the USB topology may have changed, so it only enumerates then instead of every few seconds
+import contextlib
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+class EventSource:
+    # Whether changes are reported as they happen. Polling sources aren't, waiting for the timeout does the work.
+    push = True
+    # Longest discovery waits before enumerating anyway, in case an event was missed
+    timeout = 30.0
+
+    def __init__(self):
+        self.events = 0
+        self._event = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # (loop, future) of a wait_async() in progress. The lock makes checking the event and registering the waiter one step, so a signal in between isn't lost.
+        self._lock = threading.Lock()
+        self._waiter: Optional[tuple] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        raise NotImplementedError
+
+    def signal(self):
+        # Called from the watcher thread
+        with self._lock:
+            self.events += 1
+            self._event.set()
+            waiter = self._waiter
+        if waiter:
+            loop, woken = waiter
+            # The loop may have closed since
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(True))
+
+    def take(self):
+        # Returns whether anything happened since the last call, and forgets it. Call before enumerating, so anything after is seen next time.
+        changed = self._event.is_set()
+        self._event.clear()
+        return changed
+
+    def wait(self, timeout: float):
+        self._event.wait(timeout)
+        return self.take()
+
+    async def wait_async(self, timeout: float):
+        # Like wait, without blocking the event loop. Doesn't take() the event, the caller does before enumerating.
+        # asyncio is imported here, it takes longer to import than the rest of the engine
+        import asyncio  # pylint: disable=import-outside-toplevel
+
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+        with self._lock:
+            if self._event.is_set():
+                return True
+            self._waiter = (loop, woken)
+        try:
+            return await asyncio.wait_for(woken, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiter = None
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(1)
+
+
+class PollingEventSource(EventSource):
+    # No way to be told, enumerate every interval like before
+    push = False
+
+    def __init__(self, interval: float = 5.0):
+        super().__init__()
+        self.timeout = interval
+
+    def start(self):
+        return self
+
+
+class FileEventSource(EventSource):
+    # Fires when a file changes, for test mode (the debug dump) and testing without hardware. Checking mtime 10 times a second costs next to nothing.
+
+    def __init__(self, path: Path, interval: float = 0.1):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+
+    def _mtime(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _run(self):
+        last = self._mtime()
+        while not self._stop.wait(self.interval):
+            mtime = self._mtime()
+            if mtime != last:
+                last = mtime
+                self.signal()
+
+
+class WMIEventSource(EventSource):
+    # Win32_DeviceChangeEvent fires on any device arrival or removal, USB ones included
+
+    def __init__(self):
+        super().__init__()
+        self._ready = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    def start(self):
+        super().start()
+        # The watcher has to be created on its own thread (COM apartments), wait until it is so failures can fall back to polling
+        self._ready.wait(5)
+        if self._error or not self._ready.is_set():
+            self.close()
+            raise RuntimeError(f"WMI event watcher unavailable: {self._error}")
+        return self
+
+    def _run(self):
+        # pylint: disable=import-outside-toplevel,import-error
+        try:
+            import pythoncom
+            import wmi
+
+            pythoncom.CoInitialize()
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+            return
+        try:
+            watcher = wmi.WMI().watch_for(raw_wql="SELECT * FROM Win32_DeviceChangeEvent")
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+            pythoncom.CoUninitialize()
+            return
+
+        self._ready.set()
+        try:
+            while not self._stop.is_set():
+                try:
+                    watcher(timeout_ms=500)
+                except wmi.x_wmi_timed_out:
+                    continue
+                self.signal()
+        finally:
+            pythoncom.CoUninitialize()
+
@@ -5,6 +5,8 @@ from CoreFoundation import CFRelease  # type: ignore # pylint: disable=no-name-i
 from Foundation import NSBundle  # type: ignore # pylint: disable=no-name-in-module
 from PyObjCTools import Conversion
 
+from Scripts.metrics import metrics
+
 IOKit_bundle = NSBundle.bundleWithIdentifier_("com.apple.framework.IOKit")
 
 io_name_t_ref = b"[128c]"  # pylint: disable=invalid-name
@@ -159,6 +161,19 @@ def IORegistryEntryCopyPath(entry: io_registry_entry_t, plane: bytes) -> str:  #
 objc.loadBundleFunctions(IOKit_bundle, globals(), functions)  # type: ignore # pylint: disable=no-member
 
 
+def _counted(function):
+    # IOKit calls per enumeration, see Scripts/metrics.py
+    def counted(*args):
+        metrics.count("iokit.calls")
+        return function(*args)
+
+    return counted
+
+
+for _name, _ in functions:
+    globals()[_name] = _counted(globals()[_name])
+
+
 def ioiterator_to_list(iterator: io_iterator_t):
     # items = []
     item = IOIteratorNext(iterator)  # noqa: F821
@@ -0,0 +1,77 @@
+# Counters and timers for each phase of enumeration, cheap enough to always be on. Shown on the discovery screen (M) and dumped with --metrics-json.
+import atexit
+import contextlib
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: dict[str, int] = {}
+        # name -> [count, total seconds, last seconds, max seconds]
+        self.timers: dict[str, list] = {}
+        # Enumeration runs on an executor thread while the main thread renders
+        self._lock = threading.Lock()
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = seconds
+                timer[3] = max(timer[3], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def last(self, name: str) -> Optional[float]:
+        timer = self.timers.get(name)
+        return timer[2] if timer else None
+
+    def checkpoint(self):
+        # Counters as of now, for since()
+        with self._lock:
+            return dict(self.counters)
+
+    def since(self, checkpoint: dict):
+        with self._lock:
+            return {name: value - checkpoint.get(name, 0) for name, value in self.counters.items() if value != checkpoint.get(name, 0)}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "counters": dict(sorted(self.counters.items())),
+                "timers": {
+                    name: {"count": count, "total_ms": round(total * 1000, 3), "mean_ms": round(total / count * 1000, 3), "last_ms": round(last * 1000, 3), "max_ms": round(maximum * 1000, 3)}
+                    for name, (count, total, last, maximum) in sorted(self.timers.items())
+                },
+            }
+
+    def dump(self, path: Path):
+        path.write_text(json.dumps(self.to_dict(), indent=4))
+
+    def dump_at_exit(self, path: Path):
+        atexit.register(self.dump, path)
+
+
+metrics = Metrics()
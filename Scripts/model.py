@@ -0,0 +1,352 @@
+# Slotted classes for controllers, ports and devices, converting losslessly to and from the usb.json schema
+import functools
+import sys
+from operator import attrgetter
+from typing import NamedTuple, Optional
+
+
+def _intern(value):
+    # Port statuses, names and companion hub names repeat across thousands of ports, keep one copy of each
+    if isinstance(value, str):
+        return sys.intern(value)
+    elif isinstance(value, dict):
+        return {key: _intern(i) for key, i in value.items()}
+    return value
+
+
+class _Model:
+    # (usb.json key, attribute) for every field written to usb.json
+    FIELDS: tuple = ()
+    # Keys written even when the value is None
+    ALWAYS: tuple = ()
+    __slots__ = ("extra",)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.ATTRIBUTES = dict(cls.FIELDS)
+        cls._values = attrgetter(*cls.ATTRIBUTES.values())
+
+    def __init__(self, **kwargs):
+        for _, attribute in self.FIELDS:
+            setattr(self, attribute, None)
+        # Keys this version doesn't know about, kept so they survive a load/save. None rather than an empty dict, most objects never have any.
+        self.extra = None
+        for attribute, value in kwargs.items():
+            setattr(self, attribute, value)
+
+    def keys(self):
+        return [key for key, attribute in self.FIELDS if key in self.ALWAYS or getattr(self, attribute) is not None] + list(self.extra or [])
+
+    def get(self, key, default=None):
+        attribute = self.ATTRIBUTES.get(key)
+        if attribute:
+            value = getattr(self, attribute)
+            return default if value is None else value
+        return (self.extra or {}).get(key, default)
+
+    def set(self, key, value):
+        attribute = self.ATTRIBUTES.get(key)
+        if attribute:
+            setattr(self, attribute, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    @classmethod
+    def field_from_dict(cls, key, value):  # pylint: disable=unused-argument
+        return value
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        instance = cls()
+        for key, value in data.items():
+            instance.set(key, cls.field_from_dict(key, _intern(value)))
+        return instance
+
+    def to_dict(self):
+        data = {}
+        for key, attribute in self.FIELDS:
+            value = getattr(self, attribute)
+            if value is None and key not in self.ALWAYS:
+                continue
+            if isinstance(value, _Model):
+                value = value.to_dict()
+            elif isinstance(value, list):
+                value = [i.to_dict() if isinstance(i, _Model) else i for i in value]
+            data[key] = value
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def copy(self):
+        instance = type(self)()
+        for _, attribute in self.FIELDS:
+            value = getattr(self, attribute)
+            if isinstance(value, _Model):
+                value = value.copy()
+            elif isinstance(value, list):
+                value = [i.copy() if isinstance(i, _Model) else i for i in value]
+            else:
+                value = _intern(value)
+            setattr(instance, attribute, value)
+        instance.extra = dict(self.extra) if self.extra else None
+        return instance
+
+    def replace(self, **kwargs):
+        # Shallow copy with some attributes changed
+        instance = type(self)()
+        for _, attribute in self.FIELDS:
+            setattr(instance, attribute, kwargs[attribute] if attribute in kwargs else getattr(self, attribute))
+        instance.extra = dict(self.extra) if self.extra else None
+        return instance
+
+    def merge_from(self, other, merge, skip=()):
+        # Merges every field other has into this one with merge(old, new), returns {usb.json key: new value} for the ones that changed
+        changes = {}
+        for key, attribute in self.FIELDS:
+            value = getattr(other, attribute)
+            if value is None or key in skip:
+                continue
+            old = getattr(self, attribute)
+            merged = merge(old, value)
+            if merged != old:
+                changes[key] = value
+                setattr(self, attribute, merged)
+        for key, value in (other.extra or {}).items():
+            merged = merge(self.get(key), value)
+            if merged != self.get(key):
+                changes[key] = value
+                self.set(key, merged)
+        return changes
+
+    def __repr__(self):
+        # Also what snapshot digests are built from, so keep it cheap and stable
+        return f"{type(self).__name__}{self._values(self)!r}{self.extra or ''}"
+
+
+class PCIID(NamedTuple):
+    vendor: int
+    device: int
+    subsystem_vendor: Optional[int] = None
+    subsystem: Optional[int] = None
+
+    def to_dict(self):
+        return {key: f"{value:04x}" for key, value in self._asdict().items() if value is not None}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{key: int(value, 16) for key, value in data.items()})
+
+    @classmethod
+    def from_legacy(cls, pci_id: list, windows: bool):
+        # Older usb.json files have lists of hex strings. Windows ones are unpadded, and the subsystem half is SubSysID sliced as a string (subsystem, then subsystem vendor).
+        # macOS ones are padded, subsystem vendor then subsystem.
+        vendor, device = int(pci_id[0], 16), int(pci_id[1], 16)
+        if len(pci_id) < 4:
+            return cls(vendor, device)
+        elif windows:
+            subsys_id = int(pci_id[2] + pci_id[3], 16)
+            return cls(vendor, device, subsys_id & 0xFFFF, subsys_id >> 16)
+        else:
+            return cls(vendor, device, int(pci_id[2], 16), int(pci_id[3], 16))
+
+
+@functools.lru_cache(maxsize=None)
+def normalize_acpi_path(acpi_path: str):
+    # Windows gives \_SB.PCI0.XHC, macOS gives \_SB.PCI0.XHC_ for the same device. Names are padded to 4 characters with underscores in ACPI, so strip the padding.
+    # Only for matching, acpi_path itself is kept as the OS gave it since personality names and IONameMatch come from it.
+    return "\\" + ".".join(i.rstrip("_") or i for i in acpi_path.upper().lstrip("\\").split("."))
+
+
+class Identifiers(_Model):
+    FIELDS = (
+        ("instance_id", "instance_id"),
+        ("location_id", "location_id"),
+        ("path", "path"),
+        ("pci_id", "pci_id"),
+        ("pci_revision", "pci_revision"),
+        ("acpi_path", "acpi_path"),
+        ("bdf", "bdf"),
+        ("bus_number", "bus_number"),
+        ("driver_key", "driver_key"),
+        ("location_paths", "location_paths"),
+    )
+    __slots__ = tuple(attribute for _, attribute in FIELDS)
+
+    def items(self):
+        return [(key, value) for (key, _), value in zip(self.FIELDS, self._values(self)) if value is not None] + list((self.extra or {}).items())
+
+    def common(self, other):
+        # (key, value here, value there) for every identifier set in both
+        common = [(key, value_1, value_2) for (key, _), value_1, value_2 in zip(self.FIELDS, self._values(self), other._values(other)) if value_1 and value_2]
+        if self.extra and other.extra:
+            common.extend((key, value, other.extra[key]) for key, value in self.extra.items() if value and other.extra.get(key))
+        return common
+
+    @classmethod
+    def field_from_dict(cls, key, value):
+        if key == "pci_id" and isinstance(value, dict):
+            return PCIID.from_dict(value)
+        elif key == "bdf":
+            return tuple(value)
+        return value
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        instance = super().from_dict(data)
+        if isinstance(data.get("pci_id"), list):
+            # Only Windows has instance IDs
+            instance.pci_id = PCIID.from_legacy(data["pci_id"], windows="instance_id" in data)
+        return instance
+
+    def to_dict(self):
+        data = super().to_dict()
+        if self.pci_id is not None:
+            data["pci_id"] = self.pci_id.to_dict()
+        return data
+
+    def _key(self):
+        return tuple(tuple(i) if isinstance(i, list) else i for i in self._values(self)), repr(sorted((self.extra or {}).items()))
+
+    def __eq__(self, other):
+        return isinstance(other, Identifiers) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+class Device(_Model):
+    FIELDS = (
+        ("name", "name"),
+        ("instance_id", "instance_id"),
+        ("location_id", "location_id"),
+        ("port", "port"),
+        ("speed", "speed"),
+        ("devices", "devices"),
+        ("error", "error"),
+    )
+    __slots__ = tuple(attribute for _, attribute in FIELDS) + ("fingerprint",)
+
+    def __init__(self, **kwargs):
+        self.fingerprint = None
+        super().__init__(**kwargs)
+        if self.devices is None and self.error is None:
+            self.devices = []
+
+    @property
+    def ALWAYS(self):  # pylint: disable=invalid-name
+        # Errored devices are only {"error": ...}
+        return () if self.error else ("name", "speed", "devices")
+
+    @classmethod
+    def field_from_dict(cls, key, value):
+        if key == "devices":
+            return [device_from_dict(i) for i in value]
+        return value
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        instance = super().from_dict(data)
+        if instance.error and not data.get("devices"):
+            instance.devices = None
+        return instance
+
+    def copy(self):
+        instance = super().copy()
+        instance.fingerprint = self.fingerprint
+        return instance
+
+
+def device_from_dict(data):
+    # Device lists may also hold plain strings
+    return data if isinstance(data, str) else Device.from_dict(data)
+
+
+class Port(_Model):
+    FIELDS = (
+        ("index", "index"),
+        ("name", "name"),
+        ("comment", "comment"),
+        ("class", "class_"),
+        ("status", "status"),
+        ("type", "type"),
+        ("guessed", "guessed"),
+        ("devices", "devices"),
+        ("companion_info", "companion_info"),
+        ("type_c", "type_c"),
+        ("user_connectable", "user_connectable"),
+        ("location_id", "location_id"),
+        ("selected", "selected"),
+        ("selection_index", "selection_index"),
+    )
+    ALWAYS = ("index", "name", "comment", "class", "type", "guessed", "devices")
+    __slots__ = tuple(attribute for _, attribute in FIELDS)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.devices is None:
+            self.devices = []
+
+    @classmethod
+    def field_from_dict(cls, key, value):
+        if key == "devices":
+            return [device_from_dict(i) for i in value]
+        return value
+
+
+class Controller(_Model):
+    FIELDS = (
+        ("name", "name"),
+        ("identifiers", "identifiers"),
+        ("class", "class_"),
+        ("hub_name", "hub_name"),
+        ("port_count", "port_count"),
+        ("ports", "ports"),
+        ("selected_count", "selected_count"),
+    )
+    ALWAYS = ("name", "identifiers", "class", "ports")
+    __slots__ = ("name", "identifiers", "class_", "hub_name", "port_count", "_ports", "selected_count", "ports_by_index")
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if self.identifiers is None:
+            self.identifiers = Identifiers()
+        if self.ports is None:
+            self.ports = []
+
+    @property
+    def ports(self):
+        return self._ports
+
+    @ports.setter
+    def ports(self, value):
+        self._ports = value
+        # Port number -> port, kept up to date by add_port
+        self.ports_by_index = {port.index: port for port in value} if value is not None else {}
+
+    def get_port(self, index) -> Optional[Port]:
+        return self.ports_by_index.get(index)
+
+    def add_port(self, port: Port):
+        self._ports.append(port)
+        self.ports_by_index[port.index] = port
+
+    @classmethod
+    def field_from_dict(cls, key, value):
+        if key == "identifiers":
+            return Identifiers.from_dict(value)
+        elif key == "ports":
+            return [Port.from_dict(i) for i in value]
+        return value
+
+
+def controllers_from_dict(data: Optional[list]):
+    return [Controller.from_dict(i) for i in data] if data is not None else None
+
+
+def to_json(value):
+    # For json.dump(default=...)
+    if isinstance(value, _Model):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from Scripts import model
+from Scripts.metrics import metrics
+
+
+def file_mode(path: Path, default: int = 0o666):
+    # Mode for a file replacing path: the old one's, or what open()/mkdir() would give a new one under the umask
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return default & ~umask
+
+
+class HistoricalStore:
+    # Writes usb.json only when the historical data changed, at most once per debounce interval (unless flushed), and never in place.
+    # In journal mode, changes described by records are appended to usb.journal instead, and folded back into usb.json every so often.
+
+    def __init__(self, path: Path, debounce: float = 2.0, journal: bool = False, compact_after: int = 1000):
+        self.path = path
+        self.journal_path = path.with_suffix(".journal")
+        self.debounce = debounce
+        self.journal = journal
+        self.compact_after = compact_after
+
+        self.dirty = False
+        # Something changed that no record describes, so the next save has to be a full snapshot
+        self.needs_snapshot = False
+        self.pending: list[str] = []
+        # Digest of the snapshot the journal on disk applies to, and how many records it has
+        self.journal_base = None
+        self.journal_length = 0
+
+        self.last_write = 0.0
+        self.last_size = 0
+        self.last_digest = None
+
+        self.writes = 0
+        self.bytes_written = 0
+        self.writes_saved = 0
+        self.bytes_saved = 0
+
+    def load(self):
+        # Returns the snapshot and the journal records to replay on top of it
+        data = self.path.read_bytes() if self.path.exists() else None
+        controllers = model.controllers_from_dict(json.loads(data)) if data is not None else None
+        if data is not None:
+            self.last_digest = hashlib.sha1(data).hexdigest()
+            self.last_size = len(data)
+
+        records = []
+        if self.journal_path.exists():
+            lines = self.journal_path.read_text().splitlines()
+            base = json.loads(lines[0]) if lines else None
+            # A journal for a different snapshot is left over from a compaction that was interrupted, it's already part of usb.json
+            if base and base.get("op") == "base" and base.get("snapshot") == self.last_digest:
+                for line in lines[1:]:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Torn write at the end
+                        break
+                self.journal_base = self.last_digest
+                self.journal_length = len(records)
+        if records and not self.journal:
+            self.dirty = self.needs_snapshot = True
+        return controllers, records
+
+    def set_journal(self, journal: bool):
+        if journal != self.journal:
+            self.journal = journal
+            self.pending = []
+            self.dirty = self.needs_snapshot = True
+
+    def mark_dirty(self):
+        self.dirty = True
+        self.needs_snapshot = True
+
+    def record(self, record: dict):
+        self.dirty = True
+        if self.journal:
+            self.pending.append(json.dumps(record, sort_keys=True, default=model.to_json))
+
+    def save(self, controllers, force=False):
+        # A deferred save is still pending, see flush_due()
+        if not self.dirty or (not force and time.monotonic() - self.last_write < self.debounce):
+            return False
+
+        with metrics.timer("persistence.save"):
+            if self.journal and not self.needs_snapshot and self.journal_base is not None and self.journal_length + len(self.pending) <= self.compact_after:
+                self._append_journal()
+            else:
+                self._write_snapshot(controllers)
+        self.last_write = time.monotonic()
+        return True
+
+    def flush(self, controllers):
+        return self.save(controllers, force=True)
+
+    def flush_due(self):
+        # Seconds until a save deferred by the debounce can be written, None if nothing is waiting
+        if not self.dirty:
+            return None
+        return max(0.0, self.debounce - (time.monotonic() - self.last_write))
+
+    def close(self, controllers):
+        # Fold the journal back into usb.json
+        if self.journal and (self.journal_length or self.pending):
+            self._write_snapshot(controllers)
+        else:
+            self.flush(controllers)
+
+    def _append_journal(self):
+        data = "".join(line + "\n" for line in self.pending).encode()
+        with self.journal_path.open("ab") as journal_file:
+            journal_file.write(data)
+        self.writes += 1
+        self.bytes_written += len(data)
+        # Compared to rewriting the whole snapshot
+        self.bytes_saved += max(self.last_size - len(data), 0)
+        self.journal_length += len(self.pending)
+        self.pending = []
+        self.dirty = False
+
+    def _write_snapshot(self, controllers):
+        data = json.dumps(controllers, indent=4, sort_keys=True, default=model.to_json).encode()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == self.last_digest and self.path.exists():
+            self.writes_saved += 1
+            self.bytes_saved += len(data)
+        else:
+            self.write_atomic(self.path, data)
+            self.last_size = len(data)
+            self.last_digest = digest
+            self.writes += 1
+            self.bytes_written += len(data)
+
+        # usb.json has to be in place before the journal is reset, a crash in between leaves a journal for the wrong snapshot, which is ignored
+        if self.journal:
+            self.write_atomic(self.journal_path, (json.dumps({"op": "base", "snapshot": digest}) + "\n").encode())
+            self.journal_base = digest
+        elif self.journal_path.exists():
+            self.journal_path.unlink()
+            self.journal_base = None
+        self.journal_length = 0
+        self.pending = []
+        self.dirty = False
+        self.needs_snapshot = False
+
+    def remove(self):
+        self.dirty = False
+        self.needs_snapshot = False
+        self.pending = []
+        self.last_digest = None
+        self.journal_base = None
+        self.journal_length = 0
+        for path in [self.path, self.journal_path]:
+            if path.exists():
+                path.unlink()
+
+    @staticmethod
+    def write_atomic(path: Path, data: bytes):
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(data)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            # mkstemp makes it 0600
+            os.chmod(temp_path, file_mode(path))
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def stats(self):
+        journal = f", {self.journal_length} journal records" if self.journal else ""
+        return f"{self.writes} writes ({self.bytes_written} bytes), {self.writes_saved} writes ({self.bytes_saved} bytes) saved{journal}"
@@ -0,0 +1,72 @@
+# How long discovery waits between enumerations when the backend can't report changes
+import time
+from collections import deque
+from typing import Optional
+
+# settings.json key -> PollScheduler argument
+SETTINGS = {
+    "poll_min_interval": "minimum",
+    "poll_max_interval": "maximum",
+    "poll_backoff": "backoff",
+    "poll_burst_seconds": "burst",
+    "poll_cpu_budget": "cpu_budget",
+}
+
+# What discovery always waited between polls, used until the first change
+STEADY_INTERVAL = 5.0
+
+
+class PollScheduler:
+    # Polls every `minimum` seconds for `burst` seconds after a change, then multiplies the interval by `backoff` on each idle poll up to `maximum`.
+    # Enumerating never takes more than `cpu_budget` seconds per minute: when it would, the interval is stretched to fit, up to `maximum`.
+    # Starts out steady, the first enumeration is what later ones are compared to and doesn't start a burst.
+
+    def __init__(self, minimum: float = 0.5, maximum: float = 10.0, backoff: float = 2.0, burst: float = 10.0, cpu_budget: float = 3.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.backoff = backoff
+        self.burst = burst
+        self.cpu_budget = cpu_budget
+
+        self.interval = min(max(STEADY_INTERVAL, self.minimum), self.maximum)
+        self.burst_until = 0.0
+        # (time, seconds) of enumerations in the last minute
+        self.costs: deque = deque()
+        # None until the first enumeration
+        self.last_cost: Optional[float] = None
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        return cls(**{argument: settings[key] for key, argument in SETTINGS.items() if key in settings})
+
+    def spent(self, now: float):
+        while self.costs and self.costs[0][0] < now - 60:
+            self.costs.popleft()
+        return sum(cost for _, cost in self.costs)
+
+    def record(self, cost: float, changed: bool, now: Optional[float] = None):
+        # After every enumeration, with how long it took and whether anything changed. Returns the next interval.
+        now = time.monotonic() if now is None else now
+        first = self.last_cost is None
+        self.costs.append((now, cost))
+        self.last_cost = cost
+
+        if first:
+            interval = self.interval
+        elif changed:
+            self.burst_until = now + self.burst
+            interval = self.minimum
+        elif now < self.burst_until:
+            interval = self.minimum
+        else:
+            interval = min(self.interval * self.backoff, self.maximum)
+
+        if self.cpu_budget > 0:
+            # At the average cost so far, this many enumerations fit in a minute
+            average = self.spent(now) / len(self.costs)
+            interval = min(max(interval, average * 60 / self.cpu_budget), self.maximum)
+        self.interval = interval
+        return interval
+
+    def describe(self):
+        return f"next in {self.interval:.1f} s, last scan {self.last_cost * 1000:.0f} ms, {self.spent(time.monotonic()):.1f}/{self.cpu_budget:g} s per minute"
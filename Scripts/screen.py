@@ -0,0 +1,101 @@
+# Draws menus with ANSI escapes instead of running cls/clear, and only rewrites the lines that changed since the last frame
+import os
+import re
+import shutil
+import sys
+
+from Scripts.metrics import metrics
+from Scripts.tracing import traced
+
+ESCAPES = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+# Home, clear the screen and the scrollback, like clear does
+CLEAR = "\x1b[H\x1b[2J\x1b[3J"
+
+
+def enable_vt_mode():
+    # Windows 10+ consoles understand ANSI escapes once ENABLE_VIRTUAL_TERMINAL_PROCESSING is set. Returns whether escapes can be used.
+    if os.name != "nt":
+        return True
+    try:
+        import ctypes  # pylint: disable=import-outside-toplevel
+
+        kernel32 = ctypes.windll.kernel32  # type: ignore
+        handle = kernel32.GetStdHandle(-11)  # STD_OUTPUT_HANDLE
+        mode = ctypes.c_uint32()
+        if not kernel32.GetConsoleMode(handle, ctypes.byref(mode)):
+            return False
+        return bool(mode.value & 0x0004) or bool(kernel32.SetConsoleMode(handle, mode.value | 0x0004))
+    except Exception:  # pylint: disable=broad-except
+        return False
+
+
+def visible_length(line: str):
+    return len(ESCAPES.sub("", line))
+
+
+class Screen:
+    def __init__(self):
+        self.ansi = enable_vt_mode()
+        # Last frame drawn, prompt included. Empty when something else may have been printed since, which forces a full redraw.
+        self.lines: list[str] = []
+        self.offsets: list[int] = []
+        self.rows = 0
+        self.size = None
+        self.full_redraws = 0
+        self.partial_redraws = 0
+        self.lines_written = 0
+
+    def write(self, text: str):
+        # Looked up every time, so contextlib.redirect_stdout works
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def clear(self):
+        if self.ansi:
+            self.write(CLEAR)
+        else:
+            os.system("cls" if os.name == "nt" else "clear")
+        self.lines = []
+
+    @traced()
+    def render(self, lines: list[str], prompt: str = ""):
+        # Draws the frame with the prompt as its last line, leaving the cursor after the prompt for input(). Lines can be termcolor2 objects.
+        with metrics.timer("render"):
+            self._render([str(i) for i in lines] + [prompt])
+
+    def _render(self, frame: list[str]):
+        prompt = frame[-1]
+        size = shutil.get_terminal_size()
+        offsets = []
+        row = 0
+        for line in frame:
+            offsets.append(row)
+            # Wrapped lines take more than one row, everything under them moves down
+            row += max(1, -(-visible_length(line) // size.columns))
+
+        if not self.ansi or not self.lines or size != self.size or row > size.lines or self.rows >= size.lines:
+            # Nothing to diff against, or the frame scrolls and rows can't be addressed.
+            # Also when the last frame's prompt was on the bottom row, the newline echoed by enter scrolled it.
+            self.clear()
+            self.write("\n".join(frame))
+            self.full_redraws += 1
+            self.lines_written += len(frame)
+        else:
+            parts = []
+            for i, line in enumerate(frame[:-1]):
+                if i < len(self.lines) - 1 and self.lines[i] == line and self.offsets[i] == offsets[i]:
+                    continue
+                parts.append(f"\x1b[{offsets[i] + 1};1H{line}\x1b[K")
+            # The prompt line always, since input typed after it is still there. Erasing to the end clears that and anything left by a taller frame.
+            parts.append(f"\x1b[{offsets[-1] + 1};1H{prompt}\x1b[J")
+            self.write("".join(parts))
+            self.partial_redraws += 1
+            self.lines_written += len(parts)
+
+        self.lines = frame
+        self.offsets = offsets
+        self.rows = row
+        self.size = size
+
+
+screen = Screen()
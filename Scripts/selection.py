@@ -0,0 +1,166 @@
+# Selection state for select_ports, kept up to date as ports are toggled instead of recomputed on every redraw
+from collections import Counter
+from typing import Optional
+
+from Scripts import model, topology
+
+# macOS only allows 15 ports per controller
+MAX_PORTS = 15
+
+
+class SelectionModel:
+    def __init__(self, controllers: list, companions: topology.CompanionGraph, auto_bind: bool = True):
+        self.controllers = controllers
+        self.companions = companions
+        self.auto_bind = auto_bind
+        # Ports in selection number order, selection number n is by_port[n - 1]
+        self.by_port: list[model.Port] = []
+        self._controller: dict[int, model.Controller] = {}
+        self._position: dict[int, int] = {}
+
+        # Controllers with more than MAX_PORTS selected, and selected ports without a connector type
+        self.over_limit: dict[int, model.Controller] = {}
+        self.missing_type: dict[int, model.Port] = {}
+
+        # What changed since the last take_changes()
+        self.changed_controllers: dict[int, model.Controller] = {}
+        self.changed_ports: dict[int, model.Port] = {}
+
+        for position, controller in enumerate(controllers):
+            self._position[id(controller)] = position
+            selected_count = 0
+            for port in controller.ports:
+                state = self.state(port)
+                if port.selected is None:
+                    port.selected = self.is_populated(port)
+                port.selection_index = len(self.by_port) + 1
+                self.by_port.append(port)
+                self._controller[id(port)] = controller
+                selected_count += 1 if port.selected else 0
+                self._update_missing_type(port)
+                if self.state(port) != state:
+                    self.changed_ports[id(port)] = port
+            if controller.selected_count != selected_count:
+                controller.selected_count = selected_count
+                self.changed_controllers[id(controller)] = controller
+            self._update_over_limit(controller)
+
+    @staticmethod
+    def state(port: model.Port):
+        # What select_ports can change on a port, as journaled
+        return {"selected": port.selected, "selection_index": port.selection_index, "type": port.type, "comment": port.comment}
+
+    def controller_of(self, port: model.Port) -> model.Controller:
+        return self._controller[id(port)]
+
+    def position(self, controller: model.Controller) -> int:
+        return self._position[id(controller)]
+
+    def companion(self, port: model.Port) -> Optional[model.Port]:
+        return self.companions.companion(port)
+
+    def is_populated(self, port: model.Port):
+        companion = self.companion(port)
+        return bool(port.devices) or (bool(companion.devices) if companion else False)
+
+    def get(self, number: int) -> Optional[model.Port]:
+        return self.by_port[number - 1] if number - 1 in range(len(self.by_port)) else None
+
+    def _update_over_limit(self, controller: model.Controller):
+        if controller.selected_count > MAX_PORTS:
+            self.over_limit[id(controller)] = controller
+        else:
+            self.over_limit.pop(id(controller), None)
+
+    def _update_missing_type(self, port: model.Port):
+        if port.selected and port.type is None and port.guessed is None:
+            self.missing_type[id(port)] = port
+        else:
+            self.missing_type.pop(id(port), None)
+
+    def set_selected(self, port: model.Port, selected: bool):
+        if port.selected == selected:
+            return
+        port.selected = selected
+        controller = self._controller[id(port)]
+        controller.selected_count += 1 if selected else -1
+        self._update_over_limit(controller)
+        self._update_missing_type(port)
+        self.changed_ports[id(port)] = port
+        self.changed_controllers[id(controller)] = controller
+
+    def set_type(self, port: model.Port, port_type):
+        port.type = port_type
+        self._update_missing_type(port)
+        self.changed_ports[id(port)] = port
+
+    def set_comment(self, port: model.Port, comment: Optional[str]):
+        port.comment = comment
+        self.changed_ports[id(port)] = port
+
+    def select_all(self, selected: bool):
+        for port in self.by_port:
+            self.set_selected(port, selected)
+
+    def select_populated(self):
+        for port in self.by_port:
+            if self.is_populated(port):
+                self.set_selected(port, True)
+
+    def deselect_empty(self):
+        for port in self.by_port:
+            if not self.is_populated(port):
+                self.set_selected(port, False)
+
+    def _bound_ports(self, port_nums: list[str]):
+        # Yields (port, companion to change along with it), with companions listed in port_nums only handled once.
+        # Raises ValueError for a non-numeric entry, after handling the ones before it.
+        # Counts rather than removing companions from the list, ranges make for long lists
+        remaining = Counter(port_nums)
+        for port_num in port_nums:
+            if not remaining[port_num]:
+                continue
+            port = self.get(int(port_num))
+            if not port:
+                continue
+            companion = self.companion(port) if self.auto_bind else None
+            if companion and remaining[str(companion.selection_index)]:
+                remaining[str(companion.selection_index)] -= 1
+            yield port, companion
+
+    def toggle(self, port_nums: list[str]):
+        for port, companion in self._bound_ports(port_nums):
+            if companion:
+                self.set_selected(companion, not port.selected)
+            self.set_selected(port, not port.selected)
+
+    def set_selections(self, port_nums: list[str], selected: bool):
+        for port, companion in self._bound_ports(port_nums):
+            if companion:
+                self.set_selected(companion, selected)
+            self.set_selected(port, selected)
+
+    def set_types(self, port_nums: list[str], port_type):
+        for port, companion in self._bound_ports(port_nums):
+            if companion:
+                self.set_type(companion, port_type)
+            self.set_type(port, port_type)
+
+    def set_comments(self, port_nums: list[str], comment: Optional[str]):
+        for port_num in port_nums:
+            port = self.get(int(port_num))
+            if port:
+                self.set_comment(port, comment)
+
+    def any_selected(self):
+        return any(controller.selected_count for controller in self.controllers)
+
+    def errors(self):
+        return [f"Port {port.selection_index} is missing a connector type!" for port in sorted(self.missing_type.values(), key=lambda i: i.selection_index)]
+
+    def take_changes(self):
+        # Returns and forgets what changed, for journaling and redrawing
+        changed = (list(self.changed_controllers.values()), list(self.changed_ports.values()))
+        self.changed_controllers = {}
+        self.changed_ports = {}
+        return changed
@@ -0,0 +1,167 @@
+# The select_ports input language, which can also be run on a usb.json without the TUI (see cli.py).
+#
+#   1,2,3         toggle ports 1, 2 and 3
+#   1-40          ranges work anywhere a port number does
+#   +1-40  -5     select/deselect instead of toggling
+#   T:1-4:9       set the connector type
+#   C:1:Name      set a comment, C:1 clears it. The comment is the rest of the line, ; and # included.
+#   A N P D       select all/none, enable all populated, disable all empty, like the menu
+#
+# Instead of port numbers: populated, empty, selected, unselected, speed=SS|SSP|HS|FS|LS|unknown, controller=n, type=unknown|t.
+# Join with & to only take ports matching all of them (controller=2&populated).
+# Statements are separated by ; or new lines, # starts a comment in files.
+import re
+from typing import Callable, NamedTuple, Union
+
+from Scripts import shared
+from Scripts.selection import SelectionModel
+
+
+class ScriptError(ValueError):
+    pass
+
+
+SPEEDS = {
+    "ls": shared.USBDeviceSpeeds.LowSpeed,
+    "fs": shared.USBDeviceSpeeds.FullSpeed,
+    "hs": shared.USBDeviceSpeeds.HighSpeed,
+    "ss": shared.USBDeviceSpeeds.SuperSpeed,
+    "ssp": shared.USBDeviceSpeeds.SuperSpeedPlus,
+    "unknown": shared.USBDeviceSpeeds.Unknown,
+}
+
+# A port number range, or a predicate taking (selection, port)
+Atom = Union[range, Callable]
+
+
+class Statement(NamedTuple):
+    # toggle, select, deselect, type, comment, all, none, populated or empty
+    action: str
+    # Comma separated terms, each a list of atoms joined by &
+    selector: tuple = ()
+    argument: object = None
+
+
+LETTERS = {"A": "all", "N": "none", "P": "populated", "D": "empty"}
+
+
+def _predicate(name: str, value: str) -> Callable:
+    if name == "populated" and value is None:
+        return lambda selection, port: selection.is_populated(port)
+    elif name == "empty" and value is None:
+        return lambda selection, port: not selection.is_populated(port)
+    elif name == "selected" and value is None:
+        return lambda selection, port: port.selected
+    elif name == "unselected" and value is None:
+        return lambda selection, port: not port.selected
+    elif name == "speed" and value and value.lower() in SPEEDS:
+        speed = SPEEDS[value.lower()]
+        return lambda selection, port: port.class_ == speed
+    elif name == "controller" and value and value.isdigit():
+        position = int(value) - 1
+        return lambda selection, port: selection.position(selection.controller_of(port)) == position
+    elif name == "type" and value and value.lower() == "unknown":
+        return lambda selection, port: port.type is None and port.guessed is None
+    elif name == "type" and value and value.isdigit():
+        port_type = int(value)
+        return lambda selection, port: (port.type if port.type is not None else port.guessed) == port_type
+    raise ScriptError(f"Unknown predicate {name}{'=' + value if value is not None else ''}")
+
+
+def _parse_atom(text: str) -> Atom:
+    if text.isdigit():
+        return range(int(text), int(text) + 1)
+    match = re.fullmatch(r"(\d+)-(\d+)", text)
+    if match:
+        start, end = int(match[1]), int(match[2])
+        if start > end:
+            raise ScriptError(f"Empty range {text}")
+        return range(start, end + 1)
+    name, _, value = text.partition("=")
+    return _predicate(name.lower(), value if _ else None)
+
+
+def parse_selector(text: str) -> tuple:
+    text = text.replace(" ", "")
+    if not text:
+        raise ScriptError("No ports given")
+    return tuple(tuple(_parse_atom(atom) for atom in term.split("&")) for term in text.split(","))
+
+
+def parse_statement(text: str) -> Statement:
+    text = text.strip()
+    if text.upper() in LETTERS:
+        return Statement(LETTERS[text.upper()])
+    elif text[:2].upper() == "T:":
+        parts = text.split(":")
+        if len(parts) != 3:
+            raise ScriptError(f"Expected T:ports:type, got {text}")
+        try:
+            port_type = shared.USBPhysicalPortTypes(int(parts[2]))
+        except ValueError:
+            raise ScriptError(f"Unknown connector type {parts[2]}") from None
+        return Statement("type", parse_selector(parts[1]), port_type)
+    elif text[:2].upper() == "C:":
+        parts = text.split(":", 2)
+        return Statement("comment", parse_selector(parts[1]), parts[2] if len(parts) == 3 else None)
+    elif text[:1] in ("+", "-"):
+        return Statement("select" if text[0] == "+" else "deselect", parse_selector(text[1:]))
+    return Statement("toggle", parse_selector(text))
+
+
+def parse(script: str, comments: bool = True) -> list[Statement]:
+    # comments=False for typed input
+    statements = []
+    for line in script.splitlines():
+        while line:
+            text, _, line = line.partition(";")
+            if text.strip()[:2].upper() == "C:":
+                # Port comments can have ; and # in them, so they run to the end of the line
+                statements.append(parse_statement(text + _ + line))
+                break
+            elif comments and "#" in text:
+                text = text.partition("#")[0]
+                line = ""
+            if text.strip():
+                statements.append(parse_statement(text))
+    return statements
+
+
+def select(selection: SelectionModel, selector: tuple) -> list[str]:
+    # Selection numbers in the order they were given, as strings like typed ones
+    numbers = []
+    for term in selector:
+        matched = None
+        for atom in term:
+            if isinstance(atom, range):
+                # Clamped, a typo like 1-999999999 shouldn't walk a billion numbers
+                atom_numbers = list(range(max(atom.start, 1), min(atom.stop, len(selection.by_port) + 1)))
+            else:
+                atom_numbers = [port.selection_index for port in selection.by_port if atom(selection, port)]
+            if matched is None:
+                matched = atom_numbers
+            else:
+                atom_numbers = set(atom_numbers)
+                matched = [i for i in matched if i in atom_numbers]
+        numbers.extend(str(i) for i in matched)
+    return numbers
+
+
+def run(statements: list[Statement], selection: SelectionModel):
+    for statement in statements:
+        if statement.action == "all":
+            selection.select_all(True)
+        elif statement.action == "none":
+            selection.select_all(False)
+        elif statement.action == "populated":
+            selection.select_populated()
+        elif statement.action == "empty":
+            selection.deselect_empty()
+        elif statement.action == "toggle":
+            selection.toggle(select(selection, statement.selector))
+        elif statement.action in ("select", "deselect"):
+            selection.set_selections(select(selection, statement.selector), statement.action == "select")
+        elif statement.action == "type":
+            selection.set_types(select(selection, statement.selector), statement.argument)
+        elif statement.action == "comment":
+            selection.set_comments(select(selection, statement.selector), statement.argument)
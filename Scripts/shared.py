@@ -1,11 +1,12 @@
 # pylint: disable=invalid-name
 import enum
 import sys
-from time import time
+from collections import deque
 from typing import Callable
 from pathlib import Path
 
 from Scripts._build import BUILD
+from Scripts.metrics import metrics
 
 VERSION = "0.2"
 
@@ -116,17 +117,21 @@ _usb_protocol_names = _usb_protocol_names_short if _short_names else _usb_protoc
 
 
 def time_it(func: Callable, text: str, *args, **kwargs):
-    start = time()
-    result = func(*args, **kwargs)
-    end = time()
-    input(f"{text} took {end - start}, press enter to continue".strip())
-    return result
+    # Recorded as a timer instead of waiting for enter, see Scripts/metrics.py
+    with metrics.timer(text):
+        return func(*args, **kwargs)
 
 debugging = False
+# Latest debug messages. Printed to stderr as they come (stdout may be JSON, see cli.py), except while the discovery screen owns the terminal and shows them itself.
+debug_log: deque = deque(maxlen=50)
+debug_on_screen = False
 
 def debug(str):
     if debugging:
-        input(f"DEBUG: {str}\nPress enter to continue")
+        debug_log.append(f"{str}")
+        metrics.count("debug_messages")
+        if not debug_on_screen:
+            print(f"DEBUG: {str}", file=sys.stderr)
 
 test_mode = False and debugging
 if test_mode:
@@ -0,0 +1,418 @@
+# Lookup structures over controller lists, so merges don't have to rescan everything
+from typing import Optional
+
+from Scripts import model
+
+# With Thunderbolt controllers, on hotplugs the instance ID will change, but everything else will be the same.
+# On macOS, location IDs can change all the time.
+IGNORED_IDENTIFIERS = ["instance_id", "location_id"]
+
+
+def is_same_controller(controller_1: model.Controller, controller_2: model.Controller):
+    common = controller_1.identifiers.common(controller_2.identifiers)
+    if not common:
+        # No way to tell
+        return False
+    for key, value_1, value_2 in common:
+        if key in IGNORED_IDENTIFIERS:
+            continue
+        elif len(common) == 1 and key in ["pci_revision"]:
+            # Don't match solely by pci_revision.
+            return False
+        elif key == "location_paths":
+            # Some firmwares have broken ACPI where two or more devices have the same parent and same address, and Windows does not always show all
+            # Evident with Thunderbolt controllers
+            # We will be satisified if they have at least 1 in common
+            if not set(value_1) & set(value_2):
+                return False
+        elif key == "acpi_path":
+            if model.normalize_acpi_path(value_1) != model.normalize_acpi_path(value_2):
+                return False
+        else:
+            if value_1 != value_2:
+                return False
+    return True
+
+
+def _hashable(value):
+    # Canonical identifiers (PCIID, bdf) are already tuples, only lists and dicts need converting
+    if isinstance(value, list):
+        return tuple(_hashable(i) for i in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
+
+
+def identifier_keys(controller: model.Controller):
+    # Every (key, value) pair a matching controller has to share at least one of.
+    # Any two controllers that is_same_controller accepts through a compared key agree on that key, so they land in the same bucket.
+    keys = []
+    for key, value in controller.identifiers.items():
+        if not value or key in IGNORED_IDENTIFIERS:
+            continue
+        if key == "location_paths":
+            keys.extend((key, path) for path in value)
+        elif key == "acpi_path":
+            keys.append((key, model.normalize_acpi_path(value)))
+        else:
+            keys.append((key, _hashable(value)))
+    return keys
+
+
+class ControllerIndex:
+    def __init__(self, controllers: Optional[list] = None):
+        self.controllers = []
+        self._position = {}
+        self._keys = {}
+        self._buckets: dict[tuple, dict] = {}
+        # Controllers grouped by which identifiers they have. is_same_controller also accepts two controllers that only share instance_id/location_id,
+        # and those pairs are found through these groups rather than the buckets.
+        self._signatures: dict[frozenset, dict] = {}
+        self.devices = DeviceTreeIndex()
+        self.companions = CompanionGraph(self)
+        # Built on first use by searchable(), only the historical index ever needs one
+        self.search: Optional[SearchIndex] = None
+        for controller in controllers or []:
+            self.add(controller)
+
+    def __len__(self):
+        return len(self.controllers)
+
+    def add(self, controller):
+        self._position[id(controller)] = len(self.controllers)
+        self.controllers.append(controller)
+        self._insert(controller, identifier_keys(controller))
+        self.companions.add_controller(controller)
+        if self.search is not None:
+            for port in controller.ports:
+                self.search.update_port(port)
+
+    def update(self, controller):
+        # Identifiers or hub name of an indexed controller may have changed (ie. after merge_properties), re-bucket it if so
+        self.companions.update_controller(controller)
+        keys = identifier_keys(controller)
+        if keys == self._keys[id(controller)][0]:
+            return
+        self._remove(controller)
+        self._insert(controller, keys)
+
+    def position(self, controller):
+        return self._position[id(controller)]
+
+    def add_port(self, controller, port):
+        controller.add_port(port)
+        self.companions.add_port(port)
+        if self.search is not None:
+            self.search.update_port(port)
+
+    def update_port(self, port):
+        # Companion info, devices or anything else searchable of an indexed port may have changed
+        self.companions.add_port(port)
+        if self.search is not None:
+            self.search.update_port(port)
+
+    def searchable(self):
+        if self.search is None:
+            self.search = SearchIndex()
+            for controller in self.controllers:
+                for port in controller.ports:
+                    self.search.update_port(port)
+        return self.search
+
+    def _insert(self, controller, keys):
+        signature = frozenset(key for key, value in controller.identifiers.items() if value)
+        self._keys[id(controller)] = (keys, signature)
+        self._signatures.setdefault(signature, {})[id(controller)] = controller
+        for key in keys:
+            self._buckets.setdefault(key, {})[id(controller)] = controller
+
+    def _remove(self, controller):
+        keys, signature = self._keys.pop(id(controller))
+        for table, key in [(self._signatures, signature)] + [(self._buckets, key) for key in keys]:
+            del table[key][id(controller)]
+            if not table[key]:
+                del table[key]
+
+    def find(self, original):
+        names = set(key for key, value in original.identifiers.items() if value)
+        candidates = {}
+        for key in identifier_keys(original):
+            candidates.update(self._buckets.get(key, {}))
+        for signature, controllers in self._signatures.items():
+            common_keys = signature & names
+            if common_keys and common_keys.issubset(IGNORED_IDENTIFIERS):
+                candidates.update(controllers)
+
+        for controller in sorted(candidates.values(), key=lambda i: self._position[id(i)]):
+            if is_same_controller(original, controller):
+                return controller
+        return None
+
+
+class CompanionGraph:
+    # Port -> companion port (through the hub name and port number in its companion_info), and the reverse edges
+
+    def __init__(self, index: ControllerIndex):
+        self._index = index
+        # hub_name -> {id(controller): controller}, more than one only with broken data
+        self._hubs: dict[str, dict] = {}
+        self._hub_names: dict[int, str] = {}
+        # id(port) -> (hub_name, port number) its companion_info points to
+        self._edges: dict[int, tuple] = {}
+        # (hub_name, port number) -> {id(port): port} pointing to it
+        self._reverse: dict[tuple, dict] = {}
+
+    def add_controller(self, controller: model.Controller):
+        if controller.hub_name:
+            self._hubs.setdefault(controller.hub_name, {})[id(controller)] = controller
+            self._hub_names[id(controller)] = controller.hub_name
+        for port in controller.ports:
+            self.add_port(port)
+
+    def update_controller(self, controller: model.Controller):
+        old_name = self._hub_names.get(id(controller))
+        if old_name == controller.hub_name:
+            return
+        if old_name:
+            del self._hubs[old_name][id(controller)]
+            if not self._hubs[old_name]:
+                del self._hubs[old_name]
+            del self._hub_names[id(controller)]
+        if controller.hub_name:
+            self._hubs.setdefault(controller.hub_name, {})[id(controller)] = controller
+            self._hub_names[id(controller)] = controller.hub_name
+
+    def add_port(self, port: model.Port):
+        # Also used when the port's companion_info changed
+        companion_info = port.companion_info
+        edge = (companion_info["hub"], companion_info["port"]) if companion_info and companion_info["hub"] and companion_info["port"] else None
+        old_edge = self._edges.get(id(port))
+        if old_edge == edge:
+            return
+        if old_edge:
+            del self._reverse[old_edge][id(port)]
+            if not self._reverse[old_edge]:
+                del self._reverse[old_edge]
+            del self._edges[id(port)]
+        if edge:
+            self._edges[id(port)] = edge
+            self._reverse.setdefault(edge, {})[id(port)] = port
+
+    def hub(self, hub_name):
+        hubs = self._hubs.get(hub_name)
+        if not hubs:
+            return None
+        # First one in the list, like a linear search would find
+        return min(hubs.values(), key=self._index.position) if len(hubs) > 1 else next(iter(hubs.values()))
+
+    def companion(self, port: model.Port) -> Optional[model.Port]:
+        edge = self._edges.get(id(port))
+        if not edge:
+            return None
+        hub = self.hub(edge[0])
+        return hub.get_port(edge[1]) if hub else None
+
+    def referrers(self, controller: model.Controller, port: model.Port) -> list:
+        # Ports whose companion is this port. With a hub name shared by several controllers only the first one's ports are companions, like in companion()
+        if not controller.hub_name or self.hub(controller.hub_name) is not controller:
+            return []
+        return list(self._reverse.get((controller.hub_name, port.index), {}).values())
+
+
+class SearchIndex:
+    # Finds ports by name, comment, selection number, or the names and instance IDs (VID/PID) of devices seen on them.
+    # Every query matches substrings: up to 3 characters straight from the index, longer ones through their trigrams.
+
+    def __init__(self):
+        # id(port) -> port, and the lowercased text it's found by, one term per line
+        self.ports: dict[int, model.Port] = {}
+        self._text: dict[int, str] = {}
+        # Every 1, 2 and 3 character substring -> {id(port)}
+        self._grams: dict[str, set] = {}
+
+    @staticmethod
+    def terms(port: model.Port):
+        terms = [port.name, port.comment, str(port.selection_index) if port.selection_index is not None else None]
+        devices = list(port.devices)
+        while devices:
+            device = devices.pop()
+            if isinstance(device, model.Device):
+                terms += [device.name, device.instance_id]
+                devices.extend(device.devices)
+        return sorted(set(i.strip().lower() for i in terms if isinstance(i, str) and i.strip()))
+
+    @staticmethod
+    def _keys(text: str):
+        return {text[i : i + length] for length in (1, 2, 3) for i in range(len(text) - length + 1)}
+
+    def update_port(self, port: model.Port):
+        key = id(port)
+        text = "\n".join(self.terms(port))
+        if self._text.get(key) == text:
+            return
+        self.remove_port(port)
+        self.ports[key] = port
+        self._text[key] = text
+        for gram in self._keys(text):
+            self._grams.setdefault(gram, set()).add(key)
+
+    def remove_port(self, port: model.Port):
+        key = id(port)
+        text = self._text.pop(key, None)
+        if text is None:
+            return
+        del self.ports[key]
+        for gram in self._keys(text):
+            self._grams[gram].discard(key)
+            if not self._grams[gram]:
+                del self._grams[gram]
+
+    def search(self, query: str) -> set:
+        # Returns the ids of the matching ports
+        query = query.strip().lower()
+        if not query:
+            return set(self.ports)
+        if len(query) <= 3:
+            return set(self._grams.get(query, ()))
+        candidates = None
+        # Rarest trigram first, so the intersection shrinks quickly
+        for trigram in sorted({query[i : i + 3] for i in range(len(query) - 2)}, key=lambda i: len(self._grams.get(i, ()))):
+            ports = self._grams.get(trigram)
+            if not ports:
+                return set()
+            candidates = set(ports) if candidates is None else candidates & ports
+        # Having every trigram doesn't mean having them in a row
+        return {key for key in candidates if query in self._text[key]}
+
+
+def _is_error(device):
+    return isinstance(device, model.Device) and bool(device.error)
+
+
+def _without_errors(device):
+    if not isinstance(device, model.Device):
+        return device
+    return device.replace(devices=[_without_errors(i) for i in device.devices if i and not _is_error(i)])
+
+
+def device_fingerprint(device, memo: Optional[dict] = None):
+    # Structural fingerprint of a device and everything below it
+    if isinstance(device, str):
+        return hash(device)
+    if memo is not None and id(device) in memo:
+        return memo[id(device)]
+    children = tuple(device_fingerprint(i, memo) for i in device.devices if i and not _is_error(i))
+    fingerprint = hash((device.name, device.instance_id or device.location_id, device.speed, children))
+    if memo is not None:
+        memo[id(device)] = fingerprint
+    return fingerprint
+
+
+class DeviceTreeIndex:
+    # Caches fingerprints of historical device lists, so a merge only walks the subtrees that actually changed.
+    # Fingerprints of historical devices are cached on the devices themselves, and cleared by merge when a subtree changes.
+
+    def __init__(self):
+        # id(list) -> (list, fingerprint -> count, name -> first device with that name)
+        self._lists: dict[int, tuple[list, dict, dict]] = {}
+
+    def fingerprint(self, device):
+        if isinstance(device, str):
+            return hash(device)
+        if device.fingerprint is None:
+            children = tuple(self.fingerprint(i) for i in device.devices if i and not _is_error(i))
+            device.fingerprint = hash((device.name, device.instance_id or device.location_id, device.speed, children))
+        return device.fingerprint
+
+    def _entry(self, devices: list):
+        entry = self._lists.get(id(devices))
+        if entry and entry[0] is devices:
+            return entry, False
+
+        # First time we see this list, drop errored devices like the merge always has
+        cleaned = [i for i in devices if i and not _is_error(i)]
+        removed = len(cleaned) != len(devices)
+        devices[:] = cleaned
+
+        counts = {}
+        hubs = {}
+        for i in devices:
+            fingerprint = self.fingerprint(i)
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+            if isinstance(i, model.Device):
+                hubs.setdefault(i.name, i)
+        entry = (devices, counts, hubs)
+        self._lists[id(devices)] = entry
+        return entry, removed
+
+    def merge(self, base: list, new: list, memo: Optional[dict] = None):
+        memo = {} if memo is None else memo
+        (_, counts, hubs), changed = self._entry(base)
+        for i in new:
+            if not i or _is_error(i):
+                continue
+            fingerprint = device_fingerprint(i, memo)
+            if counts.get(fingerprint):
+                # Identical subtree already recorded
+                continue
+            hub = hubs.get(i.name) if isinstance(i, model.Device) else None
+            if hub is None:
+                i = _without_errors(i)
+                base.append(i)
+                counts[fingerprint] = counts.get(fingerprint, 0) + 1
+                if isinstance(i, model.Device):
+                    hubs.setdefault(i.name, i)
+                changed = True
+                continue
+
+            old_fingerprint = self.fingerprint(hub)
+            if self.merge(hub.devices, i.devices, memo):
+                hub.fingerprint = None
+                counts[old_fingerprint] -= 1
+                if not counts[old_fingerprint]:
+                    del counts[old_fingerprint]
+                new_fingerprint = self.fingerprint(hub)
+                counts[new_fingerprint] = counts.get(new_fingerprint, 0) + 1
+                changed = True
+        return changed
+
+
+class SnapshotDigest:
+    # Remembers cheap digests of the previous snapshot, so an idle poll can skip merging, drawing and saving
+
+    def __init__(self):
+        # Snapshot position -> digest
+        self.controllers: dict[int, int] = {}
+        # (snapshot position, port number) -> digest
+        self.ports: dict[tuple[int, int], int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.changed_ports = 0
+
+    def update(self, controllers: list):
+        # Returns whether anything changed, and which controllers changed
+        controller_digests = {}
+        port_digests = {}
+        changed = []
+        for position, controller in enumerate(controllers):
+            ports = []
+            for port in controller.ports:
+                # repr is the cheapest way to digest a whole port, devices included
+                port_digest = hash(repr(port))
+                port_digests[(position, port.index)] = port_digest
+                ports.append(port_digest)
+            digest = hash((repr((controller.name, controller.identifiers, controller.class_, controller.hub_name, controller.port_count, controller.selected_count, controller.extra)), tuple(ports)))
+            controller_digests[position] = digest
+            if self.controllers.get(position) != digest:
+                changed.append(controller)
+
+        # A controller going away (ie. Thunderbolt unplug) doesn't need merging, but still counts as a change
+        is_changed = controller_digests != self.controllers
+        self.changed_ports = sum(1 for key, value in port_digests.items() if self.ports.get(key) != value) + len(self.ports.keys() - port_digests.keys())
+        self.controllers = controller_digests
+        self.ports = port_digests
+        if is_changed:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return is_changed, changed
@@ -0,0 +1,105 @@
+# Records nested spans as Chrome trace events, to open in Perfetto (ui.perfetto.dev) or about:tracing.
+# Off unless USBTOOLBOX_TRACE is set to the output path, or --trace is given. When off, a traced call costs one attribute check.
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer.complete(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path: Optional[Path] = None
+        self.events: list = []
+        self._threads: set = set()
+        self._origin = time.perf_counter_ns()
+        # Spans end on executor threads too
+        self._lock = threading.Lock()
+
+    def start(self, path: Path):
+        # Saved when the process exits, save() can also be called earlier
+        if not self.enabled:
+            atexit.register(self.save)
+        self.enabled = True
+        self.path = path
+        return self
+
+    def span(self, name: str, **args):
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, args)
+
+    def complete(self, name: str, start: int, end: int, args: Optional[dict] = None):
+        thread = threading.current_thread()
+        event = {"ph": "X", "name": name, "pid": os.getpid(), "tid": thread.ident, "ts": (start - self._origin) / 1000, "dur": (end - start) / 1000}
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self.events.append({"ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}})
+            self.events.append(event)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            events = list(self.events)
+        self.path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+
+tracer = Tracer()
+if os.environ.get("USBTOOLBOX_TRACE"):
+    tracer.start(Path(os.environ["USBTOOLBOX_TRACE"]))
+
+
+def traced(name: Optional[str] = None):
+    # Decorator recording a span per call, named after the function unless given
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.complete(label, start, time.perf_counter_ns())
+
+        return wrapper
+
+    return decorator
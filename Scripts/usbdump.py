@@ -1,12 +1,16 @@
 # USBDump Conversion Interface
+import asyncio
 import itertools
 import json
 import subprocess
 import sys
-from operator import itemgetter
+import time
+from operator import attrgetter
 from pathlib import Path
 
-from Scripts import shared
+from Scripts import model, shared
+from Scripts.metrics import metrics
+from Scripts.tracing import traced, tracer
 
 # input_path = input("File path: ")
 # if input_path:
@@ -103,44 +107,45 @@ def get_hub_by_name(name):
 
 # TODO: Figure out how to deal with the hub name not matching
 def get_companion_port(port):
-    return ([i for i in hub_map.get(port["companion_info"]["hub"], {"ports": []})["ports"] if i["index"] == port["companion_info"]["port"]] or [None])[0]
+    hub = hub_map.get(port.companion_info["hub"])
+    return hub.get_port(port.companion_info["port"]) if hub else None
 
 
 def guess_ports():
     for hub in hub_map:
-        for port in hub_map[hub]["ports"]:
-            if not port["status"].endswith("DeviceConnected"):
+        for port in hub_map[hub].ports:
+            if not port.status.endswith("DeviceConnected"):
                 # we don't have info. anything else is going to error
-                port["guessed"] = None
-            elif port["type_c"] or port["companion_info"]["port"] and get_companion_port(port) and get_companion_port(port).get("type_c", None):
-                port["guessed"] = shared.USBPhysicalPortTypes.USB3TypeC_WithSwitch
-            elif not port["user_connectable"]:
-                port["guessed"] = shared.USBPhysicalPortTypes.Internal
+                port.guessed = None
+            elif port.type_c or port.companion_info["port"] and get_companion_port(port) and get_companion_port(port).type_c:
+                port.guessed = shared.USBPhysicalPortTypes.USB3TypeC_WithSwitch
+            elif not port.user_connectable:
+                port.guessed = shared.USBPhysicalPortTypes.Internal
             elif (
-                port["class"] == shared.USBDeviceSpeeds.SuperSpeed
-                and port["companion_info"]["port"]
+                port.class_ == shared.USBDeviceSpeeds.SuperSpeed
+                and port.companion_info["port"]
                 and get_companion_port(port)
-                and get_companion_port(port)["class"] == shared.USBDeviceSpeeds.HighSpeed
-                or port["class"] == shared.USBDeviceSpeeds.HighSpeed
-                and port["companion_info"]["port"]
+                and get_companion_port(port).class_ == shared.USBDeviceSpeeds.HighSpeed
+                or port.class_ == shared.USBDeviceSpeeds.HighSpeed
+                and port.companion_info["port"]
                 and get_companion_port(port)
-                and get_companion_port(port)["class"] == shared.USBDeviceSpeeds.SuperSpeed
+                and get_companion_port(port).class_ == shared.USBDeviceSpeeds.SuperSpeed
             ):
-                port["guessed"] = shared.USBPhysicalPortTypes.USB3TypeA
-            elif port["class"] == shared.USBDeviceSpeeds.SuperSpeed and not port["companion_info"]["port"]:
-                port["guessed"] = shared.USBPhysicalPortTypes.Internal
+                port.guessed = shared.USBPhysicalPortTypes.USB3TypeA
+            elif port.class_ == shared.USBDeviceSpeeds.SuperSpeed and not port.companion_info["port"]:
+                port.guessed = shared.USBPhysicalPortTypes.Internal
             else:
-                port["guessed"] = shared.USBPhysicalPortTypes.USBTypeA
+                port.guessed = shared.USBPhysicalPortTypes.USBTypeA
 
 
+@traced()
 def serialize_hub(hub):
-    hub_info = {
-        "hub_name": hub["HubName"],
-        # "class": get_hub_type(hub),
-        "port_count": hub["HubInfo"]["HubInformation"]["HubDescriptor"]["bNumberOfPorts"],
-        # "highest_port_number": hub["HubInfoEx"]["HighestPortNumber"],
-        "ports": [],
-    }
+    hub_info = model.Controller(
+        hub_name=hub["HubName"],
+        # class_=get_hub_type(hub),
+        port_count=hub["HubInfo"]["HubInformation"]["HubDescriptor"]["bNumberOfPorts"],
+        # highest_port_number=hub["HubInfoEx"]["HighestPortNumber"],
+    )
 
     # HubPorts
     hub_ports = hub["HubPorts"]
@@ -148,104 +153,142 @@ def serialize_hub(hub):
         for i, port in enumerate(hub_ports):
             if not port:
                 continue
-            port_info = {
-                "index": (port.get("PortConnectorProps") or {}).get("ConnectionIndex")
+            port_info = model.Port(
+                index=(port.get("PortConnectorProps") or {}).get("ConnectionIndex")
                 or (port.get("ConnectionInfo") or {}).get("ConnectionIndex")
                 or (port.get("ConnectionInfoV2") or {}).get("ConnectionIndex")
                 or i + 1,
-                "comment": None,
-                "class": shared.USBDeviceSpeeds.Unknown,
-                "status": port["ConnectionInfo"]["ConnectionStatus"],
-                "type": None,
-                "guessed": None,
-                "devices": [],
-            }
-            port_info["name"] = f"Port {port_info['index']}"
+                comment=None,
+                class_=shared.USBDeviceSpeeds.Unknown,
+                status=port["ConnectionInfo"]["ConnectionStatus"],
+                type=None,
+                guessed=None,
+            )
+            port_info.name = f"Port {port_info.index}"
 
             friendly_error = {"DeviceCausedOvercurrent": "Device connected to port pulled too much current."}
 
-            if not port_info["status"].endswith("DeviceConnected"):
-                # shared.debug(f"Device connected to port {port_info['index']} errored. Please unplug or connect a different device.")
-                port_info["devices"] = [{"error": friendly_error.get(port_info["status"], True)}]
-                hub_info["ports"].append(port_info)
+            if not port_info.status.endswith("DeviceConnected"):
+                # shared.debug(f"Device connected to port {port_info.index} errored. Please unplug or connect a different device.")
+                port_info.devices = [model.Device(error=friendly_error.get(port_info.status, True))]
+                hub_info.add_port(port_info)
                 continue
 
-            port_info["class"] = get_port_type(port)
+            port_info.class_ = get_port_type(port)
             if not port["PortConnectorProps"]:
                 port["PortConnectorProps"] = {}
 
-            port_info["companion_info"] = {
+            port_info.companion_info = {
                 "port": port["PortConnectorProps"].get("CompanionPortNumber", ""),
                 "hub": port["PortConnectorProps"].get("CompanionHubSymbolicLinkName", ""),
                 "multiple_companions": bool(port["PortConnectorProps"].get("UsbPortProperties", {}).get("PortHasMultipleCompanions", False)),
             }
-            port_info["type_c"] = bool(port["PortConnectorProps"].get("UsbPortProperties", {}).get("PortConnectorIsTypeC", False))
-            port_info["user_connectable"] = bool(port["PortConnectorProps"].get("UsbPortProperties", {}).get("PortIsUserConnectable", True))
+            port_info.type_c = bool(port["PortConnectorProps"].get("UsbPortProperties", {}).get("PortConnectorIsTypeC", False))
+            port_info.user_connectable = bool(port["PortConnectorProps"].get("UsbPortProperties", {}).get("PortIsUserConnectable", True))
 
             # Guess port type
 
             if port["ConnectionInfo"]["ConnectionStatus"] == "DeviceConnected":
-                device_info = {"name": get_device_name(port), "instance_id": port["UsbDeviceProperties"].get("DeviceId"), "devices": []}
+                device_info = model.Device(name=get_device_name(port), instance_id=port["UsbDeviceProperties"].get("DeviceId"))
 
                 if port["DeviceInfoType"] == "ExternalHubInfo":
                     external_hub = serialize_hub(port)
-                    device_info["speed"] = get_device_speed_string(port, external_hub["port_count"])
-                    device_info["devices"] = [i for i in itertools.chain.from_iterable([hub_port["devices"] for hub_port in external_hub["ports"]]) if i]
-                    # device_info["hub_type"] = get_hub_type(port)
-                    # device_info["hub"] = serialize_hub(port)
+                    device_info.speed = get_device_speed_string(port, external_hub.port_count)
+                    device_info.devices = [i for i in itertools.chain.from_iterable([hub_port.devices for hub_port in external_hub.ports]) if i]
+                    # device_info.hub_type = get_hub_type(port)
+                    # device_info.hub = serialize_hub(port)
                 else:
-                    device_info["speed"] = get_device_speed_string(port)
+                    device_info.speed = get_device_speed_string(port)
 
-                port_info["devices"].append(device_info)
+                port_info.devices.append(device_info)
 
-            hub_info["ports"].append(port_info)
-    hub_info["ports"].sort(key=itemgetter("index"))
-    hub_map[hub_info["hub_name"]] = hub_info
+            hub_info.add_port(port_info)
+    hub_info.ports.sort(key=attrgetter("index"))
+    hub_map[hub_info.hub_name] = hub_info
     return hub_info
 
 
-def get_controllers():
-    new_info = []
-
+def get_usbdump_path():
     usbdump_path = Path("resources/usbdump.exe")
 
     if getattr(sys, "frozen", False) and hasattr(sys, "_MEIPASS"):
         usbdump_path = Path(sys._MEIPASS) / usbdump_path
+    return usbdump_path
+
+
+@traced()
+def run_usbdump():
+    if shared.test_mode:
+        with metrics.timer("usbdump.parse"):
+            return json.load(shared.debug_dump_path.open())["usbdump"]
+    with metrics.timer("usbdump.run"):
+        stdout = subprocess.run(get_usbdump_path(), stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+    with metrics.timer("usbdump.parse"):
+        return json.loads(stdout.decode())
+
+
+async def run_usbdump_async():
+    # Same as run_usbdump, but doesn't block the event loop, and cancelling kills usbdump instead of waiting for it
+    if shared.test_mode:
+        return run_usbdump()
+    start = time.perf_counter()
+    with tracer.span("run_usbdump_async"):
+        process = await asyncio.create_subprocess_exec(str(get_usbdump_path()), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, _ = await process.communicate()
+        except asyncio.CancelledError:
+            if process.returncode is None:
+                process.kill()
+            raise
+        metrics.add_time("usbdump.run", time.perf_counter() - start)
+        with metrics.timer("usbdump.parse"):
+            return json.loads(stdout.decode())
+
+
+def get_controllers(info=None):
+    if info is None:
+        info = run_usbdump()
+    with metrics.timer("usbdump.convert"):
+        return convert_controllers(info)
+
+
+@traced()
+def convert_controllers(info):
+    new_info = []
 
-    info = json.load(shared.debug_dump_path.open())["usbdump"] if shared.test_mode else json.loads(subprocess.run(usbdump_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode())
     for controller in info:
         if not controller["RootHub"]:
             # This is useless
             continue
 
         # root
-        controller_info = {
-            "name": controller["UsbDeviceProperties"]["DeviceDesc"],
-            "identifiers": {
-                "instance_id": controller["UsbDeviceProperties"]["DeviceId"],
-                # "revision": controller["Revision"],
-            },
-            # "port_count_no3": controller["ControllerInfo"]["NumberOfRootPorts"],
-            "class": "",
-        } | serialize_hub(controller["RootHub"])
+        controller_info = serialize_hub(controller["RootHub"])
+        controller_info.name = controller["UsbDeviceProperties"]["DeviceDesc"]
+        controller_info.identifiers = model.Identifiers(
+            instance_id=controller["UsbDeviceProperties"]["DeviceId"],
+            # revision=controller["Revision"],
+        )
+        # controller_info.port_count_no3 = controller["ControllerInfo"]["NumberOfRootPorts"]
+        controller_info.class_ = ""
 
         if all(controller[i] not in [0, int("0xFFFF", 16)] for i in ["VendorID", "DeviceID"]):
-            controller_info["identifiers"]["pci_id"] = [hex(controller[i])[2:] for i in ["VendorID", "DeviceID"]]
+            controller_info.identifiers.pci_id = model.PCIID(controller["VendorID"], controller["DeviceID"])
 
-        if controller["SubSysID"] not in [0, int("0xFFFFFFFF", 16)]:
-            controller_info["identifiers"]["pci_id"] += [hex(controller["SubSysID"])[2:6], hex(controller["SubSysID"])[6:]]
+            if controller["SubSysID"] not in [0, int("0xFFFFFFFF", 16)]:
+                # Subsystem ID in the high word, subsystem vendor ID in the low word
+                controller_info.identifiers.pci_id = controller_info.identifiers.pci_id._replace(subsystem_vendor=controller["SubSysID"] & 0xFFFF, subsystem=controller["SubSysID"] >> 16)
 
         if (controller.get("ControllerInfo") or {}).get("PciRevision", 0) not in [0, int("0xFF", 16)]:
-            controller_info["identifiers"]["pci_revision"] = int(controller["ControllerInfo"]["PciRevision"])
+            controller_info.identifiers.pci_revision = int(controller["ControllerInfo"]["PciRevision"])
 
         if controller["BusDeviceFunctionValid"]:
-            controller_info["identifiers"]["bdf"] = [controller["BusNumber"], controller["BusDevice"], controller["BusFunction"]]
+            controller_info.identifiers.bdf = (controller["BusNumber"], controller["BusDevice"], controller["BusFunction"])
 
         new_info.append(controller_info)
     guess_ports()
     if False:
         for hub in hub_map:
-            for port in hub_map[hub]["ports"]:
-                if port["companion_info"]["hub"]:
-                    port["companion_info"]["hub"] = hub_map[port["companion_info"]["hub"]]
+            for port in hub_map[hub].ports:
+                if port.companion_info["hub"]:
+                    port.companion_info["hub"] = hub_map[port.companion_info["hub"]]
     return new_info
@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import os
@@ -7,6 +8,8 @@ from sys import exit
 from typing import Callable, Optional, Union
 import ansiescapes
 
+from Scripts.screen import screen
+
 if os.name == "nt":
     # Windows
     import msvcrt
@@ -15,6 +18,60 @@ else:
     import select
 
 
+class ConsoleReader:
+    # Typed lines go into a queue on the running asyncio loop, so it can keep enumerating and redrawing while waiting for input. None means stdin closed.
+
+    def __init__(self):
+        self.lines: asyncio.Queue = asyncio.Queue()
+        self._buffer = ""
+        self._task: Optional[asyncio.Task] = None
+        self._fd: Optional[int] = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if os.name == "nt":
+            # No add_reader for consoles on Windows, poll the keyboard like grab does
+            self._task = loop.create_task(self._poll_keyboard())
+        else:
+            self._fd = sys.stdin.fileno()
+            loop.add_reader(self._fd, self._read)
+        return self
+
+    def _read(self):
+        # Bypasses sys.stdin's buffer, so a second line read along with the first isn't stuck there without waking the loop
+        data = os.read(self._fd, 4096).decode(errors="replace")
+        if not data:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+            self.lines.put_nowait(None)
+            return
+        *lines, self._buffer = (self._buffer + data).split("\n")
+        for line in lines:
+            self.lines.put_nowait(line.strip())
+
+    async def _poll_keyboard(self):
+        while True:
+            while msvcrt.kbhit():
+                c = msvcrt.getwche()
+                if c == "\r":
+                    print("")
+                    self.lines.put_nowait(self._buffer.strip())
+                    self._buffer = ""
+                elif c == "\b":
+                    self._buffer = self._buffer[:-1]
+                    print(" \b", end="", flush=True)
+                elif c >= " ":
+                    self._buffer += c
+            await asyncio.sleep(0.02)
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._fd is not None:
+            asyncio.get_running_loop().remove_reader(self._fd)
+            self._fd = None
+
+
 class Utils:
     def __init__(self, name="Python Script"):
         self.name = name
@@ -61,25 +118,14 @@ class Utils:
             return default
 
     def cls(self):
-        os.system("cls" if os.name == "nt" else "clear")
+        screen.clear()
 
     # Header drawing method
     def head(self, text=None, width=55):
         if text == None:
             text = self.name
         self.cls()
-        print("  {}".format("#" * width))
-        mid_len = int(round(width / 2 - len(text) / 2) - 2)
-        middle = " #{}{}{}#".format(" " * mid_len, text, " " * ((width - mid_len - len(text)) - 2))
-        if len(middle) > width + 1:
-            # Get the difference
-            di = len(middle) - width
-            # Add the padding for the ...#
-            di += 3
-            # Trim the string
-            middle = middle[:-di] + "...#"
-        print(middle)
-        print("#" * width)
+        print("\n".join(header_lines(text, width)))
 
     def custom_quit(self):
         self.head()
@@ -100,12 +146,10 @@ class Utils:
 
 
 def cls():
-    os.system("cls" if os.name == "nt" else "clear")
+    screen.clear()
 
 
-def header(text, width=55):
-    cls()
-    print("  {}".format("#" * width))
+def header_lines(text, width=55):
     mid_len = int(round(width / 2 - len(text) / 2) - 2)
     middle = " #{}{}{}#".format(" " * mid_len, text, " " * ((width - mid_len - len(text)) - 2))
     if len(middle) > width + 1:
@@ -115,8 +159,12 @@ def header(text, width=55):
         di += 3
         # Trim the string
         middle = middle[:-di] + "...#"
-    print(middle)
-    print("#" * width)
+    return ["  {}".format("#" * width), middle, "#" * width]
+
+
+def header(text, width=55):
+    cls()
+    print("\n".join(header_lines(text, width)))
 
 
 class TUIMenu:
@@ -152,7 +200,6 @@ class TUIMenu:
         self.options.append([key, name, description or [], function])
 
     def head(self):
-        cls()
         header(self.title)
         print()
 
@@ -216,7 +263,6 @@ class TUIOnlyPrint:
         self.in_between = in_between or []
 
     def start(self):
-        cls()
         header(self.title)
         print()
 
@@ -0,0 +1,69 @@
+# Shows a window of a long list of sections (ie. controllers with their ports), formatting only the sections in view
+import shutil
+from typing import Callable, Iterable, NamedTuple
+
+
+class Section(NamedTuple):
+    # How many lines the section has, and how to make them. The count has to be exact and cheap, lines() is only called if the section is in view.
+    count: int
+    lines: Callable[[], Iterable[str]]
+
+
+class Viewport:
+    KEYS = {"[": "page_up", "]": "page_down", "<": "previous_section", ">": "next_section"}
+
+    def __init__(self):
+        self.top = 0
+        self.height = 0
+        self.total = 0
+        self.starts: list[int] = []
+
+    @staticmethod
+    def fit(chrome: int, minimum: int = 5):
+        # Lines left for the viewport on this terminal after `chrome` lines of header, menu and prompt.
+        # One more row is kept free for the newline echoed when enter is pressed, a frame filling the terminal would scroll on it.
+        return max(minimum, shutil.get_terminal_size().lines - chrome - 1)
+
+    def render(self, sections: list[Section], height: int):
+        self.height = height
+        self.starts = []
+        total = 0
+        for section in sections:
+            self.starts.append(total)
+            total += section.count
+        self.total = total
+        self.top = max(0, min(self.top, total - height))
+
+        lines = []
+        bottom = self.top + height
+        for start, section in zip(self.starts, sections):
+            if start >= bottom:
+                break
+            if start + section.count <= self.top:
+                continue
+            lines += list(section.lines())[max(0, self.top - start) : bottom - start]
+        return lines
+
+    def status(self):
+        if self.total <= self.height:
+            return None
+        return f"Lines {self.top + 1}-{min(self.top + self.height, self.total)} of {self.total} ([ ] page, < > controller)"
+
+    def page_up(self):
+        self.top = max(0, self.top - self.height)
+
+    def page_down(self):
+        self.top = min(self.top + self.height, max(0, self.total - self.height))
+
+    def previous_section(self):
+        self.top = max([i for i in self.starts if i < self.top], default=0)
+
+    def next_section(self):
+        self.top = min([i for i in self.starts if i > self.top], default=self.top)
+
+    def handle(self, key: str):
+        # Returns whether the key was a viewport key
+        action = self.KEYS.get(key.strip())
+        if action:
+            getattr(self, action)()
+        return bool(action)
@@ -1,5 +1,6 @@
-import copy
+import asyncio
 import json
+import threading
 import time
 from enum import Enum
 
@@ -15,7 +16,9 @@ except Exception:  # pylint: disable=broad-except
 
 
 from base import BaseUSBMap
-from Scripts import shared, usbdump
+from Scripts import events, model, shared, usbdump
+from Scripts.metrics import metrics
+from Scripts.tracing import traced
 
 
 class PnpDeviceProperties(Enum):
@@ -31,7 +34,7 @@ class PnpDeviceProperties(Enum):
 
 
 class WindowsUSBMap(BaseUSBMap):
-    def __init__(self):
+    def __init__(self, **kwargs):
         self.usbdump = None
         if shared.test_mode:
             self.wmi = {}
@@ -40,21 +43,52 @@ class WindowsUSBMap(BaseUSBMap):
             self.wmi = wmi.WMI()
             self.wmi_cache = {}
         self.wmi_retries = {}
-        super().__init__()
+        self.wmi_local = threading.local()
+        super().__init__(**kwargs)
 
+    def event_source(self, poll_interval: float = 5.0):
+        if shared.test_mode:
+            # Editing the debug dump acts like plugging something in
+            return events.FileEventSource(shared.debug_dump_path).start()
+        try:
+            return events.WMIEventSource().start()
+        except RuntimeError:
+            return super().event_source(poll_interval)
+
+    @traced()
     def update_usbdump(self):
         self.usbdump = usbdump.get_controllers()
 
+    @property
+    def wmi_connection(self):
+        # WMI objects belong to the COM apartment of the thread that made them, so enumerating on an executor thread needs its own
+        if shared.test_mode or threading.current_thread() is threading.main_thread():
+            return self.wmi
+        if not hasattr(self.wmi_local, "wmi"):
+            try:
+                import pythoncom  # pylint: disable=import-error,import-outside-toplevel
+
+                pythoncom.CoInitialize()
+            except ImportError:
+                pass
+            self.wmi_local.wmi = wmi.WMI()
+        return self.wmi_local.wmi
+
+    @traced()
     def get_property_from_wmi(self, instance_id, prop: PnpDeviceProperties):
         MAX_TRIES = 2
         result = None
+        metrics.count("wmi.lookups")
         if self.wmi_cache.get(instance_id, {}).get(prop.value):
+            metrics.count("wmi.cache_hits")
             return self.wmi_cache[instance_id][prop.value]
         elif self.wmi_retries.get(instance_id, {}).get(prop.value, 0) >= MAX_TRIES:
+            metrics.count("wmi.retries_exhausted")
             return None
 
         try:
-            result = self.wmi.query(f"SELECT * FROM Win32_PnPEntity WHERE PNPDeviceID = '{instance_id}'")[0].GetDeviceProperties([prop.value])[0][0].Data
+            with metrics.timer("wmi.query"):
+                result = self.wmi_connection.query(f"SELECT * FROM Win32_PnPEntity WHERE PNPDeviceID = '{instance_id}'")[0].GetDeviceProperties([prop.value])[0][0].Data
         except IndexError:
             # Race condition between unplug detected in usbdump and WMI
             return None
@@ -86,19 +120,19 @@ class WindowsUSBMap(BaseUSBMap):
             return value """
 
     def get_name_from_wmi(self, device):
-        if not isinstance(device, dict):
+        if not isinstance(device, model.Device):
             return
-        if device.get("error") or not device["instance_id"]:
+        if device.error or not device.instance_id:
             return
-        device["name"] = self.get_property_from_wmi(device["instance_id"], PnpDeviceProperties.BUS_REPORTED_NAME) or device["name"]
-        for i in device["devices"]:
+        device.name = self.get_property_from_wmi(device.instance_id, PnpDeviceProperties.BUS_REPORTED_NAME) or device.name
+        for i in device.devices:
             self.get_name_from_wmi(i)
 
     def get_controller_class(self, controller):
-        interface = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.INTERFACE)
+        interface = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.INTERFACE)
         if interface:
             return shared.USBControllerTypes(interface)
-        service = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.SERVICE)
+        service = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.SERVICE)
         if not isinstance(service, str):
             shared.debug(f"Unknown controller type for interface {interface} and service {service}!")
             return shared.USBControllerTypes.Unknown
@@ -114,7 +148,14 @@ class WindowsUSBMap(BaseUSBMap):
             shared.debug(f"Unknown controller type for interface {interface} and service {service}!")
             return shared.USBControllerTypes.Unknown
 
+    @traced()
     def get_controllers(self):
+        self.controllers = self.enumerate_controllers()
+        return self.update_historical()
+
+    @traced()
+    def enumerate_controllers(self, devices_only: bool = False):  # pylint: disable=unused-argument
+        # usbdump always lists controllers and devices together
         # self.update_usbdump()
         for i in range(10):
             try:
@@ -128,33 +169,46 @@ class WindowsUSBMap(BaseUSBMap):
                     shared.debug(e)
                     time.sleep(0.05 if shared.debugging else 2)
 
-        controllers = self.usbdump
+        return self.add_wmi_properties(self.usbdump)
 
+    @traced()
+    def add_wmi_properties(self, controllers):
         for controller in controllers:
-            controller["name"] = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.FRIENDLY_NAME) or controller["name"]
-            controller["class"] = self.get_controller_class(controller)
-            acpi_path = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.ACPI_PATH)
+            controller.name = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.FRIENDLY_NAME) or controller.name
+            controller.class_ = self.get_controller_class(controller)
+            acpi_path = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.ACPI_PATH)
             if acpi_path:
-                controller["identifiers"]["acpi_path"] = acpi_path
-            driver_key = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.DRIVER_KEY)
+                controller.identifiers.acpi_path = acpi_path
+            driver_key = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.DRIVER_KEY)
             if driver_key:
-                controller["identifiers"]["driver_key"] = driver_key
-            location_paths = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.LOCATION_PATHS)
+                controller.identifiers.driver_key = driver_key
+            location_paths = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.LOCATION_PATHS)
             if location_paths:
-                controller["identifiers"]["location_paths"] = location_paths
-            # controller["identifiers"]["bdf"] = self.get_property_from_wmi(controller["identifiers"]["instance_id"], PnpDeviceProperties.BUS_DEVICE_FUNCTION)
-            for port in controller["ports"]:
-                for device in port["devices"]:
+                controller.identifiers.location_paths = location_paths
+            # controller.identifiers.bdf = self.get_property_from_wmi(controller.identifiers.instance_id, PnpDeviceProperties.BUS_DEVICE_FUNCTION)
+            for port in controller.ports:
+                for device in port.devices:
                     self.get_name_from_wmi(device)
 
-        self.controllers = controllers
-        if not self.controllers_historical:
-            self.controllers_historical = copy.deepcopy(self.controllers)
-        else:
-            self.merge_controllers(self.controllers_historical, self.controllers)
+        return controllers
+
+    async def enumerate_controllers_async(self, executor=None, devices_only: bool = False):
+        # usbdump runs as an asyncio subprocess (killed if the scan is cancelled), only the WMI lookups need a thread
+        loop = asyncio.get_running_loop()
+        for i in range(10):
+            try:
+                controllers = await loop.run_in_executor(executor, usbdump.get_controllers, await usbdump.run_usbdump_async())
+                break
+            except Exception as e:  # pylint: disable=broad-except
+                if i == 9:
+                    raise
+                shared.debug(e)
+                await asyncio.sleep(0.05 if shared.debugging else 2)
+        return await loop.run_in_executor(executor, self.add_wmi_properties, controllers)
 
     def update_devices(self):
-        self.get_controllers()
+        return self.get_controllers()
 
 
-e = WindowsUSBMap()
+if __name__ == "__main__":
+    WindowsUSBMap.main()
@@ -1,19 +1,22 @@
-import binascii
-import copy
-import json
-import platform
-import plistlib
-import shutil
-import subprocess
+import argparse
+import asyncio
+import contextlib
+import functools
 import textwrap
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from operator import itemgetter
 from pathlib import Path
+from typing import Optional
 
 from termcolor2 import c as color
 
-from Scripts import shared, utils
-
+from engine import KextVariant, USBMapEngine
+from Scripts import scheduler, selection_script, shared, utils, viewport
+from Scripts.metrics import metrics
+from Scripts.screen import screen
+from Scripts.selection import SelectionModel
+from Scripts.tracing import traced, tracer
 
 
 class Colors(Enum):
@@ -23,241 +26,257 @@ class Colors(Enum):
     RESET = "\u001b[0m"
 
 
-def hexswap(input_hex: str):
-    hex_pairs = [input_hex[i : i + 2] for i in range(0, len(input_hex), 2)]
-    hex_rev = hex_pairs[::-1]
-    hex_str = "".join(["".join(x) for x in hex_rev])
-    return hex_str.upper()
-
-
-def read_property(input_value: bytes, places: int):
-    return binascii.b2a_hex(input_value).decode()[:-places]
-
-
-class BaseUSBMap:
-    def __init__(self):
+class BaseUSBMap(USBMapEngine):
+    # The menus on top of the engine
+    def __init__(self, json_path: Optional[Path] = None, settings_path: Optional[Path] = None):
+        # Doesn't start the menu, call monu() for that
         self.utils = utils.Utils(f"USBToolBox {shared.VERSION}".strip())
-        self.controllers = None
-        self.json_path = shared.current_dir / Path("usb.json")
-        self.settings_path = shared.current_dir / Path("settings.json")
+        super().__init__(json_path, settings_path)
 
-        self.settings = (
-            json.load(self.settings_path.open()) if self.settings_path.exists() else {"show_friendly_types": True, "use_native": False, "use_legacy_native": False, "add_comments_to_map": True, "auto_bind_companions": True}
-        )
-        self.controllers_historical = json.load(self.json_path.open("r")) if self.json_path.exists() else None
+    def controller_to_str(self, controller):
+        return f"{controller.name} | {shared.USBControllerTypes(controller.class_)}"
 
-        self.monu()
+    def port_to_str(self, port):
+        if port.type is not None:
+            port_type = shared.USBPhysicalPortTypes(port.type) if self.settings["show_friendly_types"] else shared.USBPhysicalPortTypes(port.type).value
+        elif port.guessed is not None:
+            port_type = (str(shared.USBPhysicalPortTypes(port.guessed)) if self.settings["show_friendly_types"] else str(shared.USBPhysicalPortTypes(port.guessed).value)) + " (guessed)"
+        else:
+            port_type = "Unknown"
 
-    @staticmethod
-    def is_same_controller(controller_1, controller_2):
-        common_keys: set[str] = set(i for i in controller_1["identifiers"] if controller_1["identifiers"][i]) & set(i for i in controller_2["identifiers"] if controller_2["identifiers"][i])
-        if not common_keys:
-            # No way to tell
-            return False
-        for key in common_keys:
-            if key in ["instance_id", "location_id"]:
-                # With Thunderbolt controllers, on hotplugs the instance ID will change, but everything else will be the same.
-                # On macOS, location IDs can change all the time.
-                continue
-            elif len(common_keys) == 1 and key in ["pci_revision"]:
-                # Don't match solely by pci_revision.
-                return False
-            elif key == "location_paths":
-                # Some firmwares have broken ACPI where two or more devices have the same parent and same address, and Windows does not always show all
-                # Evident with Thunderbolt controllers
-                # We will be satisified if they have at least 1 in common
-                if not set(controller_1["identifiers"]["location_paths"]) & set(controller_2["identifiers"]["location_paths"]):
-                    return False
-            else:
-                if not (controller_1["identifiers"][key] is not None and controller_2["identifiers"][key] is not None and controller_1["identifiers"][key] == controller_2["identifiers"][key]):
-                    return False
-        return True
+        return f"{port.name} | {shared.USBDeviceSpeeds(port.class_)} | " + (str(port_type) if self.settings["show_friendly_types"] else f"Type {port_type}")
 
-    @staticmethod
-    def get_controller_from_list(original, controller_list):
-        for controller in controller_list:
-            if BaseUSBMap.is_same_controller(original, controller):
-                return controller
-        return None
+    def controller_lines(self, controllers, colored=False):
+        if not controllers:
+            yield "Empty."
+            return
+        for controller in controllers:
+            yield from self.single_controller_lines(controller, colored)
 
-    @staticmethod
-    def merge_properties(old, new):
-        if not new:
-            return old
-        if not old:
-            return new
-        if isinstance(old, list):
-            retval = list(old)
-            retval.extend(set(new) - set(old))
-            return retval
-        elif isinstance(old, dict):
-            retval = dict(old)
-            for key in new:
-                retval[key] = BaseUSBMap.merge_properties(retval.get(key), new[key])
-            return retval
+    def single_controller_lines(self, controller, colored=False, ports=None):
+        # ports narrows down which ports are shown, ie. to search results
+        if colored:
+            yield color(self.controller_to_str(controller) + f" | {len(controller.ports)} ports")
         else:
-            return new
-
-    @staticmethod
-    def merge_controllers(base: list, new: list):
-        for controller in new:
-            base_controller = BaseUSBMap.get_controller_from_list(controller, base)
-            if not base_controller:
-                base.append(controller)
-                # Don't need to merge properties because there's no base controller
-                continue
+            yield self.controller_to_str(controller) + f" | {len(controller.ports)} ports"
+        historical_controller = self.historical_index.find(controller) if colored else None
+        for port in controller.ports if ports is None else ports:
+            if not colored:
+                yield "  " + self.port_to_str(port)
+            elif port.devices:
+                yield "  " + color(self.port_to_str(port)).green.bold
+            elif historical_controller and historical_controller.get_port(port.index) and historical_controller.get_port(port.index).devices:
+                yield "  " + color(self.port_to_str(port)).cyan.bold
+            else:
+                yield "  " + self.port_to_str(port)
 
-            for key in set(controller.keys()) - set(["ports"]):  # Leave merging ports to merge_ports
-                base_controller[key] = BaseUSBMap.merge_properties(base_controller.get(key), controller[key])
+            if port.comment:
+                yield "  " + port.comment
+            for device in port.devices:
+                yield from self.device_lines(device)
 
-        BaseUSBMap.merge_ports(base, new)
+    def single_controller_line_count(self, controller, ports=None):
+        # Same as len(list(self.single_controller_lines(controller))), without formatting anything
+        return 1 + sum(1 + bool(port.comment) + sum(self.device_line_count(device) for device in port.devices) for port in (controller.ports if ports is None else ports))
 
-    @staticmethod
-    def merge_ports(base: list, new: list):
-        for controller in new:
-            base_controller = BaseUSBMap.get_controller_from_list(controller, base)
-            for port in controller["ports"]:
-                base_port = ([p for p in base_controller["ports"] if p["index"] == port["index"]] or [None])[0]
-                if not base_port:
-                    base_controller["ports"].append(copy.deepcopy(port))
-                    # Don't need to merge properties because there's no base port
+    def controller_sections(self, controllers, colored=False, matches=None):
+        # matches are ids of historical ports (see search_ports), controllers without any are left out
+        sections = []
+        for controller in controllers:
+            ports = None
+            if matches is not None:
+                historical_controller = self.historical_index.find(controller)
+                ports = [port for port in controller.ports if historical_controller and id(historical_controller.get_port(port.index)) in matches]
+                if not ports:
                     continue
-
-                for key in set(port.keys()) - set(["devices"]):  # Leave merging devices to merge_devices
-                    base_port[key] = BaseUSBMap.merge_properties(base_port.get(key), port[key])
-            base_controller["ports"].sort(key=itemgetter("index"))
-        BaseUSBMap.merge_devices(base, new)
+            sections.append(viewport.Section(self.single_controller_line_count(controller, ports), functools.partial(self.single_controller_lines, controller, colored, ports)))
+        return sections
 
     @staticmethod
-    def recursive_merge_devices(base: list, new: list):
-        for i in new:
-            if not i or i in base:
-                continue
-            elif isinstance(i, str):
-                base.append(i)
-            elif i.get("error"):
-                continue
-            elif i["name"] not in [hub.get("name") for hub in base if isinstance(hub, dict)]:
-                base.append(i)
-            else:
-                old_hub = [hub for hub in base if isinstance(hub, dict) and hub.get("name") == i["name"]][0]
-                BaseUSBMap.recursive_merge_devices(old_hub["devices"], i["devices"])
-        for i in list(base):
-            if not i or i.get("error"):
-                base.remove(i)
-
-    @staticmethod
-    def merge_devices(base: list, new: list):
-        for controller in base:
-            new_controller = BaseUSBMap.get_controller_from_list(controller, new)
-            if new_controller:
-                for port in controller["ports"]:
-                    BaseUSBMap.recursive_merge_devices(port["devices"], new_controller["ports"][controller["ports"].index(port)]["devices"])
-
-    def get_controllers(self):
-        raise NotImplementedError
+    def search_status(query, sections):
+        # Shown above the tree while filtering
+        return f'Showing {len(sections)} controllers matching "{query}" (/ to clear)' if sections else f'Nothing matches "{query}" (/ to clear)'
 
-    def update_devices(self):
-        raise NotImplementedError
-
-    def controller_to_str(self, controller):
-        return f"{controller['name']} | {shared.USBControllerTypes(controller['class'])}"
-
-    def port_to_str(self, port):
-        if port["type"] is not None:
-            port_type = shared.USBPhysicalPortTypes(port["type"]) if self.settings["show_friendly_types"] else shared.USBPhysicalPortTypes(port["type"]).value
-        elif port["guessed"] is not None:
-            port_type = (str(shared.USBPhysicalPortTypes(port["guessed"])) if self.settings["show_friendly_types"] else str(shared.USBPhysicalPortTypes(port["guessed"]).value)) + " (guessed)"
+    def device_lines(self, device, indentation="    "):
+        if not device:
+            device = "Enumerating..."
+        if isinstance(device, str):
+            yield f"{indentation}- {device}"
+        elif device.error:
+            yield f"{indentation}- {device.error if isinstance(device.error, str) else 'Device connected to port errored.'} Please unplug or connect a different device."
         else:
-            port_type = "Unknown"
+            yield f"{indentation}- {device.name.strip()} - operating at {shared.USBDeviceSpeeds(device.speed)}"
+            for i in device.devices:
+                yield from self.device_lines(i, indentation + "  ")
 
-        return f"{port['name']} | {shared.USBDeviceSpeeds(port['class'])} | " + (str(port_type) if self.settings["show_friendly_types"] else f"Type {port_type}")
+    def device_line_count(self, device):
+        if not device or isinstance(device, str) or device.error:
+            return 1
+        return 1 + sum(self.device_line_count(i) for i in device.devices)
 
+    @traced()
     def print_controllers(self, controllers, colored=False):
-        if not controllers:
-            print("Empty.")
-            return
-        for controller in controllers:
-            if colored:
-                print(color(self.controller_to_str(controller) + f" | {len(controller['ports'])} ports"))
-            else:
-                print(self.controller_to_str(controller) + f" | {len(controller['ports'])} ports")
-            for port in controller["ports"]:
-                if not colored:
-                    print("  " + self.port_to_str(port))
-                elif port["devices"]:
-                    print("  " + color(self.port_to_str(port)).green.bold)
-                elif (
-                    self.get_controller_from_list(controller, self.controllers_historical)
-                    and [i for i in self.get_controller_from_list(controller, self.controllers_historical)["ports"] if i["index"] == port["index"]][0]["devices"]
-                ):
-                    print("  " + color(self.port_to_str(port)).cyan.bold)
-                else:
-                    print("  " + self.port_to_str(port))
-
-                if port["comment"]:
-                    print("  " + port["comment"])
-                for device in port["devices"]:
-                    self.print_devices(device)
+        print("\n".join(map(str, self.controller_lines(controllers, colored))))
 
     def print_devices(self, device, indentation="    "):
-        if not device:
-            device = "Enumerating..."
-        if isinstance(device, str):
-            print(f"{indentation}- {device}")
-        elif device.get("error", False):
-            print(f"{indentation}- {device['error'] if isinstance(device['error'], str) else 'Device connected to port errored.'} Please unplug or connect a different device.")
-        else:
-            print(f"{indentation}- {device['name'].strip()} - operating at {shared.USBDeviceSpeeds(device['speed'])}")
-            for i in device["devices"]:
-                self.print_devices(i, indentation + "  ")
+        print("\n".join(map(str, self.device_lines(device, indentation))))
 
     def discover_ports(self):
-        self.utils.head("Port Discovery")
-        print()
-        dont_refresh = False
-        if not self.controllers:
-            print("\nGetting controllers...")
-            self.get_controllers()
-            dont_refresh = True
-        while True:
-            # os.system("cls" if os.name == "nt" else "clear")
-            self.utils.head("Port Discovery")
-            print()
-            if dont_refresh:
-                dont_refresh = False
+        asyncio.run(self.discover_ports_async())
+
+    async def enumerate_controllers_async(self, executor=None, devices_only: bool = False):
+        # Backends with something to await (ie. a subprocess) override this. Cancelling stops waiting, the executor thread finishes on its own and its result is dropped.
+        return await asyncio.get_running_loop().run_in_executor(executor, self.enumerate_controllers, devices_only)
+
+    async def discover_ports_async(self):
+        # Enumerating runs as a background task, so typed input is handled (and B cancels a slow scan) without waiting for it
+        events = self.event_source()
+        poll_scheduler = scheduler.PollScheduler.from_settings(self.settings)
+        console = utils.ConsoleReader().start()
+        # One thread, so scans never overlap and backends needing per-thread state (WMI) set it up once
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="enumerate")
+        port_view = viewport.Viewport()
+        query = None
+        show_metrics = False
+        # Counters from the last enumeration only
+        last_scan: dict = {}
+        # A save deferred by the debounce is written once it runs out, even if nothing changes after it
+        trailing_flush: Optional[asyncio.TimerHandle] = None
+
+        def flush():
+            nonlocal trailing_flush
+            trailing_flush = None
+            self.dump_historical(force=True)
+
+        def schedule_flush():
+            nonlocal trailing_flush
+            delay = self.historical_store.flush_due()
+            if delay is not None and trailing_flush is None:
+                trailing_flush = asyncio.get_running_loop().call_later(delay, flush)
+
+        @traced("discover_ports.draw")
+        def draw():
+            lines = utils.header_lines("Port Discovery") + [""]
+            if not self.controllers:
+                lines += ["", "Getting controllers..."]
             else:
-                self.update_devices()
-
-            self.print_controllers(self.controllers, colored=True)
+                sections = self.controller_sections(self.controllers, colored=True, matches=self.search_ports(query) if query else None)
+                if query:
+                    lines += [self.search_status(query, sections), ""]
+                # Header, status, back and prompt, plus the debug lines
+                lines += port_view.render(sections, port_view.fit(11 + (2 if query else 0) + (3 if show_metrics else 0) + (6 if shared.debugging else 0)))
+                if port_view.status():
+                    lines.append(port_view.status())
+            if shared.debugging:
+                lines += [
+                    "",
+                    f"Snapshot digests: {self.snapshot_digest.hits} unchanged, {self.snapshot_digest.misses} changed, {self.snapshot_digest.changed_ports} ports changed last time",
+                    f"usb.json: {self.historical_store.stats()}",
+                    f"Events: {type(events).__name__}, {events.events} so far",
+                    f"Screen: {screen.full_redraws} full, {screen.partial_redraws} partial redraws",
+                    f"Last debug message: {shared.debug_log[-1] if shared.debug_log else 'none'}",
+                ]
+            if show_metrics:
+                lines += [""] + self.metrics_lines(last_scan)
+            lines += ["", "B.  Back", "/.  Search devices and ports (eg. /keyboard, /VID_046D)", f"M.  {'Hide' if show_metrics else 'Show'} timings", ""]
+            if not poll_scheduler.costs:
+                prompt = "Scanning: "
+            elif events.push:
+                prompt = f"Waiting for changes (last scan {poll_scheduler.last_cost * 1000:.0f} ms): "
+            else:
+                prompt = f"Polling, {poll_scheduler.describe()}: "
+            screen.render(lines, prompt)
+
+        async def scan():
+            first = True
+            while True:
+                if not first:
+                    await events.wait_async(events.timeout if events.push else poll_scheduler.interval)
+                events.take()
+                checkpoint = metrics.checkpoint()
+                start = time.perf_counter()
+                with tracer.span("enumerate_controllers_async"):
+                    # Everything on the first scan, like get_controllers used to be, then devices
+                    controllers = await self.enumerate_controllers_async(executor, devices_only=not first)
+                metrics.add_time("enumerate", time.perf_counter() - start)
+                changed = self.apply_controllers(controllers)
+                poll_scheduler.record(time.perf_counter() - start, changed)
+                metrics.count("enumerations")
+                last_scan.clear()
+                last_scan.update(metrics.since(checkpoint))
+                if changed or first:
+                    first = False
+                    self.dump_historical()
+                    schedule_flush()
+                    draw()
+                elif show_metrics:
+                    draw()
+
+        shared.debug_on_screen = True
+        draw()
+        scanning = asyncio.create_task(scan())
+        try:
+            while True:
+                line = asyncio.create_task(console.lines.get())
+                await asyncio.wait({line, scanning}, return_when=asyncio.FIRST_COMPLETED)
+                if scanning.done():
+                    line.cancel()
+                    # Backend errors end discovery like they used to
+                    scanning.result()
+                output = line.result()
+                if output is None or output.lower() == "b":
+                    break
+                if output.startswith("/"):
+                    query = output[1:].strip() or None
+                    port_view.top = 0
+                elif output.lower() == "m":
+                    show_metrics = not show_metrics
+                else:
+                    port_view.handle(output)
+                draw()
+        finally:
+            if trailing_flush:
+                trailing_flush.cancel()
+            scanning.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await scanning
+            console.close()
+            events.close()
+            executor.shutdown(wait=False, cancel_futures=True)
+            shared.debug_on_screen = False
+        print()
+        self.dump_historical(force=True)
 
-            self.dump_historical()
-            print("\nB.  Back\n")
-            do_quit = self.utils.grab("Waiting 5 seconds: ", timeout=5)
-            if str(do_quit).lower() == "b":
-                break
+    @staticmethod
+    def metrics_lines(last_scan: dict):
+        # Where the time of the last scan went, for the discovery screen
+        timings = []
+        for name, label in [
+            ("enumerate", "scan"),
+            ("usbdump.run", "usbdump"),
+            ("usbdump.parse", "JSON"),
+            ("usbdump.convert", "convert"),
+            ("snapshot_digest", "digest"),
+            ("merge", "merge"),
+            ("persistence.save", "save"),
+            ("render", "render"),
+        ]:
+            last = metrics.last(name)
+            if last is not None:
+                timings.append(f"{label} {last * 1000:.1f} ms")
+        counters = []
+        lookups = last_scan.get("wmi.lookups", 0)
+        if lookups:
+            hits = last_scan.get("wmi.cache_hits", 0)
+            given_up = last_scan.get("wmi.retries_exhausted", 0)
+            counters.append(f"WMI {lookups - hits - given_up} queries ({hits / lookups:.0%} of {lookups} lookups cached{f', {given_up} given up' if given_up else ''})")
+        if "iokit.calls" in last_scan:
+            counters.append(f"IOKit {last_scan['iokit.calls']} calls")
+        return ["Last: " + (", ".join(timings) or "nothing yet"), "Last scan: " + (", ".join(counters) or "no backend calls counted")]
 
     def print_historical(self):
         utils.TUIMenu("Print Historical (DEBUG)", "Select an option: ", in_between=lambda: self.print_controllers(self.controllers_historical), loop=True).start()
 
-    def dump_historical(self):
-        if self.controllers_historical:
-            json.dump(self.controllers_historical, self.json_path.open("w"), indent=4, sort_keys=True)
-        elif self.controllers_historical == []:
-            self.remove_historical()
-
-    def remove_historical(self):
-        if self.controllers_historical or self.controllers_historical == []:
-            self.controllers = None
-            self.controllers_historical = None
-            self.json_path.unlink()
-
-    def dump_settings(self):
-        json.dump(self.settings, self.settings_path.open("w"), indent=4, sort_keys=True)
-
-    def on_quit(self):
-        self.dump_historical()
-
     def print_types(self):
         in_between = [f"{i}: {i.value}" for i in shared.USBPhysicalPortTypes] + [
             "",
@@ -271,80 +290,64 @@ class BaseUSBMap:
         ]
         utils.TUIMenu("USB Types", "Select an option: ", in_between=in_between).start()
 
-    def get_companion_port(self, port):
-        if not port.get("companion_info"):
-            return None
-        companion_info = port["companion_info"]
-        if not companion_info["hub"] or not companion_info["port"]:
-            return None
-        hub = [i for i in self.controllers_historical if i.get("hub_name") == companion_info["hub"]]
-        if hub:
-            port = [i for i in hub[0]["ports"] if i["index"] == companion_info["port"]]
-            if port:
-                return port[0]
-        return None
-
+    @traced()
     def select_ports(self):
         if not self.controllers_historical:
             utils.TUIMenu("Select Ports and Build Kext", "Select an option: ", in_between=["No ports! Use the discovery mode."], loop=True).start()
             return
 
-        selection_index = 1
-        by_port = []
-        for controller in self.controllers_historical:
-            controller["selected_count"] = 0
-            for port in controller["ports"]:
-                if "selected" not in port:
-                    port["selected"] = bool(port["devices"])
-                    port["selected"] = port["selected"] or (bool(self.get_companion_port(port)["devices"]) if self.get_companion_port(port) else False)
-                controller["selected_count"] += 1 if port["selected"] else 0
-                port["selection_index"] = selection_index
-                selection_index += 1
-                by_port.append(port)
+        selection = SelectionModel(self.controllers_historical, self.historical_index.companions, self.settings["auto_bind_companions"])
+        # One past the highest selection number, for padding
+        selection_index = len(selection.by_port) + 1
+        # Rendered lines per port, only redone for ports that changed
+        port_lines = {}
+
+        def record_selection_changes():
+            for port in self.record_selection(selection, self.historical_store):
+                port_lines.pop(id(port), None)
+                self.historical_index.update_port(port)
+
+        def render_port(port):
+            prefix = f"[{'#' if port.selected else ' '}]  {port.selection_index}.{(len(str(selection_index)) - len(str(port.selection_index)) + 1) * ' ' }"
+            port_info = prefix + self.port_to_str(port)
+            companion = selection.companion(port)
+            if companion:
+                port_info += f" | Companion to {companion.selection_index}"
+            lines = [color(port_info).green.bold if port.selected else port_info]
+            if port.comment:
+                lines.append(len(prefix) * " " + color(port.comment).blue.bold)
+            return lines
+
+        def controller_lines(controller, ports):
+            port_count_str = f"{controller.selected_count}/{len(controller.ports)}"
+            port_count_str = color(port_count_str).red if id(controller) in selection.over_limit else color(port_count_str).green
+            yield self.controller_to_str(controller) + f" | {port_count_str} ports"
+            for port in ports:
+                if id(port) not in port_lines:
+                    port_lines[id(port)] = render_port(port)
+                yield from port_lines[id(port)]
+                for device in port.devices:
+                    yield from self.device_lines(device, indentation="      " + len(str(selection_index)) * " " * 2)
+            yield ""
+
+        def controller_line_count(ports):
+            return 2 + sum(1 + bool(port.comment) + sum(self.device_line_count(device) for device in port.devices) for port in ports)
+
+        port_view = viewport.Viewport()
+        query = None
 
         while True:
+            record_selection_changes()
             self.dump_historical()
-            for controller in self.controllers_historical:
-                controller["selected_count"] = sum(1 if port["selected"] else 0 for port in controller["ports"])
 
-            utils.header("Select Ports and Build Kext")
-            print()
-            for controller in self.controllers_historical:
-                port_count_str = f"{controller['selected_count']}/{len(controller['ports'])}"
-                port_count_str = color(port_count_str).red if controller["selected_count"] > 15 else color(port_count_str).green
-                print(self.controller_to_str(controller) + f" | {port_count_str} ports")
-                for port in controller["ports"]:
-                    port_info = f"[{'#' if port['selected'] else ' '}]  {port['selection_index']}.{(len(str(selection_index)) - len(str(port['selection_index'])) + 1) * ' ' }" + self.port_to_str(port)
-                    companion = self.get_companion_port(port)
-                    if companion:
-                        port_info += f" | Companion to {companion['selection_index']}"
-                    if port["selected"]:
-                        print(color(port_info).green.bold)
-                    else:
-                        print(port_info)
-                    if port["comment"]:
-                        print(
-                            len(f"[{'#' if port['selected'] else ' '}]  {port['selection_index']}.{(len(str(selection_index)) - len(str(port['selection_index'])) + 1) * ' ' }") * " "
-                            + color(port["comment"]).blue.bold
-                        )
-                    for device in port["devices"]:
-                        self.print_devices(device, indentation="      " + len(str(selection_index)) * " " * 2)
-                print()
-
-            print(f"Binding companions is currently {color('on').green if self.settings['auto_bind_companions'] else color('off').red}.\n")
-
-            output_kext = None
-            if self.settings["use_native"] and self.settings["use_legacy_native"]:
-                output_kext = "USBMapLegacy.kext"
-            elif self.settings["use_native"]:
-                output_kext = "USBMap.kext"
-            else:
-                output_kext = "UTBMap.kext (requires USBToolBox.kext)"
+            variant = self.variant()
+            output_kext = variant.kext_name if variant.native else f"{variant.kext_name} (requires USBToolBox.kext)"
 
-            print(
+            footer = [f"Binding companions is currently {color('on').green if self.settings['auto_bind_companions'] else color('off').red}.", ""] + (
                 textwrap.dedent(
                     f"""\
                 K. Build {output_kext}
+                V. Build UTBMap.kext, USBMap.kext and USBMapLegacy.kext
                 A. Select All
                 N. Select None
                 P. Enable All Populated Ports
@@ -353,102 +356,62 @@ class BaseUSBMap:
 
                 B. Back
 
-                - Select ports to toggle with comma-delimited lists (eg. 1,2,3,4,5)
+                - Select ports to toggle with comma-delimited lists (eg. 1,2,3,4,5) or ranges (eg. 1-5,8)
+                - Use +ports to select and -ports to deselect instead of toggling (eg. -1-40)
+                - Instead of numbers, use populated, empty, speed=SS, controller=2 or type=unknown, join with & (eg. controller=2&populated)
                 - Change types using this formula T:1,2,3,4,5:t where t is the type
-                - Set custom names using this formula C:1:Name - Name = None to clear"""
+                - Set custom names using this formula C:1:Name - Name = None to clear
+                - Separate multiple commands with ; (eg. N;+populated;T:populated&type=unknown:3)
+                - Use [ and ] to page through ports, < and > to jump between controllers
+                - Use /text to only show ports with matching devices, names, comments or numbers (eg. /keyboard, /VID_046D), / to show all again"""
                 )
+                .splitlines()
             )
 
-            output = input("Select an option: ")
+            lines = utils.header_lines("Select Ports and Build Kext") + [""]
+            matches = self.search_ports(query) if query else None
+            sections = []
+            for controller in self.controllers_historical:
+                ports = controller.ports if matches is None else [port for port in controller.ports if id(port) in matches]
+                if ports or matches is None:
+                    sections.append(viewport.Section(controller_line_count(ports), functools.partial(controller_lines, controller, ports)))
+            if query:
+                lines += [self.search_status(query, sections), ""]
+            lines += port_view.render(sections, port_view.fit(len(lines) + len(footer) + 3, minimum=10))
+            if port_view.status():
+                lines += [port_view.status(), ""]
+            screen.render(lines + footer, "Select an option: ")
+            output = input()
             if not output:
                 continue
+            elif port_view.handle(output):
+                continue
+            elif output.startswith("/"):
+                query = output[1:].strip() or None
+                port_view.top = 0
+                continue
             elif output.upper() == "B":
+                record_selection_changes()
+                self.dump_historical(force=True)
                 break
             elif output.upper() == "K":
-                if not self.validate_selections():
+                if not self.validate_selections(selection):
                     continue
                 self.build_kext()
                 continue
-            elif output.upper() in ("N", "A"):
-                for port in by_port:
-                    port["selected"] = output.upper() == "A"
-            elif output.upper() == "P":
-                for port in by_port:
-                    if port["devices"] or (self.get_companion_port(port)["devices"] if self.get_companion_port(port) else False):
-                        port["selected"] = True
-            elif output.upper() == "D":
-                for port in by_port:
-                    if not port["devices"] and not (self.get_companion_port(port)["devices"] if self.get_companion_port(port) else False):
-                        port["selected"] = False
+            elif output.upper() == "V":
+                if not self.validate_selections(selection):
+                    continue
+                self.build_kext(list(KextVariant))
+                continue
             elif output.upper() == "T":
                 self.print_types()
                 continue
-            elif output[0].upper() == "T":
-                # We should have a type
-                if len(output.split(":")) != 3:
-                    continue
-                try:
-                    port_nums, port_type = output.split(":")[1:]
-                    port_nums = port_nums.replace(" ", "").split(",")
-                    port_type = shared.USBPhysicalPortTypes(int(port_type))
-
-                    for port_num in list(port_nums):
-                        if port_num not in port_nums:
-                            continue
-
-                        port_num = int(port_num) - 1
-
-                        if port_num not in range(len(by_port)):
-                            continue
-
-                        companion = self.get_companion_port(by_port[port_num])
-                        if self.settings["auto_bind_companions"] and companion:
-                            companion["type"] = port_type
-                            if str(companion["selection_index"]) in port_nums:
-                                port_nums.remove(str(companion["selection_index"]))
-                        by_port[port_num]["type"] = port_type
-                except ValueError:
-                    continue
-            elif output[0].upper() == "C":
-                # We should have a new name
-                if len(output.split(":")) < 2:
-                    continue
-                try:
-                    port_nums = output.split(":")[1].replace(" ", "").split(",")
-                    port_comment = output.split(":", 2)[2:]
-
-                    for port_num in list(port_nums):
-                        if port_num not in port_nums:
-                            continue
-
-                        port_num = int(port_num) - 1
-
-                        if port_num not in range(len(by_port)):
-                            continue
-
-                        by_port[port_num]["comment"] = port_comment[0] if port_comment else None
-                except ValueError:
-                    continue
             else:
+                # Everything else is a selection script (see Scripts/selection_script.py)
                 try:
-                    port_nums = output.replace(" ", "").split(",")
-
-                    for port_num in list(port_nums):
-                        if port_num not in port_nums:
-                            continue
-
-                        port_num = int(port_num) - 1
-
-                        if port_num not in range(len(by_port)):
-                            continue
-
-                        companion = self.get_companion_port(by_port[port_num])
-                        if self.settings["auto_bind_companions"] and companion:
-                            companion["selected"] = not by_port[port_num]["selected"]
-                            if str(companion["selection_index"]) in port_nums:
-                                port_nums.remove(str(companion["selection_index"]))
-                        by_port[port_num]["selected"] = not by_port[port_num]["selected"]
-                except ValueError:
+                    selection_script.run(selection_script.parse(output, comments=False), selection)
+                except selection_script.ScriptError:
                     continue
 
     def print_errors(self, errors):
@@ -457,65 +420,20 @@ class BaseUSBMap:
         utils.TUIMenu("Selection Validation", "Select an option: ", in_between=errors, loop=True).start()
         return False
 
-    def validate_selections(self):
-        errors = []
-        if not any(any(p["selected"] for p in c["ports"]) for c in self.controllers_historical):
-            utils.TUIMenu("Selection Validation", "Select an option: ", in_between=["No ports are selected! Select some ports."], loop=True).start()
-            return False
-
-        for controller in self.controllers_historical:
-            for port in controller["ports"]:
-                if not port["selected"]:
-                    continue
-                if port["type"] is None and port["guessed"] is None:
-                    errors.append(f"Port {port['selection_index']} is missing a connector type!")
-
-        return self.print_errors(errors)
-
-    def check_unique(self, identifier, predicate, controller):
-        if predicate(controller):
-            values = [identifier(c) for c in self.controllers_historical if predicate(c)]
-            return values.count(identifier(controller)) == 1
-        else:
-            return False
-
-    def choose_matching_key(self, controller):
-        if "bus_number" in controller["identifiers"]:
-            # M1 Macs
-            return {"IOPropertyMatch": {"bus-number": binascii.a2b_hex(hexswap(hex(controller["identifiers"]["bus_number"])[2:].zfill(8)))}}
-
-        elif not self.settings["use_native"] and self.check_unique(lambda c: c["identifiers"]["acpi_path"].rpartition(".")[2], lambda c: "acpi_path" in c["identifiers"], controller):
-            # Unique ACPI name
-            # Disable if using native because we don't know if it'll conflict
-            # TODO: Check this maybe?
-            shared.debug(f"Using ACPI path: {controller['identifiers']['acpi_path']}")
-            return {"IONameMatch": controller["identifiers"]["acpi_path"].rpartition(".")[2]}
+    def validate_selections(self, selection: SelectionModel):
+        return self.print_errors(self.selection_errors(selection))
 
-        elif "bdf" in controller["identifiers"]:
-            # Use bus-device-function
-            return {"IOPropertyMatch": {"pcidebug": ":".join([str(i) for i in controller["identifiers"]["bdf"]])}}
-
-        elif self.check_unique(lambda c: c["identifiers"]["path"], lambda c: "path" in c["identifiers"], controller):
-            # Use IORegistry path
-            return {"IOPathMatch": controller["identifiers"]["path"]}
-
-        elif self.check_unique(lambda c: c["identifiers"]["pci_id"], lambda c: "pci_id" in c["identifiers"], controller):
-            # Use PCI ID
-            pci_id: list[str] = controller["identifiers"]["pci_id"]
-            return {"IOPCIPrimaryMatch": f"0x{pci_id[1]}{pci_id[0]}"} | ({"IOPCISecondaryMatch": f"0x{pci_id[3]}{pci_id[2]}"} if len(pci_id) > 2 else {})
-
-        else:
-            raise RuntimeError("No matching key available")
-
-    def build_kext(self):
-        empty_controllers = [c for c in self.controllers_historical if not any(p["selected"] for p in c["ports"])]
+    @traced()
+    def build_kext(self, variants=None):
+        # Builds the variant from the settings by default
+        empty_controllers = self.empty_controllers()
         response = None
         if empty_controllers:
             empty_menu = utils.TUIMenu(
                 "Selection Validation",
                 "Select an option: ",
                 in_between=["The following controllers have no enabled ports:", ""]
-                + [controller["name"] for controller in empty_controllers]
+                + [controller.name for controller in empty_controllers]
                 + ["Select whether to ignore these controllers and exclude them from the map, or disable all ports on these controllers."],
                 add_quit=False,
                 return_number=True,
@@ -524,13 +442,11 @@ class BaseUSBMap:
             empty_menu.add_menu_option("Disable", key="D")
             response = empty_menu.start()
 
+        variants = variants or [self.variant()]
         model_identifier = None
-        if self.settings["use_native"]:
-            if platform.system() == "Darwin":
-                model_identifier = plistlib.loads(subprocess.run("system_profiler -detailLevel mini -xml SPHardwareDataType".split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.strip())[
-                    0
-                ]["_items"][0]["machine_model"]
-            else:
+        if any(variant.native for variant in variants):
+            model_identifier = self.detect_model_identifier()
+            if model_identifier is None:
                 model_menu = utils.TUIOnlyPrint(
                     "Enter Model Identifier",
                     "Enter the model identifier: ",
@@ -541,103 +457,22 @@ class BaseUSBMap:
                 ).start()
                 model_identifier = model_menu.strip()
 
-        ignore = response == "I"
-
-        template = plistlib.load((shared.resource_dir / Path("Info.plist")).open("rb"))
-
         menu = utils.TUIMenu("Building USBMap", "Select an option: ")
         menu.head()
         print("Generating Info.plist...")
-        for controller in self.controllers_historical:
-            if not any(i["selected"] for i in controller["ports"]) and ignore:
-                continue
-
-            # FIXME: ensure unique
-            if controller["identifiers"].get("acpi_path"):
-                if self.check_unique(lambda c: c["identifiers"]["acpi_path"].rpartition(".")[2], lambda c: "acpi_path" in c["identifiers"], controller):
-                    personality_name: str = controller["identifiers"]["acpi_path"].rpartition(".")[2]
-                else:
-                    personality_name: str = controller["identifiers"]["acpi_path"][1:]  # Strip leading \
-            elif controller["identifiers"].get("bdf"):
-                personality_name: str = ":".join([str(i) for i in controller["identifiers"]["bdf"]])
-            else:
-                personality_name: str = controller["name"]
-
-            if self.settings["use_native"]:
-                personality = {
-                    "CFBundleIdentifier": "com.apple.driver." + ("AppleUSBMergeNub" if self.settings["use_legacy_native"] else "AppleUSBHostMergeProperties"),
-                    "IOClass": ("AppleUSBMergeNub" if self.settings["use_legacy_native"] else "AppleUSBHostMergeProperties"),
-                    "IOProviderClass": "AppleUSBHostController",
-                    "IOParentMatch": self.choose_matching_key(controller),
-                    "model": model_identifier,
-                }
-
-            else:
-                personality = {
-                    "CFBundleIdentifier": "com.dhinakg.USBToolBox.kext",
-                    "IOClass": "USBToolBox",
-                    "IOProviderClass": "IOPCIDevice",
-                    "IOMatchCategory": "USBToolBox",
-                } | self.choose_matching_key(
-                    controller
-                )  # type: ignore
-
-            personality["IOProviderMergeProperties"] = {"ports": {}, "port-count": None}
-
-            port_name_index = {}
-            highest_index = 0
-
-            for port in controller["ports"]:
-                if not port["selected"]:
-                    continue
+        templates = self.generate_plists(variants, model_identifier, ignore_empty=response == "I")
 
-                if port["index"] > highest_index:
-                    highest_index = port["index"]
-
-                if controller["class"] == shared.USBControllerTypes.XHCI and port["class"] == shared.USBDeviceSpeeds.SuperSpeed:
-                    prefix = "SS"
-                elif controller["class"] == shared.USBControllerTypes.XHCI and port["class"] == shared.USBDeviceSpeeds.HighSpeed:
-                    prefix = "HS"
-                else:
-                    prefix = "PRT"
-
-                port_index = port_name_index.setdefault(prefix, 1)
-                port_name = prefix + str(port_index).zfill(4 - len(prefix))
-                port_name_index[prefix] += 1
-
-                personality["IOProviderMergeProperties"]["ports"][port_name] = {
-                    "port": binascii.a2b_hex(hexswap(hex(port["index"])[2:].zfill(8))),
-                    "UsbConnector": port["type"] or port["guessed"],
-                }
-
-                if self.settings["add_comments_to_map"] and port["comment"]:
-                    personality["IOProviderMergeProperties"]["ports"][port_name]["#comment"] = port["comment"]
-
-            personality["IOProviderMergeProperties"]["port-count"] = binascii.a2b_hex(hexswap(hex(highest_index)[2:].zfill(8)))
-
-            template["IOKitPersonalities"][personality_name] = personality
-
-        if not self.settings["use_native"]:
-            template["OSBundleLibraries"] = {"com.dhinakg.USBToolBox.kext": "1.0.0"}
-
-        output_kext = None
-        if self.settings["use_native"] and self.settings["use_legacy_native"]:
-            output_kext = "USBMapLegacy.kext"
-        elif self.settings["use_native"]:
-            output_kext = "USBMap.kext"
-        else:
-            output_kext = "UTBMap.kext"
-
-        write_path = shared.current_dir / Path(output_kext)
-
-        if write_path.exists():
-            print("Removing existing kext...")
-            shutil.rmtree(write_path)
-
-        print("Writing kext and Info.plist...")
-        (write_path / Path("Contents")).mkdir(parents=True)
-        plistlib.dump(template, (write_path / Path("Contents/Info.plist")).open("wb"), sort_keys=True)
-        print(f"Done. Saved to {write_path.resolve()}.\n")
+        for variant, template in templates.items():
+            print(f"Writing {variant.kext_name}...")
+            result = self.write_kext(template, variant)
+            if not result.written:
+                print(f"Unchanged, left {result.path.resolve()} as is.")
+                continue
+            for label, names in [("Added", result.added), ("Removed", result.removed), ("Changed", result.changed)]:
+                if names:
+                    print(f"  {label}: {', '.join(names)}")
+            print(f"Done. Saved to {result.path.resolve()}.")
+        print()
         menu.print_options()
 
         menu.select()
@@ -664,6 +499,7 @@ class BaseUSBMap:
             ["N", *combination("Use Native Classes", "use_native"), ["Use native Apple classes (AppleUSBHostMergeProperties) instead of the USBToolBox kext."]],
             ["L", *combination("Use Legacy Native Classes (requires Use Native Classes)", "use_legacy_native"), ["Use AppleUSBMergeNub instead of AppleUSBHostMergeProperties, for legacy macOS."]],
             ["A", *combination("Add Comments to Map", "add_comments_to_map"), ["Add port comments inside the map."]],
+            ["J", *combination("Journal Saved Data", "use_journal"), ["Append changes to usb.journal instead of rewriting usb.json every time. Faster with large usb.json files."]],
             [
                 "C",
                 *combination("Bind Companions", "auto_bind_companions"),
@@ -674,6 +510,20 @@ class BaseUSBMap:
 
         menu.start()
         self.dump_settings()
+        self.historical_store.set_journal(self.settings["use_journal"])
+
+    @classmethod
+    def main(cls, argv=None):
+        # Entry point of Windows.py and macOS.py
+        parser = argparse.ArgumentParser(description=f"USBToolBox {shared.VERSION}".strip())
+        parser.add_argument("--metrics-json", help="Write counters and timings of every enumeration phase to this file on exit")
+        parser.add_argument("--trace", help="Record a Chrome trace (Perfetto, about:tracing) of the session to this file, same as USBTOOLBOX_TRACE")
+        args = parser.parse_args(argv)
+        if args.metrics_json:
+            metrics.dump_at_exit(Path(args.metrics_json))
+        if args.trace:
+            tracer.start(Path(args.trace))
+        cls().monu()
 
     def monu(self):
         response = None
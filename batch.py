@@ -0,0 +1,118 @@
+# Builds kexts for many usb.json files at once (ie. collected from a fleet), see `cli.py batch`
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import engine
+from Scripts.selection import SelectionModel
+
+
+class BatchInput(NamedTuple):
+    path: Path
+    # Output folder, relative to the batch output directory
+    name: str
+    model_identifier: Optional[str] = None
+
+
+class BatchOptions(NamedTuple):
+    variants: tuple
+    model_identifier: Optional[str] = None
+    ignore_empty: bool = False
+    add_comments: Optional[bool] = None
+    settings_path: Optional[Path] = None
+
+
+def _unique_names(inputs: list[BatchInput]):
+    # Two inputs with the same name get -2, -3... like personality names
+    taken = set()
+    unique = []
+    for i in inputs:
+        name = i.name
+        suffix = 2
+        while name in taken:
+            name = f"{i.name}-{suffix}"
+            suffix += 1
+        taken.add(name)
+        unique.append(i._replace(name=name))
+    return unique
+
+
+def find_inputs(directory: Path):
+    # Every *.json below the directory except settings, named after its path without the suffix (fleet/host1/usb.json -> host1/usb)
+    paths = sorted(i for i in directory.rglob("*.json") if i.name != "settings.json")
+    return _unique_names([BatchInput(i, i.relative_to(directory).with_suffix("").as_posix()) for i in paths])
+
+
+def read_manifest(manifest: Path):
+    # One usb.json per line, optionally followed by the model identifier to use for native variants. Relative paths are relative to the manifest.
+    inputs = []
+    for line in manifest.read_text().splitlines():
+        line = line.partition("#")[0].strip()
+        if not line:
+            continue
+        path, _, model_identifier = line.partition(" ")
+        path = manifest.parent / Path(path)
+        inputs.append(BatchInput(path, path.stem if path.stem != "usb" else path.parent.name or path.stem, model_identifier.strip() or None))
+    return _unique_names(inputs)
+
+
+def build_one(batch_input: BatchInput, output_dir: Path, options: BatchOptions):
+    # Never raises, so one bad input doesn't stop the others
+    start = time.perf_counter()
+    result = {"input": str(batch_input.path), "output": str(output_dir / Path(batch_input.name)), "kexts": [], "error": None}
+    try:
+        usbmap = engine.USBMapEngine(batch_input.path, options.settings_path)
+        if not usbmap.controllers_historical:
+            raise ValueError("No ports")
+        if options.add_comments is not None:
+            usbmap.settings["add_comments_to_map"] = options.add_comments
+
+        # Default selections for ports never shown in Select Ports, like cli.py build
+        selection = SelectionModel(usbmap.controllers_historical, usbmap.historical_index.companions, usbmap.settings["auto_bind_companions"])
+        errors = usbmap.selection_errors(selection)
+        if errors:
+            raise ValueError(" ".join(errors))
+
+        model_identifier = batch_input.model_identifier or options.model_identifier
+        for variant in options.variants:
+            if variant.native and not model_identifier:
+                raise ValueError(f"{variant.kext_name} needs a model identifier")
+        for variant, template in usbmap.generate_plists(options.variants, model_identifier, options.ignore_empty).items():
+            written = usbmap.write_kext(template, variant, output_dir / Path(batch_input.name))
+            result["kexts"].append({"path": str(written.path), "sha256": written.digest, "written": written.written, "added": written.added, "removed": written.removed, "changed": written.changed})
+    except Exception as e:  # pylint: disable=broad-except
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def _build_one(args):
+    return build_one(*args)
+
+
+def build_all(inputs: list[BatchInput], output_dir: Path, options: BatchOptions, jobs: Optional[int] = None):
+    # Returns (results in input order, summary)
+    jobs = jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    work = [(i, output_dir, options) for i in inputs]
+    if jobs == 1 or len(inputs) < 2:
+        results = [_build_one(i) for i in work]
+    else:
+        # The template is read here once and handed to every worker with the pool, instead of being read from resources/ per build
+        with ProcessPoolExecutor(max_workers=jobs, initializer=engine.share_template, initargs=(engine.load_template(),)) as executor:
+            results = list(executor.map(_build_one, work, chunksize=max(1, len(work) // (jobs * 4))))
+    seconds = time.perf_counter() - start
+
+    failed = [i for i in results if i["error"]]
+    return results, {
+        "inputs": len(inputs),
+        "built": len(inputs) - len(failed),
+        "failed": len(failed),
+        "kexts": sum(len(i["kexts"]) for i in results),
+        "unchanged": sum(1 for i in results for kext in i["kexts"] if not kext["written"]),
+        "jobs": jobs,
+        "seconds": round(seconds, 3),
+        "maps_per_second": round(len(inputs) / seconds, 1) if seconds else None,
+    }
@@ -0,0 +1,42 @@
+# Merging a fresh snapshot into an equally sized history, with ControllerIndex against the first-match linear scan it replaced.
+#   python benchmarks/merge_index.py [controller counts...]
+import contextlib
+import sys
+import time
+
+import synthetic
+from engine import USBMapEngine
+from Scripts import model, topology
+
+
+@contextlib.contextmanager
+def linear_find():
+    # Every lookup walks the whole list, like get_controller_from_list
+    find = topology.ControllerIndex.find
+    topology.ControllerIndex.find = lambda self, original: USBMapEngine.get_controller_from_list(original, self.controllers)
+    try:
+        yield
+    finally:
+        topology.ControllerIndex.find = find
+
+
+def time_merge(count: int):
+    history = model.controllers_from_dict(synthetic.controllers(count))
+    snapshot = model.controllers_from_dict(synthetic.controllers(count))
+    start = time.perf_counter()
+    USBMapEngine.merge_controllers(history, snapshot)
+    return time.perf_counter() - start
+
+
+def main():
+    counts = [int(i) for i in sys.argv[1:]] or [10, 100, 1000]
+    print(f"{'controllers':>11}  {'linear':>10}  {'indexed':>10}  speedup")
+    for count in counts:
+        with linear_find():
+            linear = time_merge(count)
+        indexed = time_merge(count)
+        print(f"{count:>11}  {linear * 1000:>8.1f}ms  {indexed * 1000:>8.1f}ms  {linear / indexed:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
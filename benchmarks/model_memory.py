@@ -0,0 +1,33 @@
+# Memory held by historical data loaded from usb.json, as the plain dicts json.loads gives against the slotted model classes.
+#   python benchmarks/model_memory.py [controllers] [ports per controller]
+import json
+import sys
+import tracemalloc
+
+import synthetic
+from Scripts import model
+
+
+def measure(load, data: str):
+    # Once untraced first, so one-off allocations (ie. growing the interned string table) aren't counted
+    load(data)
+    tracemalloc.start()
+    controllers = load(data)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del controllers
+    return used
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    ports = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    data = json.dumps(synthetic.controllers(count, ports))
+    print(f"{count} controllers x {ports} ports")
+    for name, load in [("dicts", json.loads), ("objects", lambda data: model.controllers_from_dict(json.loads(data)))]:
+        used = measure(load, data)
+        print(f"{name:>8}: {used / 1e6:.2f} MB, {used / (count * ports):.0f} bytes/port")
+
+
+if __name__ == "__main__":
+    main()
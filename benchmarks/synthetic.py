@@ -0,0 +1,46 @@
+# Synthetic usb.json data for the benchmarks: n controllers with `ports` ports each, every third port with a device on it
+import random
+import sys
+from pathlib import Path
+
+# Scripts is imported as a top level package, like when running Windows.py/macOS.py from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def controller(number: int, ports: int = 8, rng: random.Random = random.Random(0)):
+    data = {
+        "name": f"Controller {number}",
+        "identifiers": {
+            "instance_id": f"PCI\\VEN_8086&DEV_{number:04X}\\{rng.random()}",
+            "pci_id": {"vendor": "8086", "device": f"{number:04x}"},
+            "acpi_path": f"\\_SB.PCI0.X{number:03d}",
+            "bdf": [0, number % 32, number // 32],
+            "location_paths": [f"PCIROOT(0)#PCI({number:04X})"],
+        },
+        "class": 48,
+        "hub_name": f"hub{number}",
+        "port_count": ports,
+        "ports": [],
+    }
+    for index in range(1, ports + 1):
+        port = {
+            "index": index,
+            "name": f"Port {index}",
+            "comment": None,
+            "class": 3 if index % 2 else 2,
+            "status": "DeviceConnected" if index % 3 == 0 else "NoDeviceConnected",
+            "type": None,
+            "guessed": 3,
+            "devices": [],
+            "companion_info": {"port": index + 1 if index % 2 else index - 1, "hub": f"hub{number}", "multiple_companions": False},
+            "type_c": False,
+            "user_connectable": True,
+        }
+        if port["status"] == "DeviceConnected":
+            port["devices"].append({"name": f"Device {number}-{index}", "instance_id": f"USB\\VID_046D&PID_{index:04X}\\{number}", "speed": 2, "devices": []})
+        data["ports"].append(port)
+    return data
+
+
+def controllers(count: int, ports: int = 8):
+    return [controller(number, ports) for number in range(count)]
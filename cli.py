@@ -0,0 +1,266 @@
+# Runs the same steps as the menus without any prompts, for scripts and provisioning.
+# Exit codes: 0 done, 1 no saved data, 2 bad arguments or script, 3 selection has errors, 4 not possible on this system, 5 some batch inputs failed.
+# Results are printed as JSON on stdout and messages go to stderr. With --json, results are on one line and errors are JSON too.
+import argparse
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+import batch
+from engine import KextVariant, USBMapEngine
+from Scripts import model, persistence, scheduler, selection_script, shared
+from Scripts.metrics import metrics
+from Scripts.selection import SelectionModel
+from Scripts.tracing import tracer
+
+EXIT_OK = 0
+EXIT_NO_DATA = 1
+EXIT_USAGE = 2
+EXIT_INVALID = 3
+EXIT_UNSUPPORTED = 4
+EXIT_PARTIAL = 5
+
+
+class CLIError(Exception):
+    def __init__(self, message, code):
+        super().__init__(message)
+        self.code = code
+
+
+def usbmap_for(args, discovery=False) -> USBMapEngine:
+    kwargs = {"json_path": Path(args.usb_json), "settings_path": Path(args.settings)}
+    if not discovery:
+        return USBMapEngine(**kwargs)
+    elif platform.system() == "Windows":
+        from Windows import WindowsUSBMap  # pylint: disable=import-outside-toplevel
+
+        return WindowsUSBMap(**kwargs)
+    elif platform.system() == "Darwin":
+        from macOS import macOSUSBMap  # pylint: disable=import-outside-toplevel
+
+        return macOSUSBMap(**kwargs)
+    raise CLIError(f"Discovery is not supported on {platform.system()}", EXIT_UNSUPPORTED)
+
+
+def summary(controllers):
+    return [
+        {"name": c.name, "ports": len(c.ports), "populated": sum(1 for p in c.ports if p.devices), "selected": sum(1 for p in c.ports if p.selected)} for c in controllers or []
+    ]
+
+
+def snapshot(args):
+    usbmap = usbmap_for(args, discovery=True)
+    usbmap.get_controllers()
+    if args.save:
+        usbmap.on_quit()
+
+    data = json.dumps(usbmap.controllers, indent=4, sort_keys=True, default=model.to_json)
+    if not args.out:
+        print(data)
+        return EXIT_OK, None
+    persistence.HistoricalStore.write_atomic(Path(args.out), data.encode())
+    return EXIT_OK, {"out": str(Path(args.out).resolve()), "controllers": summary(usbmap.controllers)}
+
+
+def discover(args):
+    usbmap = usbmap_for(args, discovery=True)
+    usbmap.get_controllers()
+    polls = changes = 0
+    enumeration_seconds = 0.0
+    end = time.monotonic() + args.duration
+    source = usbmap.event_source()
+    # A fixed --interval replaces the adaptive one
+    poll_scheduler = scheduler.PollScheduler(args.interval, args.interval, cpu_budget=0) if args.interval else scheduler.PollScheduler.from_settings(usbmap.settings)
+    try:
+        while time.monotonic() < end:
+            source.wait(min(source.timeout if source.push else poll_scheduler.interval, max(end - time.monotonic(), 0)))
+            polls += 1
+            start = time.perf_counter()
+            changed = usbmap.update_devices()
+            metrics.add_time("enumerate", time.perf_counter() - start)
+            metrics.count("enumerations")
+            enumeration_seconds += time.perf_counter() - start
+            poll_scheduler.record(time.perf_counter() - start, changed)
+            changes += 1 if changed else 0
+    finally:
+        source.close()
+    usbmap.on_quit()
+    return EXIT_OK, {
+        "usb_json": str(usbmap.json_path.resolve()),
+        "event_source": type(source).__name__,
+        "events": source.events,
+        "polls": polls,
+        "changes": changes,
+        "enumeration_seconds": round(enumeration_seconds, 3),
+        "controllers": summary(usbmap.controllers_historical),
+    }
+
+
+def select(args):
+    if args.expression is not None:
+        script = args.expression
+    elif args.script == "-":
+        script = sys.stdin.read()
+    else:
+        script = Path(args.script).read_text()
+    try:
+        statements = selection_script.parse(script)
+    except selection_script.ScriptError as e:
+        raise CLIError(f"Invalid script: {e}", EXIT_USAGE) from None
+
+    usbmap = usbmap_for(args)
+    if not usbmap.controllers_historical:
+        raise CLIError(f"No ports in {args.usb_json}! Use the discovery mode first.", EXIT_NO_DATA)
+
+    auto_bind = usbmap.settings["auto_bind_companions"] if args.bind is None else args.bind
+    selection = SelectionModel(usbmap.controllers_historical, usbmap.historical_index.companions, auto_bind)
+    selection_script.run(statements, selection)
+    changed_ports = usbmap.record_selection(selection, usbmap.historical_store)
+    if not args.dry_run:
+        usbmap.on_quit()
+    return EXIT_OK, {"changed_ports": len(changed_ports), "saved": not args.dry_run, "errors": usbmap.selection_errors(selection), "controllers": summary(usbmap.controllers_historical)}
+
+
+def build(args):
+    usbmap = usbmap_for(args)
+    if not usbmap.controllers_historical:
+        raise CLIError(f"No ports in {args.usb_json}! Use the discovery mode first.", EXIT_NO_DATA)
+
+    # Fills in the default selections for ports that were never shown in Select Ports, without saving them
+    selection = SelectionModel(usbmap.controllers_historical, usbmap.historical_index.companions, usbmap.settings["auto_bind_companions"])
+    errors = usbmap.selection_errors(selection)
+    if errors:
+        raise CLIError("\n".join(errors), EXIT_INVALID)
+
+    if args.all_variants:
+        variants = list(KextVariant)
+    else:
+        variants = [KextVariant(i) for i in dict.fromkeys(args.variant)] if args.variant else [usbmap.variant()]
+    model_identifier = None
+    if any(variant.native for variant in variants):
+        model_identifier = args.model or usbmap.detect_model_identifier()
+        if not model_identifier:
+            raise CLIError("Native variants need --model when not running on macOS", EXIT_USAGE)
+    if args.no_comments:
+        usbmap.settings["add_comments_to_map"] = False
+
+    try:
+        templates = usbmap.generate_plists(variants, model_identifier, ignore_empty=args.ignore_empty)
+    except RuntimeError as e:
+        raise CLIError(str(e), EXIT_UNSUPPORTED) from None
+    kexts = []
+    for variant, template in templates.items():
+        result = usbmap.write_kext(template, variant, Path(args.out) if args.out else None)
+        kexts.append(
+            {
+                "path": str(result.path.resolve()),
+                "variant": variant.value,
+                "sha256": result.digest,
+                "written": result.written,
+                "added": result.added,
+                "removed": result.removed,
+                "changed": result.changed,
+                "personalities": {name: len(personality["IOProviderMergeProperties"]["ports"]) for name, personality in template["IOKitPersonalities"].items()},
+            }
+        )
+    return EXIT_OK, {"kexts": kexts}
+
+
+def build_batch(args):
+    source = Path(args.source)
+    if source.is_dir():
+        inputs = batch.find_inputs(source)
+    elif source.exists():
+        inputs = batch.read_manifest(source)
+    else:
+        raise CLIError(f"{source} does not exist", EXIT_USAGE)
+    if not inputs:
+        raise CLIError(f"No usb.json files in {source}", EXIT_NO_DATA)
+
+    options = batch.BatchOptions(
+        tuple(KextVariant(i) for i in dict.fromkeys(args.variant or [KextVariant.USBTOOLBOX.value])),
+        args.model,
+        args.ignore_empty,
+        False if args.no_comments else None,
+        Path(args.settings),
+    )
+    results, totals = batch.build_all(inputs, Path(args.out), options, args.jobs)
+    for result in results:
+        if result["error"]:
+            print(f"{result['input']}: {result['error']}", file=sys.stderr)
+    print(f"Built {totals['built']}/{totals['inputs']} maps ({totals['kexts']} kexts, {totals['unchanged']} unchanged) in {totals['seconds']} s, {totals['maps_per_second']} maps/s with {totals['jobs']} jobs", file=sys.stderr)
+    return EXIT_PARTIAL if totals["failed"] else EXIT_OK, totals | {"results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="usbtoolbox", description=f"USBToolBox {shared.VERSION}".strip())
+    parser.add_argument("--json", action="store_true", help="Print results on one line, and errors as JSON too")
+    parser.add_argument("--usb-json", default=str(shared.current_dir / Path("usb.json")), help="Saved data (default: usb.json next to the tool)")
+    parser.add_argument("--settings", default=str(shared.current_dir / Path("settings.json")))
+    parser.add_argument("--metrics-json", help="Write counters and timings of every enumeration phase to this file on exit")
+    parser.add_argument("--trace", help="Record a Chrome trace (Perfetto, about:tracing) to this file, same as USBTOOLBOX_TRACE")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Print or save the ports and devices connected right now")
+    snapshot_parser.add_argument("--out", help="Write to this file instead of stdout")
+    snapshot_parser.add_argument("--save", action="store_true", help="Also merge into usb.json")
+    snapshot_parser.set_defaults(func=snapshot)
+
+    discover_parser = subparsers.add_parser("discover", help="Port discovery, merging what is seen into usb.json")
+    discover_parser.add_argument("--duration", type=float, default=0, help="Seconds to keep polling for plugged devices (default: one pass)")
+    discover_parser.add_argument("--interval", type=float, help="Fixed seconds between polls when the platform can't report changes (default: adaptive, see the poll_* settings)")
+    discover_parser.set_defaults(func=discover)
+
+    select_parser = subparsers.add_parser("select", help="Edit port selections in usb.json with a selection script, like the ones typed in Select Ports")
+    script_group = select_parser.add_mutually_exclusive_group(required=True)
+    script_group.add_argument("script", nargs="?", help="Script file, - for stdin")
+    script_group.add_argument("-e", "--expression", help="Script given on the command line, ie. 'N;+populated;T:populated&type=unknown:3' (use -e=... when it starts with -)")
+    select_parser.add_argument("--bind", action=argparse.BooleanOptionalAction, help="Change companion ports along with their ports (default: auto_bind_companions setting)")
+    select_parser.add_argument("--dry-run", action="store_true", help="Don't save the changes")
+    select_parser.set_defaults(func=select)
+
+    build_parser = subparsers.add_parser("build", help="Build the kext from usb.json")
+    build_parser.add_argument("--from", dest="usb_json", default=argparse.SUPPRESS, help="Same as --usb-json")
+    build_parser.add_argument("--variant", action="append", choices=[i.value for i in KextVariant], help="utb (USBToolBox.kext), native or legacy, can be given more than once (default: from settings)")
+    build_parser.add_argument("--all-variants", action="store_true", help="Build all three kexts in one pass")
+    build_parser.add_argument("--model", help="Model identifier for native variants (default: this Mac's)")
+    build_parser.add_argument("--out", help="Directory to write the kext to (default: next to the tool)")
+    build_parser.add_argument("--ignore-empty", action="store_true", help="Leave controllers without selected ports out of the map instead of disabling all their ports")
+    build_parser.add_argument("--no-comments", action="store_true", help="Don't add port comments to the map")
+    build_parser.set_defaults(func=build)
+
+    batch_parser = subparsers.add_parser("batch", help="Build kexts for every usb.json in a directory or manifest, in parallel")
+    batch_parser.add_argument("source", help="Directory searched for *.json, or a manifest with one usb.json path (and optionally a model identifier) per line")
+    batch_parser.add_argument("--out", required=True, help="Each input gets its own folder in here")
+    batch_parser.add_argument("--variant", action="append", choices=[i.value for i in KextVariant], help="Can be given more than once (default: utb)")
+    batch_parser.add_argument("--model", help="Model identifier for native variants, for inputs that don't have one in the manifest")
+    batch_parser.add_argument("--jobs", type=int, help="Worker processes (default: CPU count)")
+    batch_parser.add_argument("--ignore-empty", action="store_true", help="Leave controllers without selected ports out of the maps")
+    batch_parser.add_argument("--no-comments", action="store_true", help="Don't add port comments to the maps")
+    batch_parser.set_defaults(func=build_batch)
+
+    args = parser.parse_args(argv)
+    if args.trace:
+        tracer.start(Path(args.trace))
+    try:
+        code, result = args.func(args)
+    except CLIError as e:
+        if args.json:
+            print(json.dumps({"error": str(e), "code": e.code}))
+        print(e, file=sys.stderr)
+        return e.code
+    finally:
+        if args.metrics_json:
+            metrics.dump(Path(args.metrics_json))
+        if tracer.enabled:
+            tracer.save()
+
+    if result is not None:
+        print(json.dumps(result, indent=None if args.json else 4))
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
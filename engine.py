@@ -0,0 +1,588 @@
+# Everything needed to load, merge and map ports, without the menus. Doesn't import termcolor2, ansiescapes or Scripts.utils, so it can be embedded.
+import binascii
+import copy
+import hashlib
+import json
+import os
+import platform
+import plistlib
+import shutil
+import subprocess
+import tempfile
+from collections import Counter
+from enum import Enum
+from operator import attrgetter
+from pathlib import Path
+from typing import NamedTuple, Optional
+from xml.parsers.expat import ExpatError
+
+from Scripts import events, model, persistence, shared, topology
+from Scripts.metrics import metrics
+from Scripts.selection import SelectionModel
+from Scripts.tracing import traced
+
+
+# Identifiers that can only be used to match a controller if no other controller shares them
+UNIQUE_IDENTIFIERS = {
+    "acpi_name": lambda c: c.identifiers.acpi_path.rpartition(".")[2] if c.identifiers.acpi_path is not None else None,
+    "path": lambda c: c.identifiers.path,
+    "pci_id": lambda c: c.identifiers.pci_id,
+}
+
+
+class KextVariant(Enum):
+    USBTOOLBOX = "utb"
+    NATIVE = "native"
+    LEGACY_NATIVE = "legacy"
+
+    @classmethod
+    def from_settings(cls, settings: dict):
+        if settings["use_native"] and settings["use_legacy_native"]:
+            return cls.LEGACY_NATIVE
+        elif settings["use_native"]:
+            return cls.NATIVE
+        return cls.USBTOOLBOX
+
+    @property
+    def native(self):
+        return self != KextVariant.USBTOOLBOX
+
+    @property
+    def kext_name(self):
+        return {KextVariant.USBTOOLBOX: "UTBMap.kext", KextVariant.NATIVE: "USBMap.kext", KextVariant.LEGACY_NATIVE: "USBMapLegacy.kext"}[self]
+
+
+class KextWrite(NamedTuple):
+    path: Path
+    # sha256 of Contents/Info.plist
+    digest: str
+    # False if the kext on disk already had the same Info.plist and was left alone
+    written: bool
+    # Personalities compared to the kext that was there before
+    added: list
+    removed: list
+    changed: list
+
+
+DEFAULT_SETTINGS = {
+    "show_friendly_types": True,
+    "use_native": False,
+    "use_legacy_native": False,
+    "add_comments_to_map": True,
+    "auto_bind_companions": True,
+    "use_journal": False,
+    # Discovery polling, when there are no change events (see Scripts/scheduler.py). Intervals in seconds, budget in seconds of enumerating per minute.
+    "poll_min_interval": 0.5,
+    "poll_max_interval": 10.0,
+    "poll_backoff": 2.0,
+    "poll_burst_seconds": 10.0,
+    "poll_cpu_budget": 3.0,
+}
+
+
+# resources/Info.plist, only read once per process. Batch builds hand it to their workers with share_template().
+_template: Optional[dict] = None
+
+
+def load_template():
+    global _template  # pylint: disable=global-statement
+    if _template is None:
+        _template = plistlib.load((shared.resource_dir / Path("Info.plist")).open("rb"))
+    return copy.deepcopy(_template)
+
+
+def share_template(template: dict):
+    global _template  # pylint: disable=global-statement
+    _template = template
+
+
+def hexswap(input_hex: str):
+    hex_pairs = [input_hex[i : i + 2] for i in range(0, len(input_hex), 2)]
+    hex_rev = hex_pairs[::-1]
+    hex_str = "".join(["".join(x) for x in hex_rev])
+    return hex_str.upper()
+
+
+def read_property(input_value: bytes, places: int):
+    return binascii.b2a_hex(input_value).decode()[:-places]
+
+
+class USBMapEngine:
+    def __init__(self, json_path: Optional[Path] = None, settings_path: Optional[Path] = None):
+        self.controllers = None
+        self.json_path = json_path or shared.current_dir / Path("usb.json")
+        self.settings_path = settings_path or shared.current_dir / Path("settings.json")
+
+        self.settings = self.read_settings(self.settings_path)
+        self.historical_store = persistence.HistoricalStore(self.json_path, journal=self.settings["use_journal"])
+        self.load_historical()
+        self.snapshot_digest = topology.SnapshotDigest()
+
+    @property
+    def controllers_historical(self):
+        return self._controllers_historical
+
+    @controllers_historical.setter
+    def controllers_historical(self, value):
+        self._controllers_historical = value
+        # Rebuilt whenever the historical data is replaced (loaded, first discovery, deleted), merges keep it up to date after that
+        self.historical_index = topology.ControllerIndex(value)
+
+    @staticmethod
+    def read_settings(settings_path: Path):
+        return DEFAULT_SETTINGS | (json.load(settings_path.open()) if settings_path.exists() else {})
+
+    @staticmethod
+    def read_historical(store: persistence.HistoricalStore):
+        controllers, records = store.load()
+        if records:
+            controllers = controllers or []
+            index = topology.ControllerIndex(controllers)
+            for record in records:
+                USBMapEngine.apply_journal_record(controllers, index, record)
+        return controllers
+
+    def load_historical(self):
+        self.controllers_historical = self.read_historical(self.historical_store)
+
+    @staticmethod
+    def apply_journal_record(base: list, base_index: topology.ControllerIndex, record: dict):
+        # Replays one record written by the merges or select_ports, the same way it was applied originally
+        if record["op"] == "controller":
+            controller = model.Controller.from_dict(record["data"])
+            base.append(controller)
+            base_index.add(controller)
+            return
+
+        controller = base[record["controller"]]
+        if record["op"] == "controller_properties":
+            for key, value in record["data"].items():
+                controller.set(key, USBMapEngine.merge_properties(controller.get(key), model.Controller.field_from_dict(key, value)))
+            base_index.update(controller)
+        elif record["op"] == "controller_state":
+            for key, value in record["data"].items():
+                controller.set(key, value)
+        elif record["op"] == "port":
+            base_index.add_port(controller, model.Port.from_dict(record["data"]))
+            controller.ports.sort(key=attrgetter("index"))
+        else:
+            port = controller.get_port(record["port"])
+            if record["op"] == "port_properties":
+                for key, value in record["data"].items():
+                    port.set(key, USBMapEngine.merge_properties(port.get(key), model.Port.field_from_dict(key, value)))
+                base_index.update_port(port)
+            elif record["op"] == "port_state":
+                for key, value in record["data"].items():
+                    port.set(key, value)
+                base_index.update_port(port)
+            elif record["op"] == "devices":
+                base_index.devices.merge(port.devices, [model.device_from_dict(i) for i in record["data"]])
+                base_index.update_port(port)
+
+    @staticmethod
+    def is_same_controller(controller_1, controller_2):
+        return topology.is_same_controller(controller_1, controller_2)
+
+    @staticmethod
+    def get_controller_from_list(original, controller_list):
+        for controller in controller_list:
+            if USBMapEngine.is_same_controller(original, controller):
+                return controller
+        return None
+
+    @staticmethod
+    def merge_properties(old, new):
+        if not new:
+            return old
+        if not old:
+            return new
+        if isinstance(old, model.Identifiers):
+            retval = old.copy()
+            retval.merge_from(new, USBMapEngine.merge_properties)
+            return retval
+        elif isinstance(old, list):
+            retval = list(old)
+            retval.extend(set(new) - set(old))
+            return retval
+        elif isinstance(old, dict):
+            retval = dict(old)
+            for key in new:
+                retval[key] = USBMapEngine.merge_properties(retval.get(key), new[key])
+            return retval
+        else:
+            return new
+
+    @staticmethod
+    @traced()
+    def merge_controllers(base: list, new: list, base_index: Optional[topology.ControllerIndex] = None, journal: Optional[persistence.HistoricalStore] = None):
+        base_index = topology.ControllerIndex(base) if base_index is None else base_index
+        new_index = topology.ControllerIndex(new)
+        for controller in new:
+            base_controller = base_index.find(controller)
+            if not base_controller:
+                # Copy so later snapshots resetting their device lists can't touch the historical data
+                base_controller = controller.copy()
+                base.append(base_controller)
+                base_index.add(base_controller)
+                if journal:
+                    journal.record({"op": "controller", "data": base_controller})
+                # Don't need to merge properties because there's no base controller
+                continue
+
+            changes = base_controller.merge_from(controller, USBMapEngine.merge_properties, skip=["ports"])  # Leave merging ports to merge_ports
+            if changes:
+                base_index.update(base_controller)
+                if journal:
+                    journal.record({"op": "controller_properties", "controller": base_index.position(base_controller), "data": changes})
+
+        USBMapEngine.merge_ports(base, new, base_index, new_index, journal)
+
+    @staticmethod
+    @traced()
+    def merge_ports(
+        base: list,
+        new: list,
+        base_index: Optional[topology.ControllerIndex] = None,
+        new_index: Optional[topology.ControllerIndex] = None,
+        journal: Optional[persistence.HistoricalStore] = None,
+    ):
+        base_index = topology.ControllerIndex(base) if base_index is None else base_index
+        unsorted = {}
+        for controller in new:
+            base_controller = base_index.find(controller)
+            for port in controller.ports:
+                base_port = base_controller.get_port(port.index)
+                if not base_port:
+                    base_port = port.copy()
+                    base_index.add_port(base_controller, base_port)
+                    unsorted[id(base_controller)] = base_controller
+                    if journal:
+                        journal.record({"op": "port", "controller": base_index.position(base_controller), "data": base_port})
+                    # Don't need to merge properties because there's no base port
+                    continue
+
+                changes = base_port.merge_from(port, USBMapEngine.merge_properties, skip=["devices"])  # Leave merging devices to merge_devices
+                if changes:
+                    base_index.update_port(base_port)
+                if changes and journal:
+                    journal.record({"op": "port_properties", "controller": base_index.position(base_controller), "port": port.index, "data": changes})
+        for base_controller in unsorted.values():
+            base_controller.ports.sort(key=attrgetter("index"))
+        USBMapEngine.merge_devices(base, new, base_index, new_index, journal)
+
+    @staticmethod
+    def recursive_merge_devices(base: list, new: list):
+        return topology.DeviceTreeIndex().merge(base, new)
+
+    @staticmethod
+    @traced()
+    def merge_devices(
+        base: list,
+        new: list,
+        base_index: Optional[topology.ControllerIndex] = None,
+        new_index: Optional[topology.ControllerIndex] = None,
+        journal: Optional[persistence.HistoricalStore] = None,
+    ):
+        base_index = topology.ControllerIndex(base) if base_index is None else base_index
+        new_index = topology.ControllerIndex(new) if new_index is None else new_index
+        for position, controller in enumerate(base):
+            new_controller = new_index.find(controller)
+            if not new_controller:
+                continue
+            for port in controller.ports:
+                new_port = new_controller.get_port(port.index)
+                if new_port and base_index.devices.merge(port.devices, new_port.devices):
+                    base_index.update_port(port)
+                    if journal:
+                        journal.record({"op": "devices", "controller": position, "port": port.index, "data": new_port.devices})
+
+    def get_controllers(self):
+        raise NotImplementedError
+
+    def update_devices(self):
+        raise NotImplementedError
+
+    def enumerate_controllers(self, devices_only: bool = False):
+        # Fresh controllers with their devices, without touching self.controllers, so a scan can run on another thread and be thrown away if cancelled.
+        # devices_only lets backends reuse the controllers of their last full enumeration and only refresh devices, like update_devices.
+        raise NotImplementedError
+
+    def apply_controllers(self, controllers):
+        # Back on the main thread with the result of enumerate_controllers. Returns whether the topology changed, like update_devices.
+        self.controllers = controllers
+        return self.update_historical()
+
+    def event_source(self, poll_interval: float = 5.0) -> events.EventSource:
+        # Started source of topology change events for discovery, closed by the caller. Backends without one poll.
+        return events.PollingEventSource(poll_interval).start()
+
+    @traced()
+    def update_historical(self):
+        # Called by the backends with a fresh self.controllers. Returns whether the topology changed since the last snapshot.
+        with metrics.timer("snapshot_digest"):
+            is_changed, changed = self.snapshot_digest.update(self.controllers)
+        if not self.controllers_historical:
+            self.controllers_historical = [controller.copy() for controller in self.controllers]
+            for controller in self.controllers_historical:
+                self.historical_store.record({"op": "controller", "data": controller})
+        elif changed:
+            with metrics.timer("merge"):
+                self.merge_controllers(self.controllers_historical, changed, self.historical_index, self.historical_store)
+        return is_changed
+
+    @traced()
+    def dump_historical(self, force=False):
+        if self.controllers_historical:
+            self.historical_store.save(self.controllers_historical, force)
+        elif self.controllers_historical == []:
+            self.remove_historical()
+
+    def remove_historical(self):
+        if self.controllers_historical or self.controllers_historical == []:
+            self.controllers = None
+            self.controllers_historical = None
+            self.snapshot_digest = topology.SnapshotDigest()
+            self.historical_store.remove()
+
+    def dump_settings(self):
+        json.dump(self.settings, self.settings_path.open("w"), indent=4, sort_keys=True)
+
+    def on_quit(self):
+        if self.controllers_historical:
+            self.historical_store.close(self.controllers_historical)
+
+    def get_companion_port(self, port):
+        return self.historical_index.companions.companion(port)
+
+    @staticmethod
+    def record_selection(selection: SelectionModel, store: persistence.HistoricalStore):
+        # Journals what changed since the last call, returns the changed ports
+        changed_controllers, changed_ports = selection.take_changes()
+        for controller in changed_controllers:
+            store.record({"op": "controller_state", "controller": selection.position(controller), "data": {"selected_count": controller.selected_count}})
+        for port in changed_ports:
+            store.record({"op": "port_state", "controller": selection.position(selection.controller_of(port)), "port": port.index, "data": selection.state(port)})
+        return changed_ports
+
+    def search_ports(self, query: str) -> set:
+        # ids of the historical ports matching the query, see topology.SearchIndex
+        return self.historical_index.searchable().search(query)
+
+    @staticmethod
+    def selection_errors(selection: SelectionModel):
+        if not selection.any_selected():
+            return ["No ports are selected! Select some ports."]
+        return selection.errors()
+
+    def variant(self):
+        return KextVariant.from_settings(self.settings)
+
+    def count_identifiers(self):
+        # Built once per build, so checking if an identifier is unique is a lookup instead of a scan over every controller
+        counts = {name: Counter() for name in UNIQUE_IDENTIFIERS}
+        for controller in self.controllers_historical:
+            for name, identifier in UNIQUE_IDENTIFIERS.items():
+                value = identifier(controller)
+                if value is not None:
+                    counts[name][value] += 1
+        return counts
+
+    @staticmethod
+    def is_unique(counts, name, controller):
+        value = UNIQUE_IDENTIFIERS[name](controller)
+        return value is not None and counts[name][value] == 1
+
+    def personality_names(self, controllers, counts):
+        names = {}
+        for controller in controllers:
+            if controller.identifiers.acpi_path:
+                if self.is_unique(counts, "acpi_name", controller):
+                    names[id(controller)] = controller.identifiers.acpi_path.rpartition(".")[2]
+                else:
+                    names[id(controller)] = controller.identifiers.acpi_path[1:]  # Strip leading \
+            elif controller.identifiers.bdf:
+                names[id(controller)] = ":".join([str(i) for i in controller.identifiers.bdf])
+            else:
+                names[id(controller)] = controller.name
+
+        # Controllers with the same name and no ACPI path or BDF would overwrite each other's personality, number all but the first
+        counts["personality_name"] = Counter(names.values())
+        taken = set(counts["personality_name"])
+        seen = set()
+        for controller in controllers:
+            name = names[id(controller)]
+            if name in seen:
+                suffix = 2
+                while f"{name}-{suffix}" in taken:
+                    suffix += 1
+                names[id(controller)] = f"{name}-{suffix}"
+                taken.add(names[id(controller)])
+            seen.add(name)
+        return names
+
+    def choose_matching_key(self, controller, counts=None, variant: Optional[KextVariant] = None):
+        counts = self.count_identifiers() if counts is None else counts
+        variant = self.variant() if variant is None else variant
+        identifiers = controller.identifiers
+        if identifiers.bus_number is not None:
+            # M1 Macs
+            return {"IOPropertyMatch": {"bus-number": binascii.a2b_hex(hexswap(hex(identifiers.bus_number)[2:].zfill(8)))}}
+
+        elif not variant.native and self.is_unique(counts, "acpi_name", controller):
+            # Unique ACPI name
+            # Disable if using native because we don't know if it'll conflict
+            # TODO: Check this maybe?
+            shared.debug(f"Using ACPI path: {identifiers.acpi_path}")
+            return {"IONameMatch": identifiers.acpi_path.rpartition(".")[2]}
+
+        elif identifiers.bdf is not None:
+            # Use bus-device-function
+            return {"IOPropertyMatch": {"pcidebug": ":".join([str(i) for i in identifiers.bdf])}}
+
+        elif self.is_unique(counts, "path", controller):
+            # Use IORegistry path
+            return {"IOPathMatch": identifiers.path}
+
+        elif self.is_unique(counts, "pci_id", controller):
+            # Use PCI ID
+            pci_id: model.PCIID = identifiers.pci_id
+            return {"IOPCIPrimaryMatch": f"0x{pci_id.device:04x}{pci_id.vendor:04x}"} | (
+                {"IOPCISecondaryMatch": f"0x{pci_id.subsystem:04x}{pci_id.subsystem_vendor:04x}"} if pci_id.subsystem is not None else {}
+            )
+
+        else:
+            raise RuntimeError("No matching key available")
+
+    def empty_controllers(self):
+        return [c for c in self.controllers_historical if not any(p.selected for p in c.ports)]
+
+    @staticmethod
+    def detect_model_identifier():
+        # Only possible when running on the target machine
+        if platform.system() != "Darwin":
+            return None
+        return plistlib.loads(subprocess.run("system_profiler -detailLevel mini -xml SPHardwareDataType".split(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.strip())[0]["_items"][0][
+            "machine_model"
+        ]
+
+    def port_table(self, controller):
+        # IOProviderMergeProperties for a controller. The same for every variant.
+        ports = {}
+        port_name_index = {}
+        highest_index = 0
+
+        for port in controller.ports:
+            if not port.selected:
+                continue
+
+            if port.index > highest_index:
+                highest_index = port.index
+
+            if controller.class_ == shared.USBControllerTypes.XHCI and port.class_ == shared.USBDeviceSpeeds.SuperSpeed:
+                prefix = "SS"
+            elif controller.class_ == shared.USBControllerTypes.XHCI and port.class_ == shared.USBDeviceSpeeds.HighSpeed:
+                prefix = "HS"
+            else:
+                prefix = "PRT"
+
+            port_index = port_name_index.setdefault(prefix, 1)
+            port_name = prefix + str(port_index).zfill(4 - len(prefix))
+            port_name_index[prefix] += 1
+
+            ports[port_name] = {
+                "port": binascii.a2b_hex(hexswap(hex(port.index)[2:].zfill(8))),
+                "UsbConnector": port.type or port.guessed,
+            }
+
+            if self.settings["add_comments_to_map"] and port.comment:
+                ports[port_name]["#comment"] = port.comment
+
+        return {"ports": ports, "port-count": binascii.a2b_hex(hexswap(hex(highest_index)[2:].zfill(8)))}
+
+    @traced()
+    def generate_plists(self, variants, model_identifier: Optional[str] = None, ignore_empty: bool = False):
+        # Info.plist for each variant, {variant: template}. Port tables, personality names and matching keys are worked out once for all of them,
+        # so the templates share those objects and shouldn't be modified.
+        templates = {variant: load_template() for variant in variants}
+
+        controllers = [c for c in self.controllers_historical if not (ignore_empty and not any(i.selected for i in c.ports))]
+        counts = self.count_identifiers()
+        personality_names = self.personality_names(controllers, counts)
+        for controller in controllers:
+            personality_name: str = personality_names[id(controller)]
+            port_table = self.port_table(controller)
+            # Native variants can't match by ACPI name, so they may need a different key
+            matching_keys = {}
+
+            for variant, template in templates.items():
+                if variant.native not in matching_keys:
+                    matching_keys[variant.native] = self.choose_matching_key(controller, counts, variant)
+
+                if variant.native:
+                    personality = {
+                        "CFBundleIdentifier": "com.apple.driver." + ("AppleUSBMergeNub" if variant == KextVariant.LEGACY_NATIVE else "AppleUSBHostMergeProperties"),
+                        "IOClass": ("AppleUSBMergeNub" if variant == KextVariant.LEGACY_NATIVE else "AppleUSBHostMergeProperties"),
+                        "IOProviderClass": "AppleUSBHostController",
+                        "IOParentMatch": matching_keys[variant.native],
+                        "model": model_identifier,
+                    }
+
+                else:
+                    personality = {
+                        "CFBundleIdentifier": "com.dhinakg.USBToolBox.kext",
+                        "IOClass": "USBToolBox",
+                        "IOProviderClass": "IOPCIDevice",
+                        "IOMatchCategory": "USBToolBox",
+                    } | matching_keys[variant.native]
+
+                personality["IOProviderMergeProperties"] = port_table
+                template["IOKitPersonalities"][personality_name] = personality
+
+        for variant, template in templates.items():
+            if not variant.native:
+                template["OSBundleLibraries"] = {"com.dhinakg.USBToolBox.kext": "1.0.0"}
+        return templates
+
+    @staticmethod
+    @traced()
+    def write_kext(template: dict, variant: KextVariant, directory: Optional[Path] = None):
+        # Leaves the kext alone if its Info.plist wouldn't change, so timestamps don't churn. Otherwise builds the new one next to it and swaps it in.
+        write_path = (directory or shared.current_dir) / Path(variant.kext_name)
+        plist_path = write_path / Path("Contents/Info.plist")
+        data = plistlib.dumps(template, sort_keys=True)
+        digest = hashlib.sha256(data).hexdigest()
+
+        old_data = plist_path.read_bytes() if plist_path.is_file() else None
+        if old_data is not None and hashlib.sha256(old_data).hexdigest() == digest:
+            return KextWrite(write_path, digest, False, [], [], [])
+
+        try:
+            old_personalities = plistlib.loads(old_data).get("IOKitPersonalities", {}) if old_data is not None else {}
+        except (plistlib.InvalidFileException, ExpatError, ValueError):
+            # Unreadable, ie. torn by an interrupted in place write. Replaced like any other change.
+            old_personalities = {}
+        new_personalities = template["IOKitPersonalities"]
+        added = sorted(new_personalities.keys() - old_personalities.keys())
+        removed = sorted(old_personalities.keys() - new_personalities.keys())
+        changed = sorted(name for name in new_personalities.keys() & old_personalities.keys() if new_personalities[name] != old_personalities[name])
+
+        write_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = Path(tempfile.mkdtemp(dir=write_path.parent, prefix=f".{write_path.name}."))
+        old_path = temp_path.with_name(temp_path.name + ".old")
+        try:
+            (temp_path / Path("Contents")).mkdir()
+            (temp_path / Path("Contents/Info.plist")).write_bytes(data)
+            # mkdtemp makes it 0700
+            os.chmod(temp_path, persistence.file_mode(write_path, 0o777))
+            if write_path.exists():
+                # Directories can't be replaced in one rename, so there's a moment with no kext. Undone below if the second rename fails.
+                os.replace(write_path, old_path)
+            os.replace(temp_path, write_path)
+        except BaseException:
+            if old_path.exists() and not write_path.exists():
+                os.replace(old_path, write_path)
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        # The new kext is in place, a leftover old one isn't a failed write
+        shutil.rmtree(old_path, ignore_errors=True)
+        return KextWrite(write_path, digest, True, added, removed, changed)
@@ -1,9 +1,10 @@
 import binascii
-import copy
 from enum import Enum
-from operator import itemgetter
+from operator import attrgetter
+from typing import Optional
 
-from Scripts import iokit, shared
+from Scripts import iokit, model, shared
+from Scripts.tracing import traced
 from base import BaseUSBMap
 
 # from gui import *
@@ -29,6 +30,9 @@ def read_property(input_value: bytes, places: int) -> str:
 
 
 class macOSUSBMap(BaseUSBMap):
+    # Controllers (without devices) from the last full enumeration
+    walked_controllers: Optional[list] = None
+
     @staticmethod
     def port_class_to_type(speed):
         if "AppleUSB30XHCIPort" in speed:
@@ -59,7 +63,22 @@ class macOSUSBMap(BaseUSBMap):
             shared.debug(f"Unknown controller type for class code {read_property(parent_props['class-code'], 2) if 'class-code' in parent_props else 'none'}, inheritance {inheritance}!")
             return shared.USBControllerTypes.Unknown
 
+    @traced()
     def get_controllers(self):
+        self.controllers = self.enumerate_controllers()
+        return self.update_historical()
+
+    @traced()
+    def enumerate_controllers(self, devices_only: bool = False):
+        # Walking the controllers is only needed for the first scan, later ones copy its result and only look for devices like update_devices
+        if not devices_only or self.walked_controllers is None:
+            self.walked_controllers = self.walk_controllers()
+        controllers = [controller.copy() for controller in self.walked_controllers]
+        self.attach_devices(controllers)
+        return controllers
+
+    @traced()
+    def walk_controllers(self):
         controllers = []
 
         err, controller_iterator = iokit.IOServiceGetMatchingServices(iokit.kIOMasterPortDefault, iokit.IOServiceMatching("AppleUSBHostController".encode()), None)
@@ -69,61 +88,56 @@ class macOSUSBMap(BaseUSBMap):
             err, parent_device = iokit.IORegistryEntryGetParentEntry(controller_instance, "IOService".encode(), None)
             parent_properties: dict = iokit.corefoundation_to_native(iokit.IORegistryEntryCreateCFProperties(parent_device, None, iokit.kCFAllocatorDefault, iokit.kNilOptions)[1])  # type: ignore
 
-            controller = {
-                "name": iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(parent_device, None)[1]),
-                # "class": macOSUSBMap.port_class_to_type(iokit.get_class_inheritance(controller_instance)),
-                "identifiers": {"location_id": controller_properties["locationID"], "path": iokit.IORegistryEntryCopyPath(controller_instance, "IOService".encode())},
-                "ports": [],
-            }
+            controller = model.Controller(
+                name=iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(parent_device, None)[1]),
+                # class_=macOSUSBMap.port_class_to_type(iokit.get_class_inheritance(controller_instance)),
+                identifiers=model.Identifiers(location_id=controller_properties["locationID"], path=iokit.IORegistryEntryCopyPath(controller_instance, "IOService".encode())),
+            )
             if set(["vendor-id", "device-id"]) & set(parent_properties.keys()):
-                controller["identifiers"]["pci_id"] = [hexswap(read_property(parent_properties[i], 4)).lower() for i in ["vendor-id", "device-id"]]
+                controller.identifiers.pci_id = model.PCIID(*[int(hexswap(read_property(parent_properties[i], 4)), 16) for i in ["vendor-id", "device-id"]])
 
             if set(["subsystem-vendor-id", "subsystem-id"]) & set(parent_properties.keys()):
-                controller["identifiers"]["pci_id"] += [hexswap(read_property(parent_properties[i], 4)).lower() for i in ["subsystem-vendor-id", "subsystem-id"]]
+                controller.identifiers.pci_id = controller.identifiers.pci_id._replace(
+                    **{key: int(hexswap(read_property(parent_properties[i], 4)), 16) for key, i in [("subsystem_vendor", "subsystem-vendor-id"), ("subsystem", "subsystem-id")]}
+                )
 
             if "revision-id" in parent_properties:
-                controller["identifiers"]["pci_revision"] = int(hexswap(read_property(parent_properties.get("revision-id", b""), 6)), 16)
+                controller.identifiers.pci_revision = int(hexswap(read_property(parent_properties.get("revision-id", b""), 6)), 16)
 
             if "acpi-path" in parent_properties:
-                controller["identifiers"]["acpi_path"] = "\\" + ".".join([i.split("@")[0] for i in parent_properties["acpi-path"].split("/")[1:]])
+                controller.identifiers.acpi_path = "\\" + ".".join([i.split("@")[0] for i in parent_properties["acpi-path"].split("/")[1:]])
 
             if "pcidebug" in parent_properties:
-                controller["identifiers"]["bdf"] = [int(i) for i in parent_properties["pcidebug"].split(":", 3)[:3]]
+                controller.identifiers.bdf = tuple(int(i) for i in parent_properties["pcidebug"].split(":", 3)[:3])
 
             if "bus-number" in parent_properties:
                 # TODO: Properly figure out max value
-                controller["identifiers"]["bus_number"] = int(hexswap(read_property(parent_properties["bus-number"], 6)), 16)
+                controller.identifiers.bus_number = int(hexswap(read_property(parent_properties["bus-number"], 6)), 16)
 
-            controller["class"] = self.controller_class_to_type(parent_properties, controller_properties, iokit.get_class_inheritance(controller_instance))
+            controller.class_ = self.controller_class_to_type(parent_properties, controller_properties, iokit.get_class_inheritance(controller_instance))
 
             err, port_iterator = iokit.IORegistryEntryGetChildIterator(controller_instance, "IOService".encode(), None)
             for port in iokit.ioiterator_to_list(port_iterator):
                 port_properties: dict = iokit.corefoundation_to_native(iokit.IORegistryEntryCreateCFProperties(port, None, iokit.kCFAllocatorDefault, iokit.kNilOptions)[1])  # type: ignore
-                controller["ports"].append(
-                    {
-                        "name": iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(port, None)[1]),
-                        "comment": None,
-                        "index": int(read_property(port_properties["port"], 6), 16),
-                        "class": macOSUSBMap.port_class_to_type(iokit.get_class_inheritance(port)),
-                        "type": None,
-                        "guessed": shared.USBPhysicalPortTypes.USB3TypeC_WithSwitch
+                controller.add_port(
+                    model.Port(
+                        name=iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(port, None)[1]),
+                        comment=None,
+                        index=int(read_property(port_properties["port"], 6), 16),
+                        class_=macOSUSBMap.port_class_to_type(iokit.get_class_inheritance(port)),
+                        type=None,
+                        guessed=shared.USBPhysicalPortTypes.USB3TypeC_WithSwitch
                         if set(iokit.get_class_inheritance(port)) & set(["AppleUSB20XHCITypeCPort", "AppleUSB30XHCITypeCPort"])
                         else port_properties.get("UsbConnector"),
-                        "location_id": port_properties["locationID"],
-                        "devices": [],
-                    }
+                        location_id=port_properties["locationID"],
+                    )
                 )
                 iokit.IOObjectRelease(port)
             controllers.append(controller)
 
             iokit.IOObjectRelease(controller_instance)
             iokit.IOObjectRelease(parent_device)
-        self.controllers = controllers
-        if not self.controllers_historical:
-            self.controllers_historical = copy.deepcopy(self.controllers)
-        else:
-            self.merge_controllers(self.controllers_historical, self.controllers)
-        self.update_devices()
+        return controllers
 
     def recurse_devices(self, iterator):
         props = []
@@ -131,44 +145,49 @@ class macOSUSBMap(BaseUSBMap):
         device = iokit.IOIteratorNext(iterator)
         while device:
             props.append(
-                {
-                    "name": iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(device, None)[1]),
-                    "port": iokit.IORegistryEntryCreateCFProperty(device, "PortNum", iokit.kCFAllocatorDefault, iokit.kNilOptions),
-                    "location_id": iokit.IORegistryEntryCreateCFProperty(device, "locationID", iokit.kCFAllocatorDefault, iokit.kNilOptions),
-                    "speed": shared.USBDeviceSpeeds(iokit.IORegistryEntryCreateCFProperty(device, "Device Speed", iokit.kCFAllocatorDefault, iokit.kNilOptions)),  # type: ignore
-                    "devices": self.recurse_devices(iterator),
-                }
+                model.Device(
+                    name=iokit.io_name_t_to_str(iokit.IORegistryEntryGetName(device, None)[1]),
+                    port=iokit.IORegistryEntryCreateCFProperty(device, "PortNum", iokit.kCFAllocatorDefault, iokit.kNilOptions),
+                    location_id=iokit.IORegistryEntryCreateCFProperty(device, "locationID", iokit.kCFAllocatorDefault, iokit.kNilOptions),
+                    speed=shared.USBDeviceSpeeds(iokit.IORegistryEntryCreateCFProperty(device, "Device Speed", iokit.kCFAllocatorDefault, iokit.kNilOptions)),  # type: ignore
+                    devices=self.recurse_devices(iterator),
+                )
             )
             iokit.IOObjectRelease(device)
             device = iokit.IOIteratorNext(iterator)
         iokit.IORegistryIteratorExitEntry(iterator)
-        props.sort(key=itemgetter("name"))
+        props.sort(key=attrgetter("name"))
         return props
 
+    @traced()
     def update_devices(self):
+        self.attach_devices(self.controllers)
+        return self.update_historical()
+
+    @traced()
+    def attach_devices(self, controllers):
         # Reset devices
-        for controller in self.controllers:
-            for port in controller["ports"]:
-                port["devices"] = []
+        for controller in controllers:
+            for port in controller.ports:
+                port.devices = []
 
         err, usb_plane_iterator = iokit.IORegistryCreateIterator(iokit.kIOMasterPortDefault, "IOUSB".encode(), 0, None)
         controller_instance = iokit.IOIteratorNext(usb_plane_iterator)
         while controller_instance:
             location_id = iokit.corefoundation_to_native(iokit.IORegistryEntryCreateCFProperty(controller_instance, "locationID", iokit.kCFAllocatorDefault, iokit.kNilOptions))
 
-            controller = [i for i in self.controllers if i["identifiers"]["location_id"] == location_id][0]
+            controller = [i for i in controllers if i.identifiers.location_id == location_id][0]
             # This is gonna be a controller
 
             devices = self.recurse_devices(usb_plane_iterator)
 
-            for port in controller["ports"]:
-                port["devices"] = [i for i in devices if i["port"] == port["index"] or i["location_id"] == port["location_id"]]
+            for port in controller.ports:
+                port.devices = [i for i in devices if i.port == port.index or i.location_id == port.location_id]
 
             iokit.IOObjectRelease(controller_instance)
             controller_instance = iokit.IOIteratorNext(usb_plane_iterator)
         iokit.IOObjectRelease(usb_plane_iterator)
 
-        self.merge_devices(self.controllers_historical, self.controllers)
-
 
-e = macOSUSBMap()
+if __name__ == "__main__":
+    macOSUSBMap.main()
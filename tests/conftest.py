@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Scripts is imported as a top level package, like when running Windows.py/macOS.py from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
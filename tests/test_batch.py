@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import batch
+from engine import KextVariant
+from Scripts import model
+
+
+def usb_json(path, port_type=3):
+    controllers = [model.Controller(name="XHC", class_=48, identifiers=model.Identifiers(bdf=(0, 20, 0)), ports=[model.Port(index=1, class_=3, type=port_type, devices=[model.Device(name="Keyboard")])])]
+    path.write_text(json.dumps(controllers, default=model.to_json))
+    return path
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    usb_json(tmp_path / "good.json")
+    (tmp_path / "torn.json").write_text('[{"name": "XHC", "ports": [')
+    (tmp_path / "empty.json").write_text("[]")
+    usb_json(tmp_path / "untyped.json", port_type=None)
+    usb_json(tmp_path / "also_good.json")
+    names = ["good", "torn", "missing", "empty", "untyped", "also_good"]
+    return [batch.BatchInput(tmp_path / f"{name}.json", name) for name in names]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_failures_isolated(tmp_path, inputs, jobs):
+    results, totals = batch.build_all(inputs, tmp_path / "out", batch.BatchOptions((KextVariant.USBTOOLBOX,)), jobs)
+    assert [result["input"] for result in results] == [str(i.path) for i in inputs]
+    errors = [result["error"].partition(":")[0] if result["error"] else None for result in results]
+    assert errors == [None, "JSONDecodeError", "ValueError", "ValueError", "ValueError", None]
+    assert (totals["built"], totals["failed"], totals["kexts"], totals["jobs"]) == (2, 4, 2, jobs)
+    assert sorted(i.name for i in (tmp_path / "out").iterdir()) == ["also_good", "good"]
+
+
+def test_native_needs_a_model(tmp_path, inputs):
+    options = batch.BatchOptions((KextVariant.USBTOOLBOX, KextVariant.NATIVE))
+    first = inputs[0]
+    results, _ = batch.build_all([first, first._replace(name="with_model", model_identifier="MacPro7,1")], tmp_path / "out", options, 1)
+    assert "needs a model identifier" in results[0]["error"] and results[0]["kexts"] == []
+    assert results[1]["error"] is None and len(results[1]["kexts"]) == 2
+
+
+def test_second_build_unchanged(tmp_path, inputs):
+    options = batch.BatchOptions((KextVariant.USBTOOLBOX,))
+    batch.build_all(inputs[:1], tmp_path / "out", options, 1)
+    _, totals = batch.build_all(inputs[:1], tmp_path / "out", options, 1)
+    assert (totals["kexts"], totals["unchanged"]) == (1, 1)
+
+
+def test_manifest_names(tmp_path):
+    (tmp_path / "manifest.txt").write_text("# fleet\nhost1/usb.json MacPro7,1\nhost2/usb.json\nhost1/usb.json  # again\n")
+    assert batch.read_manifest(tmp_path / "manifest.txt") == [
+        batch.BatchInput(tmp_path / "host1/usb.json", "host1", "MacPro7,1"),
+        batch.BatchInput(tmp_path / "host2/usb.json", "host2"),
+        batch.BatchInput(tmp_path / "host1/usb.json", "host1-2"),
+    ]
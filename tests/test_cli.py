@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import cli
+from engine import USBMapEngine
+from Scripts import model
+
+
+def write_usb_json(path, port_type=3):
+    controllers = [
+        model.Controller(
+            name="XHC",
+            class_=48,
+            identifiers=model.Identifiers(bdf=(0, 20, 0)),
+            ports=[model.Port(index=i, name=f"HS0{i}", class_=3, type=port_type, devices=[model.Device(name="Keyboard")] if i == 1 else []) for i in (1, 2)],
+        )
+    ]
+    path.write_text(json.dumps(controllers, default=model.to_json))
+    return path
+
+
+def run(tmp_path, *argv):
+    return cli.main(["--json", "--usb-json", str(tmp_path / "usb.json"), "--settings", str(tmp_path / "settings.json"), *argv])
+
+
+def test_build_ok(tmp_path, capsys):
+    write_usb_json(tmp_path / "usb.json")
+    assert run(tmp_path, "build", "--variant", "utb", "--out", str(tmp_path / "out")) == cli.EXIT_OK
+    kexts = json.loads(capsys.readouterr().out)["kexts"]
+    assert [(kext["variant"], kext["written"], kext["personalities"]) for kext in kexts] == [("utb", True, {"0:20:0": 1})]
+
+
+def test_select_ok(tmp_path, capsys):
+    write_usb_json(tmp_path / "usb.json")
+    assert run(tmp_path, "select", "-e", "A") == cli.EXIT_OK
+    assert json.loads(capsys.readouterr().out)["controllers"][0]["selected"] == 2
+
+
+@pytest.mark.parametrize("command", [["build"], ["select", "-e", "A"]])
+def test_no_data(tmp_path, capsys, command):
+    assert run(tmp_path, *command) == cli.EXIT_NO_DATA
+    assert json.loads(capsys.readouterr().out)["code"] == cli.EXIT_NO_DATA
+
+
+def test_bad_script(tmp_path, capsys):
+    write_usb_json(tmp_path / "usb.json")
+    assert run(tmp_path, "select", "-e", "T:1:nonsense") == cli.EXIT_USAGE
+    assert "Invalid script" in json.loads(capsys.readouterr().out)["error"]
+
+
+def test_native_without_model(tmp_path, monkeypatch):
+    write_usb_json(tmp_path / "usb.json")
+    monkeypatch.setattr(USBMapEngine, "detect_model_identifier", staticmethod(lambda: None))
+    assert run(tmp_path, "build", "--variant", "native", "--out", str(tmp_path / "out")) == cli.EXIT_USAGE
+
+
+def test_bad_arguments(tmp_path):
+    with pytest.raises(SystemExit) as e:
+        run(tmp_path, "build", "--variant", "nonsense")
+    assert e.value.code == cli.EXIT_USAGE
+
+
+def test_selection_errors(tmp_path, capsys):
+    write_usb_json(tmp_path / "usb.json", port_type=None)
+    assert run(tmp_path, "build", "--out", str(tmp_path / "out")) == cli.EXIT_INVALID
+    assert "missing a connector type" in json.loads(capsys.readouterr().out)["error"]
+    assert not (tmp_path / "out").exists()
+
+
+def test_discovery_unsupported(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli.platform, "system", lambda: "Plan9")
+    assert run(tmp_path, "snapshot") == cli.EXIT_UNSUPPORTED
+
+
+def test_batch_partial(tmp_path, capsys):
+    (tmp_path / "maps").mkdir()
+    write_usb_json(tmp_path / "maps" / "good.json")
+    (tmp_path / "maps" / "bad.json").write_text("[]")
+    assert run(tmp_path, "batch", str(tmp_path / "maps"), "--out", str(tmp_path / "out"), "--jobs", "1") == cli.EXIT_PARTIAL
+    result = json.loads(capsys.readouterr().out)
+    assert (result["built"], result["failed"]) == (1, 1)
@@ -0,0 +1,82 @@
+import plistlib
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from engine import KextVariant, USBMapEngine
+from Scripts import model
+
+
+def port(index, selected=True, class_=3):
+    return model.Port(index=index, name=f"Port {index}", class_=class_, guessed=3, selected=selected)
+
+
+@pytest.fixture
+def usbmap(tmp_path):
+    usbmap = USBMapEngine(tmp_path / "usb.json", tmp_path / "settings.json")
+    usbmap.controllers_historical = [
+        # ACPI path for USBToolBox, BDF for the native variants
+        model.Controller(name="XHC", class_=48, identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.XHC_", bdf=(0, 20, 0)), ports=[port(1), port(2, class_=4), port(3, False)]),
+        # Only a PCI ID, which every variant uses
+        model.Controller(name="ASMedia", class_=48, identifiers=model.Identifiers(pci_id=model.PCIID(0x1B21, 0x2142)), ports=[port(1)]),
+        model.Controller(name="EHC", class_=32, identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.EH01", bdf=(0, 29, 0)), ports=[port(1), port(2)]),
+        model.Controller(name="Empty", class_=48, identifiers=model.Identifiers(bdf=(0, 8, 0)), ports=[port(1, False)]),
+    ]
+    return usbmap
+
+
+def test_engine_import_is_light():
+    # The engine is meant to be embedded, asyncio alone takes longer to import than all of it
+    code = "import sys, engine; print(sorted({'asyncio', 'termcolor2', 'ansiescapes'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).resolve().parent.parent, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.parametrize("ignore_empty", [False, True])
+def test_one_pass_matches_single_variant_builds(usbmap, ignore_empty):
+    variants = [KextVariant.USBTOOLBOX, KextVariant.NATIVE, KextVariant.LEGACY_NATIVE]
+    together = usbmap.generate_plists(variants, "MacPro7,1", ignore_empty)
+    for variant in variants:
+        alone = usbmap.generate_plists([variant], "MacPro7,1", ignore_empty)[variant]
+        assert plistlib.dumps(together[variant], sort_keys=True) == plistlib.dumps(alone, sort_keys=True)
+    assert together[KextVariant.USBTOOLBOX]["IOKitPersonalities"]["XHC_"]["IONameMatch"] == "XHC_"
+    assert together[KextVariant.NATIVE]["IOKitPersonalities"]["XHC_"]["IOParentMatch"] == {"IOPropertyMatch": {"pcidebug": "0:20:0"}}
+    assert ("0:8:0" in together[KextVariant.NATIVE]["IOKitPersonalities"]) is not ignore_empty
+
+
+def named(usbmap, *controllers):
+    usbmap.controllers_historical = list(controllers)
+    names = usbmap.personality_names(usbmap.controllers_historical, usbmap.count_identifiers())
+    return [names[id(c)] for c in controllers]
+
+
+def test_personality_names(usbmap):
+    assert named(
+        usbmap,
+        model.Controller(name="A", identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.XHC_")),
+        model.Controller(name="B", identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.RP01.PXSX")),
+        model.Controller(name="C", identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.RP02.PXSX")),
+        model.Controller(name="D", identifiers=model.Identifiers(bdf=(0, 20, 0))),
+        model.Controller(name="E"),
+    ) == ["XHC_", "_SB_.PCI0.RP01.PXSX", "_SB_.PCI0.RP02.PXSX", "0:20:0", "E"]
+
+
+def test_colliding_personality_names_suffixed(usbmap):
+    # The second "Hub" skips "Hub-2", which another controller already has
+    assert named(
+        usbmap,
+        model.Controller(name="Hub"),
+        model.Controller(name="Hub-2"),
+        model.Controller(name="Hub"),
+        model.Controller(name="Hub"),
+        model.Controller(name="Other", identifiers=model.Identifiers(bdf=(0, 8, 0))),
+        model.Controller(name="Other", identifiers=model.Identifiers(bdf=(0, 8, 0))),
+    ) == ["Hub", "Hub-2", "Hub-3", "Hub-4", "0:8:0", "0:8:0-2"]
+
+
+def test_suffixed_personalities_all_written(usbmap):
+    usbmap.controllers_historical = [model.Controller(name="Hub", class_=48, identifiers=model.Identifiers(pci_id=model.PCIID(0x1B21, i)), ports=[port(1)]) for i in range(3)]
+    template = usbmap.generate_plists([KextVariant.USBTOOLBOX])[KextVariant.USBTOOLBOX]
+    assert sorted(template["IOKitPersonalities"]) == ["Hub", "Hub-2", "Hub-3"]
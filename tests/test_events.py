@@ -0,0 +1,64 @@
+import asyncio
+import os
+import threading
+import time
+
+from Scripts import events
+
+
+class ManualEventSource(events.EventSource):
+    def start(self):
+        return self
+
+
+def test_wait_async_woken_from_another_thread():
+    source = ManualEventSource()
+
+    async def wait():
+        threading.Timer(0.05, source.signal).start()
+        start = time.perf_counter()
+        woken = await source.wait_async(5)
+        return woken, time.perf_counter() - start
+
+    woken, waited = asyncio.run(wait())
+    assert woken
+    assert waited < 1
+    assert source.take()
+    assert not source.take()
+
+
+def test_wait_async_times_out():
+    source = ManualEventSource()
+    assert not asyncio.run(source.wait_async(0.05))
+
+
+def test_signal_before_wait_returns_at_once():
+    source = ManualEventSource()
+    source.signal()
+    assert asyncio.run(asyncio.wait_for(source.wait_async(5), 1))
+    assert source.events == 1
+
+
+def test_wait_takes_the_event():
+    source = ManualEventSource()
+    source.signal()
+    assert source.wait(0)
+    assert not source.wait(0.01)
+
+
+def test_file_event_source(tmp_path):
+    path = tmp_path / "dump.json"
+    path.write_text("1")
+    source = events.FileEventSource(path, interval=0.01).start()
+    try:
+
+        async def wait():
+            await asyncio.sleep(0.05)
+            path.write_text("22")
+            # Coarse filesystem timestamps could leave it unchanged
+            os.utime(path, ns=(0, path.stat().st_mtime_ns + 10**9))
+            return await source.wait_async(5)
+
+        assert asyncio.run(wait())
+    finally:
+        source.close()
@@ -0,0 +1,80 @@
+import os
+import plistlib
+import stat
+from unittest import mock
+
+import pytest
+
+from engine import KextVariant, USBMapEngine
+
+
+def template(**personalities):
+    return {"CFBundleIdentifier": "com.dhinakg.USBToolBox.map", "IOKitPersonalities": personalities}
+
+
+def info_plist(path):
+    return plistlib.loads((path / "Contents/Info.plist").read_bytes())
+
+
+def test_new_kext(tmp_path):
+    result = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    assert result.written and result.added == ["XHC"] and result.removed == [] and result.changed == []
+    assert result.path == tmp_path / KextVariant.USBTOOLBOX.kext_name
+    assert info_plist(result.path) == template(XHC={"port-count": 1})
+    assert os.listdir(tmp_path) == [KextVariant.USBTOOLBOX.kext_name]
+
+
+def test_unchanged_kext_left_alone(tmp_path):
+    first = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    before = os.stat(first.path / "Contents/Info.plist")
+    second = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    after = os.stat(first.path / "Contents/Info.plist")
+    assert not second.written
+    assert second.digest == first.digest
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+
+def test_changed_kext_swapped_in(tmp_path):
+    USBMapEngine.write_kext(template(XHC={"port-count": 1}, EHC={"port-count": 2}), KextVariant.USBTOOLBOX, tmp_path)
+    result = USBMapEngine.write_kext(template(XHC={"port-count": 3}, XHC1={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    assert result.written
+    assert (result.added, result.removed, result.changed) == (["XHC1"], ["EHC"], ["XHC"])
+    assert info_plist(result.path) == template(XHC={"port-count": 3}, XHC1={"port-count": 1})
+    assert os.listdir(tmp_path) == [KextVariant.USBTOOLBOX.kext_name]
+
+
+def test_failed_swap_keeps_old_kext(tmp_path):
+    USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    replace = os.replace
+    calls = []
+
+    def second_rename_fails(source, destination):
+        calls.append(source)
+        if len(calls) == 2:
+            raise OSError("No space left on device")
+        return replace(source, destination)
+
+    with mock.patch("os.replace", second_rename_fails), pytest.raises(OSError):
+        USBMapEngine.write_kext(template(XHC={"port-count": 2}), KextVariant.USBTOOLBOX, tmp_path)
+    assert info_plist(tmp_path / KextVariant.USBTOOLBOX.kext_name) == template(XHC={"port-count": 1})
+    assert os.listdir(tmp_path) == [KextVariant.USBTOOLBOX.kext_name]
+
+
+def test_torn_info_plist_replaced(tmp_path):
+    path = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path).path
+    data = (path / "Contents/Info.plist").read_bytes()
+    (path / "Contents/Info.plist").write_bytes(data[: len(data) // 2])
+    result = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path)
+    assert result.written and result.added == ["XHC"]
+    assert info_plist(path) == template(XHC={"port-count": 1})
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX modes")
+def test_kext_mode(tmp_path):
+    umask = os.umask(0)
+    os.umask(umask)
+    path = USBMapEngine.write_kext(template(XHC={"port-count": 1}), KextVariant.USBTOOLBOX, tmp_path).path
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o777 & ~umask
+    os.chmod(path, 0o750)
+    USBMapEngine.write_kext(template(XHC={"port-count": 2}), KextVariant.USBTOOLBOX, tmp_path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o750
@@ -0,0 +1,93 @@
+import copy
+import random
+
+import pytest
+
+from engine import USBMapEngine
+from Scripts import model, topology
+
+
+def controller(*ports, devices=None):
+    devices = devices or {}
+    return model.Controller(
+        name="XHC",
+        identifiers=model.Identifiers(bdf=(0, 20, 0)),
+        ports=[model.Port(index=i, name=f"Port {i}", devices=[model.Device(name=name) for name in devices.get(i, [])]) for i in ports],
+    )
+
+
+def port_devices(controller):
+    return {port.index: [device.name for device in port.devices] for port in controller.ports}
+
+
+def test_devices_merged_by_port_number_not_position():
+    base = [controller(1, 2, 3)]
+    new = [controller(3, 1, 2, devices={3: ["Keyboard"], 1: ["Mouse"]})]
+    USBMapEngine.merge_controllers(base, new)
+    assert port_devices(base[0]) == {1: ["Mouse"], 2: [], 3: ["Keyboard"]}
+
+
+def test_added_ports_mapped_and_sorted():
+    base = [controller(2, 4)]
+    index = topology.ControllerIndex(base)
+    USBMapEngine.merge_controllers(base, [controller(5, 1, 3, 2, devices={5: ["Disk"]})], index)
+    assert [port.index for port in base[0].ports] == [1, 2, 3, 4, 5]
+    assert all(base[0].get_port(port.index) is port for port in base[0].ports)
+    # Merging into the map's ports, not copies of them
+    USBMapEngine.merge_controllers(base, [controller(5, devices={5: ["Hub"]})], index)
+    assert port_devices(base[0])[5] == ["Disk", "Hub"]
+
+
+def test_port_map_rebuilt_on_load():
+    loaded = model.Controller.from_dict(controller(3, 1).to_dict())
+    assert loaded.get_port(3) is loaded.ports[0] and loaded.get_port(1) is loaded.ports[1]
+    assert loaded.get_port(2) is None
+
+
+def old_recursive_merge(base: list, new: list):
+    # The dict based merge DeviceTreeIndex replaced
+    for i in new:
+        if not i or i in base:
+            continue
+        elif i.get("error"):
+            continue
+        elif i["name"] not in [hub.get("name") for hub in base]:
+            base.append(i)
+        else:
+            old_hub = [hub for hub in base if hub.get("name") == i["name"]][0]
+            old_recursive_merge(old_hub["devices"], i["devices"])
+    for i in list(base):
+        if not i or i.get("error"):
+            base.remove(i)
+
+
+def random_devices(rng, depth=0):
+    # Few names, so hubs often show up again with different children
+    devices = []
+    for _ in range(rng.randrange(4 if depth < 3 else 1)):
+        if rng.random() < 0.15:
+            devices.append({"error": "Device failed enumeration"})
+            continue
+        name = rng.choice(["Hub", "Keyboard", "Mouse", "Disk"])
+        devices.append({"name": name, "instance_id": f"USB\\{name}", "speed": len(name) % 4, "devices": random_devices(rng, depth + 1)})
+    return devices
+
+
+def without_errors(devices):
+    # The old merge only dropped errors from the top of lists it merged into, DeviceTreeIndex keeps them out of stored subtrees entirely
+    return [i | {"devices": without_errors(i["devices"])} for i in devices if not i.get("error")]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_device_tree_merge_matches_old_merge(seed):
+    rng = random.Random(seed)
+    expected = []
+    base = []
+    tree = topology.DeviceTreeIndex()
+    for _ in range(15):
+        snapshot = random_devices(rng)
+        changed = tree.merge(base, [model.device_from_dict(i) for i in copy.deepcopy(snapshot)])
+        before = without_errors(expected)
+        old_recursive_merge(expected, snapshot)
+        assert [i.to_dict() for i in base] == without_errors(expected)
+        assert changed == (before != without_errors(expected))
@@ -0,0 +1,79 @@
+import json
+
+from Scripts import model
+
+CONTROLLER = {
+    "name": "Intel USB 3.1 xHCI",
+    "identifiers": {
+        "instance_id": "PCI\\VEN_8086&DEV_A36D&SUBSYS_86941043&REV_10\\3&11583659&0&A0",
+        "pci_id": {"vendor": "8086", "device": "a36d", "subsystem_vendor": "1043", "subsystem": "8694"},
+        "pci_revision": 16,
+        "acpi_path": "\\_SB_.PCI0.XHC_",
+        "bdf": [0, 20, 0],
+        "location_paths": ["PCIROOT(0)#PCI(1400)", "ACPI(_SB_)#ACPI(PCI0)#ACPI(XHC_)"],
+        "future_identifier": "kept",
+    },
+    "class": 48,
+    "hub_name": "\\\\?\\USB#ROOT_HUB30#4&1234&0&0#{f18a0e88-c30c-11d0-8815-00a0c906bed8}",
+    "port_count": 3,
+    "ports": [
+        {
+            "index": 1,
+            "name": "HS01",
+            "comment": "Front left",
+            "class": 3,
+            "status": "DeviceConnected",
+            "type": 3,
+            "guessed": None,
+            "devices": [
+                {
+                    "name": "Hub",
+                    "instance_id": "USB\\VID_05E3&PID_0610\\5&1",
+                    "port": 1,
+                    "speed": 3,
+                    "devices": [{"name": "Keyboard", "instance_id": "USB\\VID_046D&PID_C31C\\6&2", "port": 2, "speed": 1, "devices": []}, "Unknown device"],
+                }
+            ],
+            "companion_info": {"port": 1, "hub": "\\\\?\\USB#ROOT_HUB30#4&1234&0&0#{f18a0e88-c30c-11d0-8815-00a0c906bed8}", "multiple_companions": False},
+            "type_c": False,
+            "selected": True,
+            "selection_index": 1,
+        },
+        {"index": 2, "name": "HS02", "comment": None, "class": 3, "type": None, "guessed": 9, "devices": [{"error": "Device failed enumeration"}], "user_connectable": True},
+        {"index": 3, "name": "SS01", "comment": None, "class": 4, "type": None, "guessed": None, "devices": [], "location_id": 0x14300000, "future_field": [1, 2]},
+    ],
+    "selected_count": 1,
+}
+
+
+def canonical(data):
+    return json.loads(json.dumps(data, sort_keys=True))
+
+
+def test_round_trip():
+    controller = model.Controller.from_dict(CONTROLLER)
+    assert canonical(controller.to_dict()) == canonical(CONTROLLER)
+    assert canonical(json.loads(json.dumps([controller], default=model.to_json))) == canonical([CONTROLLER])
+
+
+def test_round_trip_through_copy():
+    controller = model.Controller.from_dict(CONTROLLER).copy()
+    assert canonical(controller.to_dict()) == canonical(CONTROLLER)
+
+
+def test_typed_fields():
+    controller = model.Controller.from_dict(CONTROLLER)
+    assert controller.identifiers.pci_id == model.PCIID(0x8086, 0xA36D, 0x1043, 0x8694)
+    assert controller.identifiers.bdf == (0, 20, 0)
+    assert controller.identifiers.acpi_path == "\\_SB_.PCI0.XHC_"
+    assert controller.get_port(2).devices[0].devices is None
+    assert controller.get_port(1).devices[0].devices[1] == "Unknown device"
+    assert controller.get_port(3).get("future_field") == [1, 2]
+
+
+def test_legacy_pci_id_lists():
+    windows = model.Identifiers.from_dict({"instance_id": "PCI\\VEN_8086", "pci_id": ["8086", "a36d", "8694", "1043"]})
+    assert windows.pci_id == model.PCIID(0x8086, 0xA36D, 0x1043, 0x8694)
+    macos = model.Identifiers.from_dict({"pci_id": ["8086", "a36d", "1043", "8694"]})
+    assert macos.pci_id == model.PCIID(0x8086, 0xA36D, 0x1043, 0x8694)
+    assert model.Identifiers.from_dict({"pci_id": ["8086", "a36d"]}).pci_id == model.PCIID(0x8086, 0xA36D)
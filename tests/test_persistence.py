@@ -0,0 +1,109 @@
+import json
+import os
+import stat
+
+import pytest
+
+from Scripts import model
+from Scripts.persistence import HistoricalStore
+
+
+def controllers():
+    return [model.Controller(name="XHC", identifiers=model.Identifiers(bdf=(0, 20, 0)), ports=[model.Port(index=1, name="HS01")])]
+
+
+def journaled_store(path):
+    store = HistoricalStore(path, debounce=0, journal=True)
+    store.mark_dirty()
+    store.flush(controllers())
+    for number in range(3):
+        store.record({"op": "port", "number": number})
+        assert store.flush(controllers())
+    return store
+
+
+def test_snapshot_round_trip(tmp_path):
+    store = HistoricalStore(tmp_path / "usb.json", debounce=0)
+    store.mark_dirty()
+    store.flush(controllers())
+    loaded, records = HistoricalStore(tmp_path / "usb.json").load()
+    assert [i.to_dict() for i in loaded] == [i.to_dict() for i in controllers()]
+    assert records == []
+
+
+def test_journal_replayed(tmp_path):
+    journaled_store(tmp_path / "usb.json")
+    store = HistoricalStore(tmp_path / "usb.json", journal=True)
+    _, records = store.load()
+    assert records == [{"op": "port", "number": number} for number in range(3)]
+    assert store.journal_length == 3
+    assert not store.dirty
+
+
+def test_torn_last_line_dropped(tmp_path):
+    journaled_store(tmp_path / "usb.json")
+    with (tmp_path / "usb.journal").open("a") as journal_file:
+        journal_file.write('{"op": "port", "num')
+    store = HistoricalStore(tmp_path / "usb.json", journal=True)
+    _, records = store.load()
+    assert records == [{"op": "port", "number": number} for number in range(3)]
+
+
+def test_journal_for_another_snapshot_ignored(tmp_path):
+    journaled_store(tmp_path / "usb.json")
+    # As if usb.json was rewritten and the process died before the journal was reset
+    data = json.loads((tmp_path / "usb.json").read_text())
+    data[0]["name"] = "XHC1"
+    (tmp_path / "usb.json").write_text(json.dumps(data))
+    store = HistoricalStore(tmp_path / "usb.json", journal=True)
+    loaded, records = store.load()
+    assert loaded[0].name == "XHC1"
+    assert records == []
+    assert store.journal_base is None
+
+
+def test_journal_without_journal_mode_forces_snapshot(tmp_path):
+    journaled_store(tmp_path / "usb.json")
+    store = HistoricalStore(tmp_path / "usb.json", debounce=0)
+    _, records = store.load()
+    assert len(records) == 3
+    assert store.dirty and store.needs_snapshot
+    store.flush(controllers())
+    assert not (tmp_path / "usb.journal").exists()
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX modes")
+def test_save_keeps_file_mode(tmp_path):
+    store = HistoricalStore(tmp_path / "usb.json", debounce=0)
+    store.mark_dirty()
+    store.flush(controllers())
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(os.stat(tmp_path / "usb.json").st_mode) == 0o666 & ~umask
+    os.chmod(tmp_path / "usb.json", 0o640)
+    store.mark_dirty()
+    store.flush(controllers() * 2)
+    assert stat.S_IMODE(os.stat(tmp_path / "usb.json").st_mode) == 0o640
+
+
+def test_deferred_save_is_due_later(tmp_path):
+    store = HistoricalStore(tmp_path / "usb.json", debounce=60)
+    assert store.flush_due() is None
+    store.mark_dirty()
+    store.flush(controllers())
+    assert store.flush_due() is None
+    store.mark_dirty()
+    assert not store.save(controllers())
+    assert 59 < store.flush_due() <= 60
+    # Deferred, not saved
+    assert store.writes_saved == 0
+
+
+def test_identical_snapshot_counted_as_saved(tmp_path):
+    store = HistoricalStore(tmp_path / "usb.json", debounce=0)
+    store.mark_dirty()
+    store.flush(controllers())
+    store.mark_dirty()
+    store.flush(controllers())
+    assert store.writes == 1
+    assert store.writes_saved == 1
@@ -0,0 +1,71 @@
+import pytest
+
+from Scripts.scheduler import PollScheduler
+
+
+def idle(poll_scheduler, now, count):
+    # Idle polls, each waiting the interval the last one asked for
+    intervals = []
+    for _ in range(count):
+        now += poll_scheduler.interval
+        intervals.append(poll_scheduler.record(0.01, False, now))
+    return now, intervals
+
+
+def test_first_enumeration_is_steady():
+    poll_scheduler = PollScheduler(cpu_budget=0)
+    assert poll_scheduler.interval == 5.0
+    # The first snapshot is always new, it isn't a change to burst on
+    assert poll_scheduler.record(0.01, True, 100.0) == 5.0
+    assert idle(poll_scheduler, 100.0, 2)[1] == [10.0, 10.0]
+
+
+@pytest.mark.parametrize("minimum, maximum, expected", [(0.5, 2.0, 2.0), (8.0, 20.0, 8.0), (3.0, 3.0, 3.0)])
+def test_steady_interval_within_limits(minimum, maximum, expected):
+    assert PollScheduler(minimum, maximum).interval == expected
+
+
+def test_burst_then_backoff():
+    poll_scheduler = PollScheduler(0.5, 10.0, backoff=2.0, burst=2.0, cpu_budget=0)
+    poll_scheduler.record(0.01, False, 0.0)
+    assert poll_scheduler.record(0.01, True, 10.0) == 0.5
+    # Minimum interval until the burst runs out 2 s after the change, then doubling up to the maximum
+    now, intervals = idle(poll_scheduler, 10.0, 10)
+    assert intervals == [0.5, 0.5, 0.5, 1.0, 2.0, 4.0, 8.0, 10.0, 10.0, 10.0]
+    # Another change starts over
+    assert poll_scheduler.record(0.01, True, now) == 0.5
+
+
+def test_budget_stretches_interval():
+    # 1 s enumerations with 3 s per minute fit every 20 s
+    poll_scheduler = PollScheduler(0.5, 60.0, cpu_budget=3.0)
+    poll_scheduler.record(1.0, False, 0.0)
+    assert poll_scheduler.record(1.0, True, 20.0) == 20.0
+
+
+def test_budget_stretch_clamped_to_maximum():
+    poll_scheduler = PollScheduler(0.5, 10.0, cpu_budget=3.0)
+    poll_scheduler.record(1.0, False, 0.0)
+    assert poll_scheduler.record(1.0, True, 10.0) == 10.0
+
+
+def test_budget_only_counts_the_last_minute():
+    poll_scheduler = PollScheduler(0.5, 60.0, burst=1000.0, cpu_budget=3.0)
+    poll_scheduler.record(6.0, False, 0.0)
+    poll_scheduler.record(0.01, True, 1.0)
+    assert poll_scheduler.interval > 0.5
+    assert poll_scheduler.spent(60.5) == pytest.approx(0.01)
+    assert poll_scheduler.record(0.01, True, 62.0) == 0.5
+
+
+def test_fixed_interval():
+    # cli.py discover --interval
+    poll_scheduler = PollScheduler(2.0, 2.0, cpu_budget=0)
+    assert poll_scheduler.interval == 2.0
+    poll_scheduler.record(0.01, True, 0.0)
+    assert [poll_scheduler.record(0.01, changed, 2.0 * i) for i, changed in enumerate([True, False, False], 1)] == [2.0, 2.0, 2.0]
+
+
+def test_from_settings():
+    poll_scheduler = PollScheduler.from_settings({"poll_min_interval": 1.0, "poll_max_interval": 30.0, "poll_cpu_budget": 0, "unrelated": True})
+    assert (poll_scheduler.minimum, poll_scheduler.maximum, poll_scheduler.cpu_budget, poll_scheduler.backoff) == (1.0, 30.0, 0, 2.0)
@@ -0,0 +1,95 @@
+import contextlib
+import io
+import os
+from unittest import mock
+
+import pytest
+
+from Scripts.screen import CLEAR, Screen
+
+
+@pytest.fixture
+def terminal():
+    size = [os.terminal_size((40, 10))]
+    with mock.patch("shutil.get_terminal_size", side_effect=lambda: size[0]):
+        yield size
+
+
+def render(screen, lines, prompt="> "):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        screen.render(lines, prompt)
+    return output.getvalue()
+
+
+def ansi_screen():
+    screen = Screen()
+    screen.ansi = True
+    return screen
+
+
+def test_first_frame_is_full(terminal):
+    screen = ansi_screen()
+    output = render(screen, ["a", "b"])
+    assert output == CLEAR + "a\nb\n> "
+    assert screen.full_redraws == 1
+
+
+def test_only_changed_lines_rewritten(terminal):
+    screen = ansi_screen()
+    render(screen, ["a", "b", "c"])
+    output = render(screen, ["a", "B", "c"])
+    assert output == "\x1b[2;1HB\x1b[K\x1b[4;1H> \x1b[J"
+    assert (screen.full_redraws, screen.partial_redraws) == (1, 1)
+
+
+def test_unchanged_frame_rewrites_prompt_only(terminal):
+    screen = ansi_screen()
+    render(screen, ["a", "b"])
+    assert render(screen, ["a", "b"], "Scanning: ") == "\x1b[3;1HScanning: \x1b[J"
+
+
+def test_shorter_frame_erases_below(terminal):
+    screen = ansi_screen()
+    render(screen, ["a", "b", "c"])
+    assert render(screen, ["a"]) == "\x1b[2;1H> \x1b[J"
+
+
+def test_wrapped_line_moves_the_lines_under_it(terminal):
+    screen = ansi_screen()
+    render(screen, ["a", "b"])
+    output = render(screen, ["a" * 50, "b"])
+    # The first line now takes two rows, so b moves down one
+    assert output == "\x1b[1;1H" + "a" * 50 + "\x1b[K\x1b[3;1Hb\x1b[K\x1b[4;1H> \x1b[J"
+
+
+def test_resize_redraws_everything(terminal):
+    screen = ansi_screen()
+    render(screen, ["a"])
+    terminal[0] = os.terminal_size((60, 10))
+    assert render(screen, ["a"]).startswith(CLEAR)
+
+
+def test_frame_taller_than_terminal_redraws_everything(terminal):
+    screen = ansi_screen()
+    render(screen, ["a"])
+    assert render(screen, [str(i) for i in range(20)]).startswith(CLEAR)
+
+
+def test_frame_on_the_last_row_redraws_next_time(terminal):
+    # Enter after a prompt on the bottom row scrolls the terminal, so the next frame can't be addressed by row
+    screen = ansi_screen()
+    render(screen, [str(i) for i in range(9)])
+    assert render(screen, [str(i) for i in range(9)]).startswith(CLEAR)
+    render(screen, [str(i) for i in range(8)])
+    assert not render(screen, [str(i) for i in range(8)]).startswith(CLEAR)
+
+
+def test_without_ansi_always_full(terminal):
+    screen = ansi_screen()
+    screen.ansi = False
+    with mock.patch("os.system") as system:
+        render(screen, ["a"])
+        render(screen, ["a"])
+    assert system.call_count == 2
+    assert screen.full_redraws == 2
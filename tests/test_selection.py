@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from Scripts import model, topology
+from Scripts.selection import MAX_PORTS, SelectionModel
+
+
+def companion_info(port):
+    return {"hub": "hub0", "port": port, "multiple_companions": False}
+
+
+def make_selection(pairs=2, extra=0, auto_bind=True):
+    # USB 2 port n is the companion of USB 3 port pairs + n, with a device on USB 3 port pairs + 1 only
+    ports = [model.Port(index=i, type=3, companion_info=companion_info(pairs + i)) for i in range(1, pairs + 1)]
+    ports += [model.Port(index=pairs + i, type=3, companion_info=companion_info(i), devices=[model.Device(name="Disk")] if i == 1 else []) for i in range(1, pairs + 1)]
+    ports += [model.Port(index=2 * pairs + i, guessed=3) for i in range(1, extra + 1)]
+    controllers = [model.Controller(name="XHC", identifiers=model.Identifiers(bdf=(0, 20, 0)), hub_name="hub0", ports=ports)]
+    return SelectionModel(controllers, topology.ControllerIndex(controllers).companions, auto_bind)
+
+
+def selected(selection):
+    return [port.selection_index for port in selection.by_port if port.selected]
+
+
+def test_populated_ports_and_companions_selected_by_default():
+    selection = make_selection()
+    assert selected(selection) == [1, 3]
+    assert selection.controllers[0].selected_count == 2
+    controllers, ports = selection.take_changes()
+    assert controllers == selection.controllers and len(ports) == 4
+    assert selection.take_changes() == ([], [])
+
+
+def test_toggle_binds_companions_once():
+    selection = make_selection()
+    selection.take_changes()
+    # 2 and its companion 4 are flipped together, 4 later in the list isn't flipped back
+    selection.toggle(["2", "4"])
+    assert selected(selection) == [1, 2, 3, 4]
+    assert selection.controllers[0].selected_count == 4
+    assert sorted(port.index for port in selection.take_changes()[1]) == [2, 4]
+
+    unbound = make_selection(auto_bind=False)
+    unbound.toggle(["2"])
+    assert selected(unbound) == [1, 2, 3]
+
+
+def test_counters_follow_every_command():
+    rng = random.Random(0)
+    selection = make_selection(pairs=6, extra=5)
+    for _ in range(300):
+        numbers = [str(rng.randrange(1, 19)) for _ in range(rng.randrange(1, 4))]
+        command = rng.randrange(6)
+        if command == 0:
+            selection.toggle(numbers)
+        elif command == 1:
+            selection.set_selections(numbers, rng.random() < 0.5)
+        elif command == 2:
+            selection.select_all(rng.random() < 0.5)
+        elif command == 3:
+            selection.select_populated()
+        elif command == 4:
+            selection.deselect_empty()
+        else:
+            selection.set_types(numbers, rng.choice([None, 3, 9]))
+        controller = selection.controllers[0]
+        assert controller.selected_count == len(selected(selection))
+        assert bool(selection.over_limit) == (controller.selected_count > MAX_PORTS)
+        assert sorted(p.index for p in selection.missing_type.values()) == [p.index for p in controller.ports if p.selected and p.type is None and p.guessed is None]
+
+
+def test_over_limit_and_missing_type():
+    selection = make_selection(pairs=6, extra=5)
+    selection.select_all(True)
+    assert selection.controllers[0].selected_count == 17
+    assert list(selection.over_limit.values()) == selection.controllers
+    selection.set_selections(["17", "16"], False)
+    assert selection.controllers[0].selected_count == 15
+    assert not selection.over_limit
+
+    selection.set_types(["1"], None)
+    # Port 1 is bound to port 7, so both lose their type
+    assert selection.errors() == ["Port 1 is missing a connector type!", "Port 7 is missing a connector type!"]
+    selection.set_selections(["7"], False)
+    assert selection.errors() == []
+
+
+@pytest.mark.parametrize("number", ["0", "99"])
+def test_out_of_range_numbers_ignored(number):
+    selection = make_selection()
+    selection.toggle([number])
+    assert selected(selection) == [1, 3]
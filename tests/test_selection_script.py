@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+from Scripts import model, selection_script, shared, topology
+from Scripts.selection import SelectionModel
+
+
+def make_selection(ports_per_controller=(4, 3)):
+    controllers = []
+    for number, port_count in enumerate(ports_per_controller):
+        controllers.append(
+            model.Controller(
+                name=f"Controller {number}",
+                identifiers=model.Identifiers(pci_id=model.PCIID(0x8086, number)),
+                class_=shared.USBControllerTypes.XHCI,
+                ports=[
+                    model.Port(index=index, name=f"HS{index:02}", class_=shared.USBDeviceSpeeds.HighSpeed, devices=[model.Device(name="Keyboard")] if index == 1 else [], selected=False)
+                    for index in range(1, port_count + 1)
+                ],
+            )
+        )
+    return SelectionModel(controllers, topology.ControllerIndex(controllers).companions)
+
+
+def selected(selection):
+    return [port.selection_index for port in selection.by_port if port.selected]
+
+
+def test_toggle_numbers_and_ranges():
+    selection = make_selection()
+    selection_script.run(selection_script.parse("1,3-5"), selection)
+    assert selected(selection) == [1, 3, 4, 5]
+    selection_script.run(selection_script.parse("3-4"), selection)
+    assert selected(selection) == [1, 5]
+
+
+def test_select_deselect_and_predicates():
+    selection = make_selection()
+    selection_script.run(selection_script.parse("+1-7; -controller=2&empty"), selection)
+    assert selected(selection) == [1, 2, 3, 4, 5]
+    selection_script.run(selection_script.parse("N\n+populated"), selection)
+    assert selected(selection) == [1, 5]
+
+
+def test_select_returns_numbers_in_given_order():
+    selection = make_selection()
+    assert selection_script.select(selection, selection_script.parse_selector("6,2-3")) == ["6", "2", "3"]
+    assert selection_script.select(selection, selection_script.parse_selector("1-7&controller=2")) == ["5", "6", "7"]
+
+
+def test_range_is_clamped_to_the_ports():
+    selection = make_selection()
+    start = time.perf_counter()
+    numbers = selection_script.select(selection, selection_script.parse_selector("0-999999999"))
+    assert time.perf_counter() - start < 0.1
+    assert numbers == [str(i) for i in range(1, 8)]
+    assert selection_script.select(selection, selection_script.parse_selector("100-999999999")) == []
+
+
+def test_connector_type():
+    selection = make_selection()
+    selection_script.run(selection_script.parse("T:1-2:9"), selection)
+    assert [port.type for port in selection.by_port[:3]] == [shared.USBPhysicalPortTypes(9)] * 2 + [None]
+
+
+@pytest.mark.parametrize("comments", [True, False])
+def test_comment_keeps_semicolons_and_hashes(comments):
+    selection = make_selection()
+    selection_script.run(selection_script.parse("+1; C:3:Front #2; left", comments=comments), selection)
+    assert selection.get(3).comment == "Front #2; left"
+    assert selected(selection) == [1]
+
+
+def test_comment_cleared_and_file_comments():
+    selection = make_selection()
+    selection.get(2).comment = "Old"
+    statements = selection_script.parse("# set up\n+1 # the keyboard\nC:2\n")
+    assert [statement.action for statement in statements] == ["select", "comment"]
+    selection_script.run(statements, selection)
+    assert selection.get(2).comment is None
+    assert selected(selection) == [1]
+
+
+@pytest.mark.parametrize("script", ["5-2", "T:1:99", "T:1", "speed=XX", "bogus", "+"])
+def test_invalid_scripts(script):
+    with pytest.raises(selection_script.ScriptError):
+        selection_script.parse(script)
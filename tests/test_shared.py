@@ -0,0 +1,23 @@
+from Scripts import shared
+
+
+def test_debug_goes_to_stderr(monkeypatch, capsys):
+    monkeypatch.setattr(shared, "debugging", True)
+    shared.debug("Using ACPI path")
+    captured = capsys.readouterr()
+    assert captured.out == ""
+    assert captured.err == "DEBUG: Using ACPI path\n"
+    assert shared.debug_log[-1] == "Using ACPI path"
+
+
+def test_debug_quiet_while_discovery_shows_it(monkeypatch, capsys):
+    monkeypatch.setattr(shared, "debugging", True)
+    monkeypatch.setattr(shared, "debug_on_screen", True)
+    shared.debug("Unknown port type")
+    assert capsys.readouterr().err == ""
+    assert shared.debug_log[-1] == "Unknown port type"
+
+
+def test_debug_off(capsys):
+    shared.debug("nothing")
+    assert capsys.readouterr().err == ""
@@ -0,0 +1,211 @@
+import random
+
+import pytest
+
+from engine import USBMapEngine
+from Scripts import model, topology
+
+
+def random_identifiers(rng):
+    # Few distinct values per identifier, so controllers often share some identifiers and disagree on others
+    identifiers = model.Identifiers()
+    if rng.random() < 0.5:
+        identifiers.instance_id = f"PCI\\VEN_8086&DEV_{rng.randrange(4):04X}"
+    if rng.random() < 0.3:
+        identifiers.location_id = rng.randrange(4)
+    if rng.random() < 0.4:
+        identifiers.pci_id = model.PCIID(0x8086, rng.randrange(3))
+    if rng.random() < 0.3:
+        identifiers.pci_revision = rng.randrange(2)
+    if rng.random() < 0.4:
+        identifiers.acpi_path = rng.choice(["\\_SB.PCI0.XHC", "\\_SB_.PCI0.XHC_", "\\_SB.PCI0.XHC1", "\\_SB.PCI0.EHC1"])
+    if rng.random() < 0.4:
+        identifiers.bdf = (0, rng.randrange(3), 0)
+    if rng.random() < 0.3:
+        identifiers.location_paths = rng.sample(["PCIROOT(0)#PCI(1400)", "PCIROOT(0)#PCI(1D00)", "ACPI(_SB_)#ACPI(PCI0)#ACPI(XHC_)"], rng.randrange(1, 3))
+    return identifiers
+
+
+def linear_find(controllers, original):
+    return next((controller for controller in controllers if topology.is_same_controller(original, controller)), None)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_find_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    controllers = [model.Controller(name=f"Controller {i}", identifiers=random_identifiers(rng)) for i in range(200)]
+    index = topology.ControllerIndex(controllers)
+    for _ in range(500):
+        original = model.Controller(identifiers=random_identifiers(rng))
+        assert index.find(original) is linear_find(controllers, original)
+
+
+def test_find_after_update_and_add():
+    rng = random.Random(10)
+    controllers = [model.Controller(name=f"Controller {i}", identifiers=random_identifiers(rng)) for i in range(100)]
+    index = topology.ControllerIndex(controllers)
+    for controller in rng.sample(controllers, 30):
+        controller.identifiers = random_identifiers(rng)
+        index.update(controller)
+    for i in range(20):
+        controller = model.Controller(name=f"Added {i}", identifiers=random_identifiers(rng))
+        controllers.append(controller)
+        index.add(controller)
+    for _ in range(500):
+        original = model.Controller(identifiers=random_identifiers(rng))
+        assert index.find(original) is linear_find(controllers, original)
+
+
+def test_acpi_padding_matches():
+    windows = model.Controller(identifiers=model.Identifiers(acpi_path="\\_SB.PCI0.XHC"))
+    macos = model.Controller(identifiers=model.Identifiers(acpi_path="\\_SB_.PCI0.XHC_"))
+    assert topology.is_same_controller(windows, macos)
+    assert topology.ControllerIndex([macos]).find(windows) is macos
+
+
+def test_pci_revision_alone_never_matches():
+    controller = model.Controller(identifiers=model.Identifiers(pci_revision=1))
+    assert topology.ControllerIndex([controller]).find(model.Controller(identifiers=model.Identifiers(pci_revision=1))) is None
+
+
+def snapshot(devices=()):
+    # Fresh objects every time, like each poll
+    return [
+        model.Controller(name="XHC", identifiers=model.Identifiers(bdf=(0, 20, 0)), ports=[model.Port(index=i, devices=[model.Device(name=d) for d in devices if i == 1]) for i in (1, 2)]),
+        model.Controller(name="EHC", identifiers=model.Identifiers(bdf=(0, 29, 0)), ports=[model.Port(index=1)]),
+    ]
+
+
+def test_snapshot_digest_skips_identical_snapshots():
+    digest = topology.SnapshotDigest()
+    first = snapshot()
+    assert digest.update(first) == (True, first)
+    assert digest.update(snapshot()) == (False, [])
+    assert (digest.hits, digest.misses, digest.changed_ports) == (1, 1, 0)
+
+
+def test_snapshot_digest_reports_changed_controllers_only():
+    digest = topology.SnapshotDigest()
+    digest.update(snapshot())
+    changed = snapshot(["Keyboard"])
+    assert digest.update(changed) == (True, [changed[0]])
+    assert digest.changed_ports == 1
+    # Back to the old device list is a change too
+    assert digest.update(snapshot())[0]
+    assert (digest.hits, digest.misses) == (0, 3)
+
+
+def test_snapshot_digest_removed_controller_is_a_change():
+    digest = topology.SnapshotDigest()
+    digest.update(snapshot())
+    assert digest.update(snapshot()[:1]) == (True, [])
+    assert digest.changed_ports == 1
+
+
+def linear_companion(controllers, port):
+    # The scan CompanionGraph replaced
+    companion_info = port.companion_info
+    if not companion_info or not companion_info["hub"] or not companion_info["port"]:
+        return None
+    hub = [i for i in controllers if i.hub_name == companion_info["hub"]]
+    if hub:
+        return next((i for i in hub[0].ports if i.index == companion_info["port"]), None)
+    return None
+
+
+def random_companion_info(rng):
+    if rng.random() < 0.2:
+        return None
+    return {"hub": rng.choice(["hub0", "hub1", "hub2", None]), "port": rng.randrange(5), "multiple_companions": False}
+
+
+def random_hub_controller(rng, name):
+    # hub2 may be taken by two controllers, the first one wins
+    ports = [model.Port(index=i, companion_info=random_companion_info(rng)) for i in rng.sample(range(1, 5), rng.randrange(1, 5))]
+    return model.Controller(name=name, identifiers=model.Identifiers(bdf=(0, int(name), 0)), hub_name=rng.choice(["hub0", "hub1", "hub2", "hub2", None]), ports=ports)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_companions_match_linear_scan(seed):
+    rng = random.Random(seed)
+    controllers = [random_hub_controller(rng, str(i)) for i in range(4)]
+    index = topology.ControllerIndex(controllers)
+    for step in range(100):
+        action = rng.randrange(4)
+        controller = rng.choice(controllers)
+        if action == 0:
+            controller.hub_name = rng.choice(["hub0", "hub1", "hub2", None])
+            index.update(controller)
+        elif action == 1:
+            port = rng.choice(controller.ports)
+            port.companion_info = random_companion_info(rng)
+            index.update_port(port)
+        elif action == 2 and len(controller.ports) < 6:
+            port = model.Port(index=max(i.index for i in controller.ports) + 1, companion_info=random_companion_info(rng))
+            index.add_port(controller, port)
+        elif action == 3 and len(controllers) < 8:
+            controller = random_hub_controller(rng, str(step))
+            controllers.append(controller)
+            index.add(controller)
+
+        ports = [(c, p) for c in controllers for p in c.ports]
+        for controller, port in ports:
+            assert index.companions.companion(port) is linear_companion(controllers, port)
+            expected = [p for _, p in ports if linear_companion(controllers, p) is port]
+            assert sorted(map(id, index.companions.referrers(controller, port))) == sorted(map(id, expected))
+
+
+def test_merged_companion_info_updates_graph():
+    def controller(companion_port):
+        return model.Controller(
+            name="XHC", identifiers=model.Identifiers(bdf=(0, 20, 0)), hub_name="hub0", ports=[model.Port(index=i, companion_info={"hub": "hub0", "port": companion_port, "multiple_companions": False}) for i in (1, 2, 3)]
+        )
+
+    historical = [controller(2)]
+    index = topology.ControllerIndex(historical)
+    USBMapEngine.merge_controllers(historical, [controller(3)], index)
+    ports = historical[0].ports
+    assert index.companions.companion(ports[0]) is ports[2]
+    assert sorted(p.index for p in index.companions.referrers(historical[0], ports[2])) == [1, 2, 3]
+    assert index.companions.referrers(historical[0], ports[1]) == []
+
+
+def random_search_port(rng, number):
+    names = ["USB Keyboard", "Logitech Mouse", "SanDisk Ultra", "Hub", "Bluetooth"]
+    devices = [model.Device(name=name, instance_id=f"USB\\VID_{rng.randrange(16):04X}&PID_{rng.randrange(16):04X}\\{number}") for name in rng.sample(names, rng.randrange(3))]
+    return model.Port(index=number, name=f"HS{number:02}", comment=rng.choice([None, "Front left", "Rear USB-C"]), selection_index=number, devices=devices)
+
+
+def linear_search(ports, query):
+    query = query.strip().lower()
+    return {id(port) for port in ports if query in "\n".join(topology.SearchIndex.terms(port))}
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_search_matches_substring_scan(seed):
+    rng = random.Random(seed)
+    ports = [random_search_port(rng, i) for i in range(1, 40)]
+    index = topology.SearchIndex()
+    for port in ports:
+        index.update_port(port)
+    for port in rng.sample(ports, 10):
+        port.devices = random_search_port(rng, port.index).devices
+        index.update_port(port)
+    for port in rng.sample(ports, 5):
+        ports.remove(port)
+        index.remove_port(port)
+
+    texts = ["\n".join(topology.SearchIndex.terms(port)) for port in ports]
+    queries = ["", " ", "zz", "k", "1", "b", "us", "se", "ey", "eyb", "vid_000", "front", "RT LEFT"]
+    queries += [text[start : start + length] for text in rng.sample(texts, 10) for length in (1, 2, 3, 5) for start in [rng.randrange(max(1, len(text) - length))]]
+    for query in queries:
+        assert index.search(query) == linear_search(ports, query), query
+
+
+def test_short_queries_match_inside_words():
+    port = model.Port(index=1, name="HS01", devices=[model.Device(name="USB Keyboard", instance_id="USB\\VID_046D&PID_C31C\\1")])
+    index = topology.SearchIndex()
+    index.update_port(port)
+    assert all(index.search(query) == {id(port)} for query in ("y", "bo", "31", "6d", "keyb"))
+    index.remove_port(port)
+    assert index.search("y") == set() and index.search("") == set()
@@ -0,0 +1,75 @@
+import os
+from unittest import mock
+
+from Scripts.viewport import Section, Viewport
+
+
+def sections(*counts):
+    made = []
+
+    def section(number, count):
+        def lines():
+            made.append(number)
+            return [f"{number}.{line}" for line in range(count)]
+
+        return Section(count, lines)
+
+    return [section(number, count) for number, count in enumerate(counts)], made
+
+
+def test_renders_window_and_only_visible_sections():
+    parts, made = sections(3, 4, 5, 6)
+    view = Viewport()
+    assert view.render(parts, 4) == ["0.0", "0.1", "0.2", "1.0"]
+    assert made == [0, 1]
+    view.page_down()
+    made.clear()
+    assert view.render(parts, 4) == ["1.1", "1.2", "1.3", "2.0"]
+    assert made == [1, 2]
+    assert view.status() == "Lines 5-8 of 18 ([ ] page, < > controller)"
+
+
+def test_paging_stops_at_the_ends():
+    parts, _ = sections(3, 4, 5, 6)
+    view = Viewport()
+    view.render(parts, 5)
+    for _ in range(10):
+        view.page_down()
+    assert view.top == 13
+    assert view.render(parts, 5) == ["3.1", "3.2", "3.3", "3.4", "3.5"]
+    for _ in range(10):
+        view.page_up()
+    assert view.top == 0
+
+
+def test_section_keys():
+    parts, _ = sections(3, 4, 5, 6)
+    view = Viewport()
+    view.render(parts, 4)
+    assert view.handle(">") and view.top == 3
+    assert view.handle(" > ") and view.top == 7
+    assert view.handle("<") and view.top == 3
+    assert not view.handle("x")
+
+
+def test_top_clamped_when_content_shrinks():
+    parts, _ = sections(10, 10)
+    view = Viewport()
+    view.render(parts, 5)
+    view.top = 15
+    parts, _ = sections(4, 4)
+    assert view.render(parts, 5) == ["0.3", "1.0", "1.1", "1.2", "1.3"]
+    assert view.top == 3
+
+
+def test_fits_everything_and_no_status():
+    parts, _ = sections(2, 2)
+    view = Viewport()
+    assert len(view.render(parts, 10)) == 4
+    assert view.status() is None
+
+
+def test_fit_leaves_a_row_for_the_echoed_newline():
+    with mock.patch("shutil.get_terminal_size", return_value=os.terminal_size((80, 40))):
+        assert Viewport.fit(10) == 29
+        assert Viewport.fit(38) == 5